@@ -1,3 +1,4 @@
+from . import jit  # noqa: F401  (numba environment; must precede any numba import)
 from .main import app
 
 __all__ = ["app"]
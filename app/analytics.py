@@ -1,97 +1,426 @@
 from __future__ import annotations
 
+import io
 import os
-from typing import Any, Dict, List, Tuple
-from collections import defaultdict
+import sys
+import time
+import asyncio
+import itertools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Mapping, Tuple
+from dataclasses import dataclass, field, replace
 from datetime import datetime, timedelta
 
 import numpy as np
 import numba as nb
 import orjson
 
-from fastapi import APIRouter, Request
-from fastapi.responses import ORJSONResponse
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from .userid import get_user_id_from_file
+from cachetools import LRUCache
+
+try:
+    import pyarrow as pa
+except ImportError:  # optional: only the Arrow IPC response format needs it
+    pa = None
+
+from . import journal, shm, snapshot, telemetry
+from . import ingest
+from .ingest import NO_GROUP, SPOILAGE, DumpIngest, LedgerParts, UnsoldParts, iter_json_batches
+from .userid import get_user_id_from_file, is_admin
 
 BASE_DIR = os.path.join(os.path.dirname(__file__), "..", "routes")
 STOCK_DUMP = os.path.join(BASE_DIR, "stock_dump.json")
 SALES_DUMP = os.path.join(BASE_DIR, "sales_dump.json")
 
+RESULT_CACHE_BYTES = int(os.getenv("ANALYTICS_CACHE_BYTES", str(64 * 1024 * 1024)))
+RELOAD_INTERVAL = float(os.getenv("ANALYTICS_RELOAD_INTERVAL", "5"))
+SNAPSHOT_PATH = os.getenv("ANALYTICS_SNAPSHOT_PATH", os.path.join(BASE_DIR, "analytics.snapshot"))
+SHM_NAME = os.getenv("ANALYTICS_SHM_NAME", "")
+BATCH_MAX_RANGES = int(os.getenv("ANALYTICS_BATCH_MAX_RANGES", "400"))
+SERIES_MAX_BUCKETS = int(os.getenv("ANALYTICS_SERIES_MAX_BUCKETS", "400"))
+COMPUTE_CONCURRENCY = int(os.getenv("ANALYTICS_COMPUTE_CONCURRENCY", "2"))
+PARALLEL_MIN_WORK = int(os.getenv("ANALYTICS_PARALLEL_MIN_WORK", "-1"))
+STREAM_CHUNK_ROWS = max(1, int(os.getenv("ANALYTICS_STREAM_CHUNK_ROWS", "2048")))
+APPEND_LOG = os.getenv("ANALYTICS_APPEND_LOG", os.path.join(BASE_DIR, "analytics.appends"))
+APPEND_MAX_RECORDS = int(os.getenv("ANALYTICS_APPEND_MAX_RECORDS", "100000"))
+DELTA_MAX_EVENTS = int(os.getenv("ANALYTICS_DELTA_MAX_EVENTS", "65536"))
+
 router = APIRouter(prefix="/item-analytics", tags=["item-analytics"])
 
-_CODES: List[str] = []
-_OFFSETS: np.ndarray | None = None
-_TIMES_FLAT: np.ndarray | None = None
-_STARTS_FLAT: np.ndarray | None = None
-_ENDS_FLAT: np.ndarray | None = None
-_SALES_ARR: np.ndarray | None = None
-_PRICE_ARR: np.ndarray | None = None
-_LOSSQ_ARR: np.ndarray | None = None
-_NAME_BY_CODE: Dict[str, str] = {}
-_GROUP_BY_CODE: Dict[str, str] = {}
+SourceStamp = Tuple[Tuple[int, int], ...]
+# rows (sorted), offsets, times, opening flag per row, end flags, prefix.
+EventDelta = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+# rows (sorted), offsets, times, running sales and spoilage totals.
+LedgerDelta = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+Records = List[Dict[str, Any]]
+
+
+@dataclass(frozen=True)
+class _Delta:
+    # What appends added on top of one base dataset. A row an append has
+    # touched keeps its whole merged history here, so the kernels read
+    # either its base or its delta segment, never both; rows of codes that
+    # first appeared in appends exist only here. Codes without positive
+    # sales yet wait as raw records in pending, like a rebuild skips them;
+    # a compaction moves them into the unsold table.
+    #
+    # Per-code values, new codes and new names or groups are an overlay on
+    # the dataset's arrays and tables too, so an append copies nothing the
+    # size of the dataset; _folded() applies it once per version for the
+    # requests that read it. Rows (sorted) with changed values, columns as
+    # in _VALUE_ARRAYS; rows past the dataset's codes are the new codes.
+    base_version: int
+    events: EventDelta
+    ledger: LedgerDelta
+    pending: Dict[str, Tuple[Records, Records]]
+    rows: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    values: np.ndarray = field(default_factory=lambda: np.empty((0, 5), dtype=np.float64))
+    codes: Tuple[str, ...] = ()
+    index: Dict[str, int] = field(default_factory=dict)
+    labels: Dict[str, Tuple[str, str]] = field(default_factory=dict)
+    resort: bool = False
+    # Appended batches and records so far; the records themselves are only
+    # in the append log.
+    batches: int = 0
+    records: int = 0
+    log_offset: int = 0
+    dropped: bool = False
+
+
+@dataclass(frozen=True)
+class _Unsold:
+    # Dump data of the codes a build leaves out for lack of positive sales.
+    # An append that makes one of them sell joins it with this history, as
+    # a rebuild from the dumps plus the appends would.
+    parts: UnsoldParts
+    index: Dict[str, int]
+
+
+class _CodeIndex(Mapping[str, int]):
+
+    # Row of each code of a snapshot or shared-memory dataset, looked up in
+    # its sorted codes with searchsorted, so workers share the lookup
+    # arrays instead of each building a dict. Codes added by appends after
+    # the snapshot go in a small dict on top.
+    def __init__(
+        self, keys: np.ndarray, rows: np.ndarray, codes: List[str], added: Dict[str, int] | None = None
+    ) -> None:
+        self._keys = keys
+        self._rows = rows
+        self._codes = codes
+        self._added = added or {}
+
+    def __getitem__(self, code: str) -> int:
+        if isinstance(code, str):
+            i = int(np.searchsorted(self._keys, code))
+            if i < self._keys.shape[0] and self._keys[i] == code:
+                return int(self._rows[i])
+        return self._added[code]
+
+    def __iter__(self) -> Iterator[str]:
+        return itertools.chain(self._codes, self._added)
+
+    def __len__(self) -> int:
+        return len(self._codes) + len(self._added)
+
+    def extended(self, added: Dict[str, int]) -> _CodeIndex:
+        return _CodeIndex(self._keys, self._rows, self._codes, {**self._added, **added})
+
+
+@dataclass(frozen=True)
+class _Dataset:
+    version: int
+    source: SourceStamp
+    codes: List[str]
+    epoch: float
+    offsets: np.ndarray
+    times_flat: np.ndarray
+    open_flags: np.ndarray
+    end_flags: np.ndarray
+    avail_prefix: np.ndarray
+    sales_arr: np.ndarray
+    price_arr: np.ndarray
+    lossq_arr: np.ndarray
+    abc_arr: np.ndarray
+    ledger_offsets: np.ndarray
+    ledger_times: np.ndarray
+    ledger_sales: np.ndarray
+    ledger_loss: np.ndarray
+    base_sales: np.ndarray
+    base_loss: np.ndarray
+    row_fragments: np.ndarray
+    row_frag_offsets: np.ndarray
+    group_ids: np.ndarray
+    group_rows: np.ndarray
+    group_offsets: np.ndarray
+    group_names: List[str]
+    name_by_code: Dict[str, str]
+    group_by_code: Dict[str, str]
+    index_by_code: Mapping[str, int]
+    generation: int = 0
+    # Append log offset up to which appends are folded into this base.
+    journal: int = 0
+    unsold: _Unsold | None = field(default=None, repr=False, compare=False)
+    delta: _Delta | None = field(default=None, repr=False, compare=False)
+    # Rows in ABC rank order once appends changed sales; None while memory
+    # order is rank order.
+    rank: np.ndarray | None = field(default=None, repr=False, compare=False)
+    handle: Any = field(default=None, repr=False, compare=False)
+
+
+# Bump whenever _Dataset gains or changes arrays so stale snapshot files are
+# rebuilt instead of opened.
+DATASET_LAYOUT = 7
+_SNAPSHOT_ARRAYS = (
+    "offsets", "times_flat", "open_flags", "end_flags", "avail_prefix",
+    "sales_arr", "price_arr", "lossq_arr", "abc_arr",
+    "ledger_offsets", "ledger_times", "ledger_sales", "ledger_loss", "base_sales", "base_loss",
+    "group_ids", "group_rows", "group_offsets",
+    "row_fragments", "row_frag_offsets",
+)
+# Arrays and tables of ingest.UnsoldParts, stored as unsold_<name>.
+_UNSOLD_ARRAYS = (
+    "ev_offsets", "ev_times", "ev_starts", "ev_ends", "led_offsets", "led_times", "led_sales", "led_loss",
+    "sales", "qty", "loss_qty",
+)
+_UNSOLD_TABLES = ("names", "sale_names", "groups")
+# Per-code values held in a delta's overlay, in column order.
+_VALUE_ARRAYS = ("sales_arr", "price_arr", "lossq_arr", "base_sales", "base_loss")
+
+# Requests read this reference once and keep using that snapshot; reloads
+# only ever replace the reference, never mutate a published snapshot.
+_DATASET: _Dataset | None = None
+_versions = itertools.count(1)
+_failed_source: SourceStamp | None = None
+
+# Keys are (start_ts, end_ts, version) for full lists, with the normalized
+# row selection appended for filtered requests.
+CacheKey = Tuple[Any, ...]
+
+_result_cache: LRUCache[CacheKey, bytes] = LRUCache(
+    maxsize=RESULT_CACHE_BYTES, getsizeof=len)
+_cache_hits = 0
+_cache_misses = 0
+
+# Below these sizes the prange fork/join costs more than the work itself and
+# the serial kernels are used. calibrate_kernels() measures them at startup
+# unless ANALYTICS_PARALLEL_MIN_WORK pins them.
+_metrics_parallel_min = PARALLEL_MIN_WORK if PARALLEL_MIN_WORK >= 0 else 1 << 14
+_abc_parallel_min = PARALLEL_MIN_WORK if PARALLEL_MIN_WORK >= 0 else 1 << 16
+
+_executor: ThreadPoolExecutor | None = None
+_executor_workers = 0
+
+# Set once precompile_kernels() has run every kernel in this process.
+_kernels_ready = False
+
+
+def cache_stats() -> Dict[str, int]:
+    return {
+        "hits": _cache_hits,
+        "misses": _cache_misses,
+        "entries": len(_result_cache),
+        "bytes": int(_result_cache.currsize),
+        "budget": int(_result_cache.maxsize),
+    }
+
+
+@telemetry.timed("cache")
+def _cache_get(key: CacheKey) -> bytes | None:
+    global _cache_hits, _cache_misses
+    body = _result_cache.get(key)
+    if body is None:
+        _cache_misses += 1
+    else:
+        _cache_hits += 1
+    return body
+
+
+def _cache_put(key: CacheKey, body: bytes) -> None:
+
+    # Every key carries the dataset version third. A body computed on a
+    # snapshot that was swapped out meanwhile could never be hit again.
+    ds = _DATASET
+    if ds is None or key[2] != ds.version:
+        return
+    try:
+        _result_cache[key] = body
+    except ValueError:
+        # Larger than the whole budget: serve it uncached.
+        pass
 
 
-def _parse_dt(val: str) -> datetime | None:
-    for fmt in ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y"):
-        try:
-            return datetime.strptime(val, fmt)
-        except Exception:
-            continue
-    return None
+@nb.njit(cache=True, parallel=True, fastmath=True)
+def _build_avail_prefix(times_flat: np.ndarray, end_flags: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # Same dtype as the times: int32 seconds for a compact dataset, where
+    # the available seconds of one code can never exceed the event span.
+    n_codes = offsets.shape[0] - 1
+    prefix = np.empty_like(times_flat)
 
+    for i in nb.prange(n_codes):
+        s = offsets[i]
+        e = offsets[i + 1]
+        acc = 0
+        for j in range(s, e):
+            prefix[j] = acc
+            if j + 1 < e and end_flags[j] > 0:
+                acc += times_flat[j + 1] - times_flat[j]
+    return prefix
+
+
+@nb.njit(cache=True, parallel=True)
+def _segment_cumsum(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    out = np.empty_like(values)
+    for i in nb.prange(offsets.shape[0] - 1):
+        acc = 0.0
+        for j in range(offsets[i], offsets[i + 1]):
+            acc += values[j]
+            out[j] = acc
+    return out
+
+
+@nb.njit(cache=True, inline="always")
+def _cum_before(times, cum, t: float) -> float:
+    # Running total of the entries strictly before t.
+    k = np.searchsorted(times, t, side="left")
+    return cum[k - 1] if k > 0 else 0.0
+
+
+@nb.njit(cache=True, inline="always")
+def _code_ledger(ledger_offsets, ledger_times, ledger_sales, ledger_loss, delta, i: int):
+    # Dated entries of row i, from the delta once an append touched it.
+    d_rows, d_offsets, d_times, d_sales, d_loss = delta
+    k = np.searchsorted(d_rows, i)
+    if k < d_rows.shape[0] and d_rows[k] == i:
+        s = d_offsets[k]
+        e = d_offsets[k + 1]
+        return d_times[s:e], d_sales[s:e], d_loss[s:e]
+    if i + 1 >= ledger_offsets.shape[0]:
+        return ledger_times[:0], ledger_sales[:0], ledger_loss[:0]
+    s = ledger_offsets[i]
+    e = ledger_offsets[i + 1]
+    return ledger_times[s:e], ledger_sales[s:e], ledger_loss[s:e]
+
+
+@nb.njit(cache=True, parallel=True, nogil=True)
+def _window_totals_numba(
+    ledger_offsets: np.ndarray,
+    ledger_times: np.ndarray,
+    ledger_sales: np.ndarray,
+    ledger_loss: np.ndarray,
+    ledger_delta: LedgerDelta,
+    base_sales: np.ndarray,
+    base_loss: np.ndarray,
+    start_ts: float,
+    end_ts: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Sales and spoilage quantity of every code within [start_ts, end_ts):
+    # two binary searches into its time-sorted running totals, plus the
+    # undated entries, which belong to every window.
+    n_codes = base_sales.shape[0]
+    sales = np.empty(n_codes, dtype=np.float64)
+    loss = np.empty(n_codes, dtype=np.float64)
 
-def _load_json_fast(path: str) -> Any:
-    if not os.path.exists(path):
-        return []
-    with open(path, "rb") as f:
-        return orjson.loads(f.read())
+    for i in nb.prange(n_codes):
+        times, sales_cum, loss_cum = _code_ledger(
+            ledger_offsets, ledger_times, ledger_sales, ledger_loss, ledger_delta, i)
+        sales[i] = base_sales[i] + (
+            _cum_before(times, sales_cum, end_ts) - _cum_before(times, sales_cum, start_ts))
+        loss[i] = base_loss[i] + (
+            _cum_before(times, loss_cum, end_ts) - _cum_before(times, loss_cum, start_ts))
+    return sales, loss
 
 
 @nb.njit(cache=True, fastmath=True, inline="always")
-def _compute_osa_one_code(times, starts, ends, start_ts: float, end_ts: float) -> float:
-    m = times.shape[0]
-    if m == 0:
-        return 0.0
+def _avail_seconds_until(times, opened, ends, prefix, t: float) -> float:
+    # Available seconds between times[0] and t; negative when t precedes the
+    # first event and the code was in stock before it.
+    if t <= times[0]:
+        return (t - times[0]) if opened > 0 else 0.0
+    k = np.searchsorted(times, t, side="right") - 1
+    acc = prefix[k] + 0.0
+    if ends[k] > 0:
+        acc += t - times[k]
+    return acc
 
-    avail_hours = 0.0
-
-    it_start = start_ts
-    it_end = times[0]
-    if it_end > end_ts:
-        it_end = end_ts
-    if it_end > it_start and starts[0] > 0.0:
-        avail_hours += (it_end - it_start) / 3600.0
-
-    for j in range(1, m):
-        s = times[j - 1]
-        e = times[j]
-        if s < start_ts:
-            s = start_ts
-        if e > end_ts:
-            e = end_ts
-        if e > s and ends[j - 1] > 0.0:
-            avail_hours += (e - s) / 3600.0
-        if times[j] >= end_ts:
-            break
 
-    it_start = times[m - 1]
-    it_end = end_ts
-    if it_end > it_start and ends[m - 1] > 0.0:
-        avail_hours += (it_end - it_start) / 3600.0
+@nb.njit(cache=True, fastmath=True, inline="always")
+def _avail_seconds_at(times, opened, ends, prefix, bounds, out) -> None:
+    # _avail_seconds_until for every edge of an ascending bounds array in one
+    # forward sweep over the events.
+    n = times.shape[0]
+    k = 0
+    for b in range(bounds.shape[0]):
+        t = bounds[b]
+        if t <= times[0]:
+            out[b] = (t - times[0]) if opened > 0 else 0.0
+            continue
+        while k + 1 < n and times[k + 1] <= t:
+            k += 1
+        acc = prefix[k] + 0.0
+        if ends[k] > 0:
+            acc += t - times[k]
+        out[b] = acc
+
+
+@nb.njit(cache=True, inline="always")
+def _code_events(times_flat, open_flags, end_flags, prefix_flat, offsets, delta, i: int):
+    # Events of row i: its delta segment once an append touched it, else
+    # its base segment; rows added by appends have no base segment.
+    d_rows, d_offsets, d_times, d_open, d_ends, d_prefix = delta
+    k = np.searchsorted(d_rows, i)
+    if k < d_rows.shape[0] and d_rows[k] == i:
+        s = d_offsets[k]
+        e = d_offsets[k + 1]
+        return d_times[s:e], d_open[k], d_ends[s:e], d_prefix[s:e]
+    if i + 1 >= offsets.shape[0]:
+        return times_flat[:0], np.uint8(0), end_flags[:0], prefix_flat[:0]
+    s = offsets[i]
+    e = offsets[i + 1]
+    return times_flat[s:e], open_flags[i], end_flags[s:e], prefix_flat[s:e]
+
 
-    total_hours = (end_ts - start_ts) / 3600.0
-    if total_hours <= 0.0:
+@nb.njit(cache=True, fastmath=True, inline="always")
+def _compute_osa_one_code(times, opened, ends, prefix, start_ts: float, end_ts: float) -> float:
+    if times.shape[0] == 0:
         return 0.0
-    return 100.0 * (avail_hours / total_hours)
 
+    total = end_ts - start_ts
+    if total <= 0.0:
+        return 0.0
 
-@nb.njit(cache=True, parallel=True, fastmath=True)
+    avail = (
+        _avail_seconds_until(times, opened, ends, prefix, end_ts) -
+        _avail_seconds_until(times, opened, ends, prefix, start_ts)
+    )
+    return 100.0 * (avail / total)
+
+
+@nb.njit(cache=True, fastmath=True, inline="always")
+def _metrics_row(
+    times_flat, open_flags, end_flags, prefix_flat, offsets, delta, i: int,
+    start_ts: float, end_ts: float, sales_arr, price_arr, loss_qty_arr,
+) -> Tuple[float, float, float]:
+    times, opened, ends, prefix = _code_events(
+        times_flat, open_flags, end_flags, prefix_flat, offsets, delta, i)
+    osa = _compute_osa_one_code(times, opened, ends, prefix, start_ts, end_ts)
+
+    amt = loss_qty_arr[i] * price_arr[i]
+    total = sales_arr[i]
+    return osa, amt, (amt / total) * 100.0 if total > 0.0 else 0.0
+
+
+@nb.njit(cache=True, parallel=True, fastmath=True, nogil=True)
 def _compute_metrics_numba_csr(
     times_flat: np.ndarray,
-    starts_flat: np.ndarray,
-    ends_flat: np.ndarray,
+    open_flags: np.ndarray,
+    end_flags: np.ndarray,
+    prefix_flat: np.ndarray,
     offsets: np.ndarray,
+    delta: EventDelta,
     start_ts: float,
     end_ts: float,
     sales_arr: np.ndarray,
@@ -104,27 +433,184 @@ def _compute_metrics_numba_csr(
     loss_percents = np.empty(n_codes, dtype=np.float64)
 
     for i in nb.prange(n_codes):
-        s = offsets[i]
-        e = offsets[i + 1]
-        if e > s:
-            osa = _compute_osa_one_code(
-                times_flat[s:e], starts_flat[s:e], ends_flat[s:e],
-                start_ts, end_ts
-            )
-        else:
-            osa = 0.0
+        osa_res[i], loss_amounts[i], loss_percents[i] = _metrics_row(
+            times_flat, open_flags, end_flags, prefix_flat, offsets, delta, i,
+            start_ts, end_ts, sales_arr, price_arr, loss_qty_arr
+        )
+    return osa_res, loss_amounts, loss_percents
 
-        osa_res[i] = osa
+
+@nb.njit(cache=True, fastmath=True, nogil=True)
+def _compute_metrics_serial_csr(
+    times_flat: np.ndarray,
+    open_flags: np.ndarray,
+    end_flags: np.ndarray,
+    prefix_flat: np.ndarray,
+    offsets: np.ndarray,
+    delta: EventDelta,
+    start_ts: float,
+    end_ts: float,
+    sales_arr: np.ndarray,
+    price_arr: np.ndarray,
+    loss_qty_arr: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n_codes = sales_arr.shape[0]
+    osa_res = np.empty(n_codes, dtype=np.float64)
+    loss_amounts = np.empty(n_codes, dtype=np.float64)
+    loss_percents = np.empty(n_codes, dtype=np.float64)
+
+    for i in range(n_codes):
+        osa_res[i], loss_amounts[i], loss_percents[i] = _metrics_row(
+            times_flat, open_flags, end_flags, prefix_flat, offsets, delta, i,
+            start_ts, end_ts, sales_arr, price_arr, loss_qty_arr
+        )
+    return osa_res, loss_amounts, loss_percents
+
+
+@nb.njit(cache=True, parallel=True, fastmath=True, nogil=True)
+def _compute_metrics_numba_rows(
+    times_flat: np.ndarray,
+    open_flags: np.ndarray,
+    end_flags: np.ndarray,
+    prefix_flat: np.ndarray,
+    offsets: np.ndarray,
+    delta: EventDelta,
+    rows: np.ndarray,
+    start_ts: float,
+    end_ts: float,
+    sales_arr: np.ndarray,
+    price_arr: np.ndarray,
+    loss_qty_arr: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Same as _compute_metrics_numba_csr, restricted to the given rows; only
+    # their events are touched.
+    n = rows.shape[0]
+    osa_res = np.empty(n, dtype=np.float64)
+    loss_amounts = np.empty(n, dtype=np.float64)
+    loss_percents = np.empty(n, dtype=np.float64)
+
+    for j in nb.prange(n):
+        osa_res[j], loss_amounts[j], loss_percents[j] = _metrics_row(
+            times_flat, open_flags, end_flags, prefix_flat, offsets, delta, rows[j],
+            start_ts, end_ts, sales_arr, price_arr, loss_qty_arr
+        )
+    return osa_res, loss_amounts, loss_percents
+
+
+@nb.njit(cache=True, fastmath=True, nogil=True)
+def _compute_metrics_serial_rows(
+    times_flat: np.ndarray,
+    open_flags: np.ndarray,
+    end_flags: np.ndarray,
+    prefix_flat: np.ndarray,
+    offsets: np.ndarray,
+    delta: EventDelta,
+    rows: np.ndarray,
+    start_ts: float,
+    end_ts: float,
+    sales_arr: np.ndarray,
+    price_arr: np.ndarray,
+    loss_qty_arr: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n = rows.shape[0]
+    osa_res = np.empty(n, dtype=np.float64)
+    loss_amounts = np.empty(n, dtype=np.float64)
+    loss_percents = np.empty(n, dtype=np.float64)
+
+    for j in range(n):
+        osa_res[j], loss_amounts[j], loss_percents[j] = _metrics_row(
+            times_flat, open_flags, end_flags, prefix_flat, offsets, delta, rows[j],
+            start_ts, end_ts, sales_arr, price_arr, loss_qty_arr
+        )
+    return osa_res, loss_amounts, loss_percents
+
+
+@nb.njit(cache=True, parallel=True, fastmath=True, nogil=True)
+def _compute_metrics_numba_ranges(
+    times_flat: np.ndarray,
+    open_flags: np.ndarray,
+    end_flags: np.ndarray,
+    prefix_flat: np.ndarray,
+    offsets: np.ndarray,
+    delta: EventDelta,
+    bounds: np.ndarray,
+    range_lo: np.ndarray,
+    range_hi: np.ndarray,
+    sales_arr: np.ndarray,
+    price_arr: np.ndarray,
+    loss_qty_arr: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # bounds holds the sorted distinct range edges; range r spans
+    # bounds[range_lo[r]]..bounds[range_hi[r]]. Each code sweeps its events
+    # and the edges together once, so the cost per code is events + edges
+    # however many ranges overlap.
+    n_codes = sales_arr.shape[0]
+    n_bounds = bounds.shape[0]
+    n_ranges = range_lo.shape[0]
+    osa_res = np.zeros((n_ranges, n_codes), dtype=np.float64)
+    loss_amounts = np.empty(n_codes, dtype=np.float64)
+    loss_percents = np.empty(n_codes, dtype=np.float64)
+
+    for i in nb.prange(n_codes):
+        times, opened, ends, prefix = _code_events(
+            times_flat, open_flags, end_flags, prefix_flat, offsets, delta, i)
+        if times.shape[0] > 0:
+            until = np.empty(n_bounds, dtype=np.float64)
+            _avail_seconds_at(times, opened, ends, prefix, bounds, until)
+            for r in range(n_ranges):
+                total = bounds[range_hi[r]] - bounds[range_lo[r]]
+                if total > 0.0:
+                    osa_res[r, i] = 100.0 * ((until[range_hi[r]] - until[range_lo[r]]) / total)
 
         amt = loss_qty_arr[i] * price_arr[i]
         loss_amounts[i] = amt
-        total = sales_arr[i]
-        loss_percents[i] = (amt / total) * 100.0 if total > 0.0 else 0.0
+        total_sales = sales_arr[i]
+        loss_percents[i] = (amt / total_sales) * 100.0 if total_sales > 0.0 else 0.0
 
     return osa_res, loss_amounts, loss_percents
 
 
-@nb.njit(cache=True, parallel=True, fastmath=True)
+@nb.njit(cache=True, parallel=True, fastmath=True, nogil=True)
+def _compute_osa_buckets_numba(
+    times_flat: np.ndarray,
+    open_flags: np.ndarray,
+    end_flags: np.ndarray,
+    prefix_flat: np.ndarray,
+    offsets: np.ndarray,
+    delta: EventDelta,
+    rows: np.ndarray,
+    edges: np.ndarray,
+) -> np.ndarray:
+    # Row j of the result is the OSA series of code rows[j] over the buckets
+    # edges[b]..edges[b + 1].
+    n = rows.shape[0]
+    n_buckets = edges.shape[0] - 1
+    osa = np.zeros((n, n_buckets), dtype=np.float64)
+
+    for j in nb.prange(n):
+        times, opened, ends, prefix = _code_events(
+            times_flat, open_flags, end_flags, prefix_flat, offsets, delta, rows[j])
+        if times.shape[0] > 0:
+            until = np.empty(edges.shape[0], dtype=np.float64)
+            _avail_seconds_at(times, opened, ends, prefix, edges, until)
+            for b in range(n_buckets):
+                width = edges[b + 1] - edges[b]
+                if width > 0.0:
+                    osa[j, b] = 100.0 * ((until[b + 1] - until[b]) / width)
+    return osa
+
+
+@nb.njit(cache=True, fastmath=True, inline="always")
+def _abc_class(cumulative: float, total: float) -> int:
+    share = (cumulative / total * 100.0) if total > 0.0 else 0.0
+    if share <= 80.0:
+        return 65
+    if share <= 95.0:
+        return 66
+    return 67
+
+
+@nb.njit(cache=True, parallel=True, fastmath=True, nogil=True)
 def _assign_abc_numba(sales: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     order = np.argsort(sales)[::-1]
     sorted_sales = sales[order]
@@ -133,210 +619,427 @@ def _assign_abc_numba(sales: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     abc = np.empty(sales.shape[0], dtype=np.uint8)
 
     for i in nb.prange(sorted_sales.shape[0]):
-        share = (cumulative[i] / total * 100.0) if total > 0.0 else 0.0
-        if share <= 80.0:
-            abc[i] = 65
-        elif share <= 95.0:
-            abc[i] = 66
-        else:
-            abc[i] = 67
+        abc[i] = _abc_class(cumulative[i], total)
+    return order, abc
+
+
+@nb.njit(cache=True, fastmath=True, nogil=True)
+def _assign_abc_serial(sales: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(sales)[::-1]
+    sorted_sales = sales[order]
+    cumulative = np.cumsum(sorted_sales)
+    total = cumulative[-1] if sorted_sales.size > 0 else 0.0
+    abc = np.empty(sales.shape[0], dtype=np.uint8)
+
+    for i in range(sorted_sales.shape[0]):
+        abc[i] = _abc_class(cumulative[i], total)
     return order, abc
 
 
+@nb.njit(cache=True, parallel=True, fastmath=True, nogil=True)
+def _rollup_groups_numba(
+    group_rows: np.ndarray,
+    group_offsets: np.ndarray,
+    osa_res: np.ndarray,
+    loss_amounts: np.ndarray,
+    sales_arr: np.ndarray,
+    abc_codes: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # group_rows lists the rows of each group contiguously, so every group is
+    # one segment. OSA is weighted by sales; groups without sales fall back
+    # to the plain mean.
+    n_groups = group_offsets.shape[0] - 1
+    sales = np.zeros(n_groups, dtype=np.float64)
+    loss = np.zeros(n_groups, dtype=np.float64)
+    osa = np.zeros(n_groups, dtype=np.float64)
+    abc_counts = np.zeros((n_groups, 3), dtype=np.int64)
+
+    for g in nb.prange(n_groups):
+        s = group_offsets[g]
+        e = group_offsets[g + 1]
+        sales_sum = 0.0
+        loss_sum = 0.0
+        weighted = 0.0
+        plain = 0.0
+        for j in range(s, e):
+            i = group_rows[j]
+            sales_sum += sales_arr[i]
+            loss_sum += loss_amounts[i]
+            weighted += osa_res[i] * sales_arr[i]
+            plain += osa_res[i]
+            abc_counts[g, abc_codes[i] - 65] += 1
+        sales[g] = sales_sum
+        loss[g] = loss_sum
+        if sales_sum > 0.0:
+            osa[g] = weighted / sales_sum
+        elif e > s:
+            osa[g] = plain / (e - s)
+    return sales, loss, osa, abc_counts
+
+
+@telemetry.timed("abc")
 def assign_abc(sales: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
 
-    return _assign_abc_numba(sales)
+    parallel = sales.shape[0] >= _abc_parallel_min
+    telemetry.note_kernel("abc", parallel)
+    return _assign_abc_numba(sales) if parallel else _assign_abc_serial(sales)
 
 
-def _prepare_csr_on_start(stock_data: List[Dict[str, Any]], sales_data: List[Dict[str, Any]]) -> None:
-    global _CODES, _OFFSETS, _TIMES_FLAT, _STARTS_FLAT, _ENDS_FLAT
-    global _SALES_ARR, _PRICE_ARR, _LOSSQ_ARR, _NAME_BY_CODE, _GROUP_BY_CODE
-
-    events_by_code: Dict[str,
-                         List[Tuple[datetime, float, float]]] = defaultdict(list)
-    loss_qty: Dict[str, float] = defaultdict(float)
-    name_by_code: Dict[str, str] = {}
-    group_by_code: Dict[str, str] = {}
-
-    for item in stock_data:
-        code = str(item.get("НоменклатураКод", "")).strip()
-        if not code:
-            continue
+def _event_delta(ds: _Dataset) -> EventDelta:
+    return _NO_EVENTS if ds.delta is None else ds.delta.events
 
-        name_by_code[code] = item.get("Номенклатура")
-        group_by_code[code] = item.get("Родитель") or "Без группы 🤔"
-
-        dt = _parse_dt(str(item.get("Период", "")))
-        if dt is not None:
-            start_val = float(item.get("НачальныйОстаток", 0) or 0.0)
-            end_val = float(item.get("КонечныйОстаток", 0) or 0.0)
-            events_by_code[code].append((dt, start_val, end_val))
-
-        if item.get("СтатьяРасходов") == "Порча на складах (94)":
-            sv = float(item.get("НачальныйОстаток", 0) or 0.0)
-            ev = float(item.get("КонечныйОстаток", 0) or 0.0)
-            diff = sv - ev
-            if diff > 0.0:
-                loss_qty[code] += diff
-
-    sales_sum: Dict[str, float] = defaultdict(float)
-    sales_qty: Dict[str, float] = defaultdict(float)
-    name_sales: Dict[str, str] = {}
-
-    for rec in sales_data:
-        code = str(rec.get("Код", "")).strip()
-        if not code:
-            continue
-        name_sales[code] = rec.get("Номенклатура")
-        sales_sum[code] += float(rec.get("Сумма", 0) or 0.0)
-        sales_qty[code] += float(rec.get("Количество", 0) or 0.0)
-
-    price_by_code: Dict[str, float] = {}
-    for code, qty in sales_qty.items():
-        price_by_code[code] = (sales_sum[code] / qty) if qty > 0.0 else 0.0
-
-    codes: List[str] = []
-    code_lengths: List[int] = []
-    for code, total_sum in sales_sum.items():
-        if total_sum > 0.0:
-            codes.append(code)
-            evs = events_by_code.get(code)
-            code_lengths.append(0 if not evs else len(evs))
-
-    n_codes = len(codes)
-    total_events = int(
-        np.sum(np.array(code_lengths, dtype=np.int64))) if n_codes > 0 else 0
-
-    times_flat = np.empty(total_events, dtype=np.float64)
-    starts_flat = np.empty(total_events, dtype=np.float64)
-    ends_flat = np.empty(total_events, dtype=np.float64)
-    offsets = np.empty(n_codes + 1, dtype=np.int64)
-
-    sales_arr = np.empty(n_codes, dtype=np.float64)
-    price_arr = np.empty(n_codes, dtype=np.float64)
-    loss_arr = np.empty(n_codes, dtype=np.float64)
-
-    cur = 0
-    for i, code in enumerate(codes):
-        offsets[i] = cur
-        evs = events_by_code.get(code, [])
-        if evs:
-            evs.sort(key=lambda x: x[0])
-            m = len(evs)
-            for j in range(m):
-                dt, sv, ev = evs[j]
-                times_flat[cur + j] = dt.timestamp()
-                starts_flat[cur + j] = float(sv)
-                ends_flat[cur + j] = float(ev)
-            cur += m
-
-        sales_arr[i] = sales_sum.get(code, 0.0)
-        price_arr[i] = price_by_code.get(code, 0.0)
-        loss_arr[i] = loss_qty.get(code, 0.0)
-
-        nm = name_sales.get(code) or name_by_code.get(code) or code
-        name_by_code[code] = nm
-        if code not in group_by_code:
-            group_by_code[code] = "Без группы 🤔"
-
-    offsets[n_codes] = cur
-
-    _CODES = codes
-    _OFFSETS = offsets
-    _TIMES_FLAT = times_flat
-    _STARTS_FLAT = starts_flat
-    _ENDS_FLAT = ends_flat
-    _SALES_ARR = sales_arr
-    _PRICE_ARR = price_arr
-    _LOSSQ_ARR = loss_arr
-    _NAME_BY_CODE = name_by_code
-    _GROUP_BY_CODE = group_by_code
-
-
-def warmup_numba() -> None:
-
-    stock_data = _load_json_fast(STOCK_DUMP)
-    sales_data = _load_json_fast(SALES_DUMP)
-    if not isinstance(stock_data, list):
-        stock_data = []
-    if not isinstance(sales_data, list):
-        sales_data = []
-
-    _prepare_csr_on_start(stock_data, sales_data)
-
-    if (
-        _OFFSETS is not None and _TIMES_FLAT is not None and
-        _STARTS_FLAT is not None and _ENDS_FLAT is not None and
-        _SALES_ARR is not None and _PRICE_ARR is not None and _LOSSQ_ARR is not None
-    ):
-        start_ts = 1_700_000_000.0
-        end_ts = start_ts + 3600.0
-        _compute_metrics_numba_csr(
-            _TIMES_FLAT, _STARTS_FLAT, _ENDS_FLAT, _OFFSETS,
-            start_ts, end_ts, _SALES_ARR, _PRICE_ARR, _LOSSQ_ARR
-        )
 
+def _ledger_delta(ds: _Dataset) -> LedgerDelta:
+    return _NO_LEDGER if ds.delta is None else ds.delta.ledger
 
-@router.post("/")
-async def item_analytics(request: Request) -> ORJSONResponse:
 
-    raw = await request.body()
-    try:
-        payload = orjson.loads(raw)
-    except Exception:
-        return ORJSONResponse({"error": "invalid json"}, status_code=400)
+@telemetry.timed("metrics")
+def _metrics_all(ds: _Dataset, start_ts: float, end_ts: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
 
-    token = str(payload.get("token", ""))
-    user_id = get_user_id_from_file(token)
-    if user_id != 1:
-        return ORJSONResponse({"error": "InvalidId"}, status_code=403)
+    parallel = ds.times_flat.shape[0] + len(ds.codes) >= _metrics_parallel_min
+    telemetry.note_kernel("metrics", parallel)
+    kernel = _compute_metrics_numba_csr if parallel else _compute_metrics_serial_csr
+    return kernel(
+        ds.times_flat, ds.open_flags, ds.end_flags, ds.avail_prefix, ds.offsets, _event_delta(ds),
+        start_ts - ds.epoch, end_ts - ds.epoch, ds.sales_arr, ds.price_arr, ds.lossq_arr
+    )
 
-    start_s = str(payload.get("StartDate", ""))
-    finish_s = str(payload.get("FinishDate", ""))
 
-    def _parse_or_400(s: str) -> datetime | None:
-        for fmt in ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y"):
-            try:
-                return datetime.strptime(s, fmt)
-            except Exception:
-                continue
-        return None
+@telemetry.timed("metrics")
+def _metrics_rows(
+    ds: _Dataset,
+    rows: np.ndarray,
+    start_ts: float,
+    end_ts: float,
+    sales_arr: np.ndarray | None = None,
+    lossq_arr: np.ndarray | None = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
 
-    start_dt = _parse_or_400(start_s)
-    finish_dt = _parse_or_400(finish_s)
-    if start_dt is None or finish_dt is None:
-        return ORJSONResponse({"error": "invalid dates"}, status_code=400)
+    per_code = ds.times_flat.shape[0] // max(len(ds.codes), 1)
+    parallel = rows.shape[0] * (per_code + 1) >= _metrics_parallel_min
+    telemetry.note_kernel("metrics", parallel)
+    kernel = _compute_metrics_numba_rows if parallel else _compute_metrics_serial_rows
+    return kernel(
+        ds.times_flat, ds.open_flags, ds.end_flags, ds.avail_prefix, ds.offsets, _event_delta(ds),
+        rows, start_ts - ds.epoch, end_ts - ds.epoch,
+        ds.sales_arr if sales_arr is None else sales_arr, ds.price_arr,
+        ds.lossq_arr if lossq_arr is None else lossq_arr,
+    )
 
-    end_dt = finish_dt + timedelta(days=1)
-    start_ts = float(start_dt.timestamp())
-    end_ts = float(end_dt.timestamp())
-
-    codes = _CODES
-    offsets = _OFFSETS
-    times_flat = _TIMES_FLAT
-    starts_flat = _STARTS_FLAT
-    ends_flat = _ENDS_FLAT
-    sales_arr = _SALES_ARR
-    price_arr = _PRICE_ARR
-    lossq_arr = _LOSSQ_ARR
-    name_by_code = _NAME_BY_CODE
-    group_by_code = _GROUP_BY_CODE
-
-    if offsets is None or times_flat is None or starts_flat is None or ends_flat is None:
-        return ORJSONResponse({"error": "data not loaded"}, status_code=500)
 
-    osa_res, loss_amounts, loss_percents = _compute_metrics_numba_csr(
-        times_flat, starts_flat, ends_flat, offsets,
-        start_ts, end_ts, sales_arr, price_arr, lossq_arr
+@telemetry.timed("totals")
+def _window_totals(ds: _Dataset, start_ts: float, end_ts: float) -> Tuple[np.ndarray, np.ndarray]:
+
+    return _window_totals_numba(
+        ds.ledger_offsets, ds.ledger_times, ds.ledger_sales, ds.ledger_loss, _ledger_delta(ds),
+        ds.base_sales, ds.base_loss, start_ts - ds.epoch, end_ts - ds.epoch
+    )
+
+
+def _best_time(fn: Callable[[], Any], repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _crossover(run: Callable[[int, bool], Any], sizes: List[int]) -> int:
+    # Smallest size from which the parallel variant keeps winning.
+    threshold = sizes[-1] * 2
+    for size in reversed(sizes):
+        if _best_time(lambda: run(size, True)) >= _best_time(lambda: run(size, False)):
+            break
+        threshold = size
+    return threshold
+
+
+def calibrate_kernels() -> Dict[str, int]:
+    global _metrics_parallel_min, _abc_parallel_min
+
+    if PARALLEL_MIN_WORK >= 0:
+        _metrics_parallel_min = _abc_parallel_min = PARALLEL_MIN_WORK
+        return {"metrics": _metrics_parallel_min, "abc": _abc_parallel_min}
+
+    if nb.get_num_threads() <= 1:
+        _metrics_parallel_min = _abc_parallel_min = 1 << 62
+        return {"metrics": _metrics_parallel_min, "abc": _abc_parallel_min}
+
+    rng = np.random.default_rng(0)
+    sizes = [1 << k for k in range(8, 19, 2)]
+    per_code = 8
+    n_max = sizes[-1] // (per_code + 1)
+    offsets = np.arange(0, n_max * per_code + 1, per_code, dtype=np.int64)
+    times = np.tile(3600 * np.arange(per_code, dtype=np.int32), n_max)
+    stock = (rng.random(times.shape[0]) < 0.7).astype(np.uint8)
+    prefix = _build_avail_prefix(times, stock, offsets)
+    values = rng.random(sizes[-1]) * 100.0
+    # Read-only like a dataset's arrays (ABC only ever gets fresh ones), so
+    # these calls hit the signatures precompile_kernels() put in the cache.
+    for arr in (offsets, times, stock, prefix):
+        _frozen(arr)
+    frozen_values = _frozen(values.copy())
+
+    def metrics(size: int, parallel: bool) -> Any:
+        n = size // (per_code + 1)
+        m = n * per_code
+        kernel = _compute_metrics_numba_csr if parallel else _compute_metrics_serial_csr
+        return kernel(
+            times[:m], stock[:n], stock[:m], prefix[:m], offsets[:n + 1], _NO_EVENTS,
+            3600.0, 18_000.0, frozen_values[:n], frozen_values[:n], frozen_values[:n]
+        )
+
+    def abc(size: int, parallel: bool) -> Any:
+        return (_assign_abc_numba if parallel else _assign_abc_serial)(values[:size])
+
+    _metrics_parallel_min = _crossover(metrics, sizes)
+    _abc_parallel_min = _crossover(abc, sizes)
+    return {"metrics": _metrics_parallel_min, "abc": _abc_parallel_min}
+
+
+def _compute_executor() -> ThreadPoolExecutor:
+    global _executor, _executor_workers
+
+    if _executor is None:
+        workers = COMPUTE_CONCURRENCY
+        try:
+            if nb.threading_layer() == "workqueue":
+                # The workqueue layer must not be entered from two threads.
+                workers = 1
+        except ValueError:
+            pass
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analytics-compute")
+        _executor_workers = workers
+    return _executor
+
+
+async def _offload(fn: Callable[..., Any], *args: Any) -> Any:
+    # The kernels release the GIL, so the event loop keeps serving other
+    # requests while at most COMPUTE_CONCURRENCY computations run.
+    if COMPUTE_CONCURRENCY <= 0:
+        return fn(*args)
+    # The copied context carries the request's telemetry trace into the
+    # pool thread; "queue" is the wait for a free compute slot.
+    queued = time.perf_counter()
+
+    def run() -> Any:
+        telemetry.note("queue", time.perf_counter() - queued)
+        return fn(*args)
+
+    return await asyncio.get_running_loop().run_in_executor(
+        _compute_executor(), contextvars.copy_context().run, run)
+
+
+def shutdown_compute() -> None:
+    global _executor, _executor_workers
+
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+        _executor_workers = 0
+
+
+def _telemetry_gauges() -> Dict[str, float]:
+    ds = _DATASET
+    return {
+        "cache_hits": _cache_hits,
+        "cache_misses": _cache_misses,
+        "dataset_codes": _row_count(ds) if ds is not None else 0,
+        "dataset_events": ds.times_flat.shape[0] if ds is not None else 0,
+        "dataset_generation": ds.generation if ds is not None else 0,
+        "delta_events": _delta_size(ds.delta) if ds is not None else 0,
+        "numba_threads": nb.get_num_threads(),
+        "compute_workers": _executor_workers,
+    }
+
+
+telemetry.set_gauge_source(_telemetry_gauges)
+
+
+_LBL_LOSS = np.frombuffer(b',"Loss":', dtype=np.uint8).copy()
+_LBL_LOP = np.frombuffer(b',"LossOfProfit":', dtype=np.uint8).copy()
+_LBL_OSA = np.frombuffer(b',"OSA":', dtype=np.uint8).copy()
+_LBL_ABC = np.frombuffer(b',"ABC":"', dtype=np.uint8).copy()
+_ROW_TAIL = np.frombuffer(b'"}', dtype=np.uint8).copy()
+
+# Beyond this the scaled integers stop being exact and orjson would switch
+# to exponent notation, so such rows go through the dict path instead.
+_FAST_FORMAT_LIMIT = 1e12
+
+
+def _build_row_fragments(
+    codes: List[str], name_by_code: Dict[str, str], group_by_code: Dict[str, str]
+) -> Tuple[np.ndarray, np.ndarray]:
+
+    dumps = orjson.dumps
+    parts = [
+        b'{"Name":' + dumps(name_by_code.get(code, code)) +
+        b',"Code":' + dumps(code) +
+        b',"Group":' + dumps(group_by_code.get(code, "Без группы")) +
+        b',"Sales":'
+        for code in codes
+    ]
+    frag_offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+    if parts:
+        frag_offsets[1:] = np.cumsum(
+            np.fromiter(map(len, parts), dtype=np.int64, count=len(parts)))
+    fragments = np.frombuffer(b"".join(parts), dtype=np.uint8)
+    return fragments, frag_offsets
+
+
+@nb.njit(cache=True, inline="always")
+def _fixed_len(q: int, decimals: int) -> int:
+    a = -q if q < 0 else q
+    scale = 10 ** decimals
+    ip = a // scale
+    frac = a % scale
+    n = 2 if q < 0 else 1
+    while ip >= 10:
+        ip //= 10
+        n += 1
+    if frac == 0:
+        return n + 2
+    d = decimals
+    while frac % 10 == 0:
+        frac //= 10
+        d -= 1
+    return n + 1 + d
+
+
+@nb.njit(cache=True, inline="always")
+def _write_fixed(buf, pos: int, q: int, decimals: int) -> int:
+    a = -q if q < 0 else q
+    scale = 10 ** decimals
+    ip = a // scale
+    frac = a % scale
+    if q < 0:
+        buf[pos] = 45
+        pos += 1
+
+    width = 1
+    t = ip
+    while t >= 10:
+        t //= 10
+        width += 1
+    for k in range(width - 1, -1, -1):
+        buf[pos + k] = 48 + ip % 10
+        ip //= 10
+    pos += width
+
+    buf[pos] = 46
+    pos += 1
+    if frac == 0:
+        buf[pos] = 48
+        return pos + 1
+    d = decimals
+    while frac % 10 == 0:
+        frac //= 10
+        d -= 1
+    for k in range(d - 1, -1, -1):
+        buf[pos + k] = 48 + frac % 10
+        frac //= 10
+    return pos + d
+
+
+@nb.njit(cache=True, inline="always")
+def _write_bytes(buf, pos: int, src) -> int:
+    for k in range(src.shape[0]):
+        buf[pos + k] = src[k]
+    return pos + src.shape[0]
+
+
+@nb.njit(cache=True, parallel=True, nogil=True)
+def _format_rows_numba(
+    fragments: np.ndarray,
+    frag_offsets: np.ndarray,
+    abc_codes: np.ndarray,
+    q_sales: np.ndarray,
+    q_loss: np.ndarray,
+    q_lop: np.ndarray,
+    q_osa: np.ndarray,
+) -> np.ndarray:
+    n = abc_codes.shape[0]
+    fixed = (
+        _LBL_LOSS.shape[0] + _LBL_LOP.shape[0] + _LBL_OSA.shape[0] +
+        _LBL_ABC.shape[0] + 1 + _ROW_TAIL.shape[0]
     )
 
-    order, abc_codes = _assign_abc_numba(sales_arr)
+    row_len = np.empty(n, dtype=np.int64)
+    for i in nb.prange(n):
+        row_len[i] = (
+            frag_offsets[i + 1] - frag_offsets[i] + fixed +
+            _fixed_len(q_sales[i], 2) + _fixed_len(q_loss[i], 2) +
+            _fixed_len(q_lop[i], 3) + _fixed_len(q_osa[i], 2)
+        )
+
+    row_pos = np.empty(n + 1, dtype=np.int64)
+    row_pos[0] = 1
+    for r in range(n):
+        row_pos[r + 1] = row_pos[r] + row_len[r] + 1
+
+    total = row_pos[n] + 1 if n == 0 else row_pos[n]
+    out = np.empty(total, dtype=np.uint8)
+    out[0] = 91
+    out[total - 1] = 93
+
+    for i in nb.prange(n):
+        pos = row_pos[i]
+        pos = _write_bytes(out, pos, fragments[frag_offsets[i]:frag_offsets[i + 1]])
+        pos = _write_fixed(out, pos, q_sales[i], 2)
+        pos = _write_bytes(out, pos, _LBL_LOSS)
+        pos = _write_fixed(out, pos, q_loss[i], 2)
+        pos = _write_bytes(out, pos, _LBL_LOP)
+        pos = _write_fixed(out, pos, q_lop[i], 3)
+        pos = _write_bytes(out, pos, _LBL_OSA)
+        pos = _write_fixed(out, pos, q_osa[i], 2)
+        pos = _write_bytes(out, pos, _LBL_ABC)
+        out[pos] = abc_codes[i]
+        pos = _write_bytes(out, pos + 1, _ROW_TAIL)
+        if i + 1 < n:
+            out[pos] = 44
+    return out
+
+
+def _scaled(values: np.ndarray, decimals: int) -> np.ndarray | None:
+    if not np.all(np.abs(values) < _FAST_FORMAT_LIMIT):
+        return None
+    scaled = values * (10.0 ** decimals)
+    q = np.rint(scaled)
+    # The multiplication may land next to a .5 tie that the exact decimal
+    # value does not sit on; settle those few with Python's round().
+    near_tie = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) <= 4.0 * np.spacing(np.abs(scaled))
+    for i in np.flatnonzero(near_tie):
+        q[i] = round(round(float(values[i]), decimals) * 10.0 ** decimals)
+    return q.astype(np.int64)
+
+
+@telemetry.timed("format")
+def _rows_json(
+    abc_codes: np.ndarray,
+    sales_arr: np.ndarray,
+    loss_amounts: np.ndarray,
+    loss_percents: np.ndarray,
+    osa_res: np.ndarray,
+    fragments: np.ndarray,
+    frag_offsets: np.ndarray,
+    codes: List[str],
+    name_by_code: Dict[str, str],
+    group_by_code: Dict[str, str],
+) -> bytes:
+
+    q_sales = _scaled(sales_arr, 2)
+    q_loss = _scaled(loss_amounts, 2)
+    q_lop = _scaled(loss_percents, 3)
+    q_osa = _scaled(osa_res, 2)
+    if q_sales is not None and q_loss is not None and q_lop is not None and q_osa is not None:
+        return _format_rows_numba(
+            fragments, frag_offsets, abc_codes, q_sales, q_loss, q_lop, q_osa
+        ).tobytes()
 
-    n = len(codes)
     out = []
     append = out.append
-    for rank_idx in range(n):
-        i = order[rank_idx]
+    for i in range(abc_codes.shape[0]):
         code = codes[i]
         append({
             "Name": name_by_code.get(code, code),
@@ -346,7 +1049,1862 @@ async def item_analytics(request: Request) -> ORJSONResponse:
             "Loss": round(float(loss_amounts[i]), 2),
             "LossOfProfit": round(float(loss_percents[i]), 3),
             "OSA": round(float(osa_res[i]), 2),
-            "ABC": chr(abc_codes[rank_idx]),
+            "ABC": chr(abc_codes[i]),
+        })
+    return orjson.dumps(out)
+
+
+# Bulk formats for /item-analytics/, picked by the Accept header. They carry
+# the kernel outputs as columns; the string columns are dictionary tables in
+# dataset order plus per-row indices into them.
+JSON_MEDIA = "application/json"
+COLUMNS_MEDIA = "application/vnd.rtu.columns+json"
+ARROW_MEDIA = "application/vnd.apache.arrow.stream"
+NPZ_MEDIA = "application/x-npz"
+
+# rows (None for every row in dataset order), ABC, Sales, Loss, LossOfProfit, OSA.
+RowsResult = Tuple[np.ndarray | None, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+_dict_tables: Tuple[int, List[str]] | None = None
+
+
+def _names_table(ds: _Dataset) -> List[str]:
+    global _dict_tables
+
+    cached = _dict_tables
+    if cached is not None and cached[0] == ds.version:
+        return cached[1]
+    names = [ds.name_by_code.get(code, code) for code in ds.codes]
+    _dict_tables = (ds.version, names)
+    return names
+
+
+def _result_columns(ds: _Dataset, result: RowsResult) -> Dict[str, np.ndarray]:
+    rows, abc_codes, sales, loss_amounts, loss_percents, osa_res = result
+    if rows is None:
+        rows = np.arange(len(ds.codes), dtype=np.int32)
+    return {
+        "Row": rows.astype(np.int32),
+        "Group": ds.group_ids[rows],
+        "Sales": sales,
+        "Loss": loss_amounts,
+        "LossOfProfit": loss_percents,
+        "OSA": osa_res,
+        "ABC": abc_codes,
+    }
+
+
+@telemetry.timed("format")
+def _columns_json(ds: _Dataset, result: RowsResult) -> bytes:
+
+    cols = _result_columns(ds, result)
+    return orjson.dumps(
+        {
+            "Codes": ds.codes,
+            "Names": _names_table(ds),
+            "Groups": ds.group_names,
+            "Row": cols["Row"],
+            "Group": cols["Group"],
+            "Sales": np.round(cols["Sales"], 2),
+            "Loss": np.round(cols["Loss"], 2),
+            "LossOfProfit": np.round(cols["LossOfProfit"], 3),
+            "OSA": np.round(cols["OSA"], 2),
+            "ABC": cols["ABC"].tobytes().decode("ascii"),
+        },
+        option=orjson.OPT_SERIALIZE_NUMPY,
+    )
+
+
+@telemetry.timed("format")
+def _columns_npz(ds: _Dataset, result: RowsResult) -> bytes:
+
+    cols = _result_columns(ds, result)
+    cols["ABC"] = cols["ABC"].view("S1")
+    out = io.BytesIO()
+    np.savez(
+        out, Codes=np.array(ds.codes, dtype=str), Names=np.array(_names_table(ds), dtype=str),
+        Groups=np.array(ds.group_names, dtype=str), **cols
+    )
+    return out.getvalue()
+
+
+@telemetry.timed("format")
+def _columns_arrow(ds: _Dataset, result: RowsResult) -> bytes:
+
+    cols = _result_columns(ds, result)
+    rows = pa.array(cols["Row"])
+    batch = pa.record_batch(
+        [
+            pa.DictionaryArray.from_arrays(rows, pa.array(ds.codes, pa.string())),
+            pa.DictionaryArray.from_arrays(rows, pa.array(_names_table(ds), pa.string())),
+            pa.DictionaryArray.from_arrays(pa.array(cols["Group"]), pa.array(ds.group_names, pa.string())),
+            pa.array(cols["Sales"]),
+            pa.array(cols["Loss"]),
+            pa.array(cols["LossOfProfit"]),
+            pa.array(cols["OSA"]),
+            pa.DictionaryArray.from_arrays(
+                pa.array((cols["ABC"] - ord("A")).astype(np.int8)), pa.array(["A", "B", "C"])),
+        ],
+        names=["Code", "Name", "Group", "Sales", "Loss", "LossOfProfit", "OSA", "ABC"],
+    )
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+_COLUMN_WRITERS: Dict[str, Callable[[_Dataset, RowsResult], bytes]] = {
+    COLUMNS_MEDIA: _columns_json,
+    NPZ_MEDIA: _columns_npz,
+    ARROW_MEDIA: _columns_arrow,
+}
+
+
+def _negotiate(accept: str) -> str | None:
+
+    # Highest q wins, earlier entries break ties; anything unknown falls back
+    # to the row JSON. None only when Arrow alone was asked for and pyarrow
+    # is missing.
+    best, best_q = JSON_MEDIA, -1.0
+    refused = False
+    for part in accept.split(","):
+        media, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        media = media.lower()
+        if media in ("*/*", "application/*"):
+            media = JSON_MEDIA
+        if q <= 0.0 or (media != JSON_MEDIA and media not in _COLUMN_WRITERS):
+            continue
+        if media == ARROW_MEDIA and pa is None:
+            refused = True
+            continue
+        if q > best_q:
+            best, best_q = media, q
+    if refused and best_q < 0.0:
+        return None
+    return best
+
+
+def _prepare_csr_on_start(stock_data: List[Dict[str, Any]], sales_data: List[Dict[str, Any]]) -> None:
+
+    _install_dataset(_build_from_records(stock_data, sales_data))
+
+
+def _build_from_records(
+    stock_data: List[Dict[str, Any]],
+    sales_data: List[Dict[str, Any]],
+    source: SourceStamp = (),
+) -> _Dataset:
+
+    ingest = DumpIngest()
+    ingest.add_stock(stock_data)
+    ingest.add_sales(sales_data)
+    return _ingested(ingest, source)
+
+
+def _ingested(ingest: DumpIngest, source: SourceStamp = ()) -> _Dataset:
+    parts = ingest.csr()
+    return _build_dataset(
+        *parts, source, ledger=ingest.ledger(parts[0]), unsold=_unsold_of(ingest.unsold(parts[0]))
+    )
+
+
+def _unsold_of(parts: UnsoldParts) -> _Unsold:
+    return _Unsold(parts, {code: i for i, code in enumerate(parts[0])})
+
+
+def _gather_csr(starts: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+
+    # Offsets of the segments starts[k]:starts[k] + lengths[k] laid end to
+    # end, and the flat index of every element they cover.
+    new_offsets = np.zeros(lengths.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    shift = np.repeat(starts - new_offsets[:-1], lengths)
+    return new_offsets, np.arange(new_offsets[-1], dtype=np.int64) + shift
+
+
+def _permute_csr(offsets: np.ndarray, order: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    return _gather_csr(offsets[:-1][order], np.diff(offsets)[order])
+
+
+def _epoch_seconds(times: np.ndarray, epoch: float) -> np.ndarray:
+    rel = np.rint(times - epoch)
+    if rel.size and np.abs(rel).max() > np.iinfo(np.int32).max:
+        raise ValueError("event span does not fit into int32 seconds")
+    return rel.astype(np.int32)
+
+
+def _compact_events(
+    offsets: np.ndarray,
+    times_flat: np.ndarray,
+    starts_flat: np.ndarray,
+    ends_flat: np.ndarray,
+    epoch: float | None = None,
+) -> Tuple[float, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+
+    # The kernels only test stock levels against zero, and of the start
+    # levels only each code's first one, so events shrink to int32 seconds
+    # from the dataset epoch plus one in-stock byte.
+    if epoch is None:
+        epoch = float(np.floor(times_flat.min())) if times_flat.size else 0.0
+    times_rel = _epoch_seconds(times_flat, epoch)
+
+    open_flags = np.zeros(offsets.shape[0] - 1, dtype=np.uint8)
+    filled = offsets[1:] > offsets[:-1]
+    open_flags[filled] = starts_flat[offsets[:-1][filled]] > 0.0
+    end_flags = (ends_flat > 0.0).astype(np.uint8)
+    return epoch, times_rel, open_flags, end_flags, _build_avail_prefix(times_rel, end_flags, offsets)
+
+
+def _frozen(arr: np.ndarray) -> np.ndarray:
+    arr.flags.writeable = False
+    return arr
+
+
+# Deltas of a dataset nothing was appended to; same dtypes as real ones so
+# the kernels keep a single signature.
+_NO_EVENTS: EventDelta = (
+    _frozen(np.empty(0, dtype=np.int64)), _frozen(np.zeros(1, dtype=np.int64)),
+    _frozen(np.empty(0, dtype=np.int32)), _frozen(np.empty(0, dtype=np.uint8)),
+    _frozen(np.empty(0, dtype=np.uint8)), _frozen(np.empty(0, dtype=np.int32)),
+)
+_NO_LEDGER: LedgerDelta = (
+    _frozen(np.empty(0, dtype=np.int64)), _frozen(np.zeros(1, dtype=np.int64)),
+    _frozen(np.empty(0, dtype=np.int32)), _frozen(np.empty(0, dtype=np.float64)),
+    _frozen(np.empty(0, dtype=np.float64)),
+)
+
+
+def _build_dataset(
+    codes: List[str],
+    offsets: np.ndarray,
+    times_flat: np.ndarray,
+    starts_flat: np.ndarray,
+    ends_flat: np.ndarray,
+    sales_arr: np.ndarray,
+    price_arr: np.ndarray,
+    loss_arr: np.ndarray,
+    name_by_code: Dict[str, str],
+    group_by_code: Dict[str, str],
+    source: SourceStamp = (),
+    ledger: LedgerParts | None = None,
+    unsold: _Unsold | None = None,
+) -> _Dataset:
+
+    if ledger is None:
+        # Without dated entries every sale and spoilage counts in any window.
+        ledger = (
+            np.zeros(len(codes) + 1, dtype=np.int64), np.empty(0), np.empty(0), np.empty(0),
+            np.asarray(sales_arr, dtype=np.float64), np.asarray(loss_arr, dtype=np.float64),
+        )
+    led_offsets, led_times, led_sales, led_loss, base_sales, base_loss = ledger
+    stamps = np.concatenate((times_flat, led_times))
+    epoch = float(np.floor(stamps.min())) if stamps.size else 0.0
+
+    # Sales never change for a loaded dataset, so rank once and keep every
+    # per-code array in rank order; requests then emit rows in memory order.
+    order, abc_arr = assign_abc(sales_arr)
+    codes = [codes[i] for i in order]
+    offsets, event_idx = _permute_csr(offsets, order)
+    epoch, times_rel, open_flags, end_flags, avail_prefix = _compact_events(
+        offsets, times_flat[event_idx], starts_flat[event_idx], ends_flat[event_idx], epoch
+    )
+    led_offsets, led_idx = _permute_csr(led_offsets, order)
+    fragments, frag_offsets = _build_row_fragments(codes, name_by_code, group_by_code)
+
+    return _Dataset(
+        version=next(_versions),
+        source=source,
+        codes=codes,
+        epoch=epoch,
+        offsets=_frozen(offsets),
+        times_flat=_frozen(times_rel),
+        open_flags=_frozen(open_flags),
+        end_flags=_frozen(end_flags),
+        avail_prefix=_frozen(avail_prefix),
+        sales_arr=_frozen(sales_arr[order]),
+        price_arr=_frozen(price_arr[order]),
+        lossq_arr=_frozen(loss_arr[order]),
+        abc_arr=_frozen(abc_arr),
+        ledger_offsets=_frozen(led_offsets),
+        ledger_times=_frozen(_epoch_seconds(led_times[led_idx], epoch)),
+        ledger_sales=_frozen(_segment_cumsum(led_sales[led_idx], led_offsets)),
+        ledger_loss=_frozen(_segment_cumsum(led_loss[led_idx], led_offsets)),
+        base_sales=_frozen(base_sales[order]),
+        base_loss=_frozen(base_loss[order]),
+        row_fragments=_frozen(fragments),
+        row_frag_offsets=_frozen(frag_offsets),
+        name_by_code=name_by_code,
+        group_by_code=group_by_code,
+        index_by_code={code: i for i, code in enumerate(codes)},
+        unsold=unsold,
+        **_group_tables(codes, group_by_code),
+    )
+
+
+def _group_tables(codes: List[str], group_by_code: Dict[str, str]) -> Dict[str, Any]:
+    group_names, group_ids = np.unique(
+        np.array([group_by_code.get(code, NO_GROUP) for code in codes], dtype=object),
+        return_inverse=True,
+    )
+    group_ids = group_ids.astype(np.int32)
+    group_offsets = np.zeros(group_names.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(group_ids, minlength=group_names.shape[0]), out=group_offsets[1:])
+    return {
+        "group_ids": _frozen(group_ids),
+        "group_rows": _frozen(np.argsort(group_ids, kind="stable").astype(np.int64)),
+        "group_offsets": _frozen(group_offsets),
+        "group_names": group_names.tolist(),
+    }
+
+
+def _install_dataset(ds: _Dataset) -> None:
+    global _DATASET
+
+    # A snapshot that only moved its append log offset keeps its version
+    # and with it the cached results.
+    if _DATASET is None or _DATASET.version != ds.version:
+        _result_cache.clear()
+    _DATASET = ds
+
+
+def _install_csr(
+    codes: List[str],
+    offsets: np.ndarray,
+    times_flat: np.ndarray,
+    starts_flat: np.ndarray,
+    ends_flat: np.ndarray,
+    sales_arr: np.ndarray,
+    price_arr: np.ndarray,
+    loss_arr: np.ndarray,
+    name_by_code: Dict[str, str],
+    group_by_code: Dict[str, str],
+) -> None:
+
+    _install_dataset(_build_dataset(
+        codes, offsets, times_flat, starts_flat, ends_flat,
+        sales_arr, price_arr, loss_arr, name_by_code, group_by_code
+    ))
+
+
+def _dump_stamp() -> SourceStamp:
+    stamp = []
+    for path in (STOCK_DUMP, SALES_DUMP):
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append((0, 0))
+    return tuple(stamp)
+
+
+def _parse_dumps(source: SourceStamp) -> _Dataset:
+
+    ingest = DumpIngest()
+    for batch in iter_json_batches(STOCK_DUMP):
+        ingest.add_stock(batch)
+    for batch in iter_json_batches(SALES_DUMP):
+        ingest.add_sales(batch)
+    return _ingested(ingest, source)
+
+
+def _snapshot_parts(ds: _Dataset) -> snapshot.Snapshot:
+
+    codes = ds.codes
+    unsold = (ds.unsold or _unsold_of(DumpIngest().unsold([]))).parts
+    keys = np.array(codes, dtype=str)
+    code_rows = np.argsort(keys, kind="stable").astype(np.int64)
+    return (
+        {
+            **{name: getattr(ds, name) for name in _SNAPSHOT_ARRAYS},
+            "code_keys": keys[code_rows],
+            "code_rows": code_rows,
+            **{f"unsold_{name}": arr for name, arr in zip(_UNSOLD_ARRAYS, unsold[1:12])},
+        },
+        {
+            "codes": codes,
+            "names": [ds.name_by_code.get(code, code) for code in codes],
+            "groups": [ds.group_by_code.get(code, NO_GROUP) for code in codes],
+            "group_names": ds.group_names,
+            "unsold_codes": unsold[0],
+            **{f"unsold_{name}": table for name, table in zip(_UNSOLD_TABLES, unsold[12:])},
+        },
+        {"layout": DATASET_LAYOUT, "source": ds.source, "epoch": ds.epoch, "journal": ds.journal},
+    )
+
+
+def _dataset_from_parts(
+    snap: snapshot.Snapshot, source: SourceStamp, generation: int = 0, handle: Any = None
+) -> _Dataset:
+
+    arrays, tables, meta = snap
+    codes = tables["codes"]
+    return _Dataset(
+        version=next(_versions),
+        source=source,
+        codes=codes,
+        epoch=float(meta["epoch"]),
+        group_names=tables["group_names"],
+        name_by_code=dict(zip(codes, tables["names"])),
+        group_by_code=dict(zip(codes, tables["groups"])),
+        index_by_code=_CodeIndex(arrays["code_keys"], arrays["code_rows"], codes),
+        generation=generation,
+        journal=int(meta.get("journal", 0)),
+        unsold=_unsold_of((
+            tables["unsold_codes"],
+            *(arrays[f"unsold_{name}"] for name in _UNSOLD_ARRAYS),
+            *(tables[f"unsold_{name}"] for name in _UNSOLD_TABLES),
+        )),
+        handle=handle,
+        **{name: arrays[name] for name in _SNAPSHOT_ARRAYS},
+    )
+
+
+def _save_snapshot(ds: _Dataset, checksum: str) -> None:
+
+    arrays, tables, meta = _snapshot_parts(ds)
+    meta["checksum"] = checksum
+    snapshot.write_snapshot(SNAPSHOT_PATH, arrays, tables, meta)
+
+
+def _open_snapshot(source: SourceStamp, checksum: Callable[[], str]) -> _Dataset | None:
+
+    snap = snapshot.open_snapshot(SNAPSHOT_PATH)
+    if snap is None:
+        return None
+    meta = snap[2]
+    if meta.get("layout") != DATASET_LAYOUT:
+        return None
+    # Matching stamps are enough; otherwise the dumps may only have been
+    # touched, so fall back to comparing their contents. Appends folded in
+    # were logged against the stamped dumps and go with them.
+    if meta.get("source") != [list(stamp) for stamp in source]:
+        if meta.get("journal") or meta.get("checksum") != checksum():
+            return None
+    return _dataset_from_parts(snap, source)
+
+
+def _attach_shared() -> _Dataset | None:
+
+    attached = shm.attach(SHM_NAME)
+    if attached is None:
+        return None
+    gen, snap, seg = attached
+    meta = snap[2]
+    if meta.get("layout") != DATASET_LAYOUT:
+        seg.close()
+        return None
+    source = tuple(tuple(stamp) for stamp in meta.get("source", ()))
+    return _dataset_from_parts(snap, source, generation=gen, handle=seg)
+
+
+def _load_dataset() -> _Dataset:
+
+    if SHM_NAME:
+        ds = _attach_shared()
+        if ds is not None:
+            return ds
+
+    source = _dump_stamp()
+    if not SNAPSHOT_PATH:
+        return _parse_dumps(source)
+
+    digest: List[str] = []
+
+    def checksum() -> str:
+        if not digest:
+            digest.append(snapshot.source_checksum((STOCK_DUMP, SALES_DUMP)))
+        return digest[0]
+
+    ds = _open_snapshot(source, checksum)
+    if ds is not None:
+        return ds
+    with snapshot.build_lock(SNAPSHOT_PATH):
+        ds = _open_snapshot(source, checksum)
+        if ds is not None:
+            return ds
+        # Hash the dumps before parsing them and save only if they were not
+        # replaced meanwhile, so the snapshot never pairs data with the
+        # checksum of other dumps.
+        digest_before = checksum()
+        ds = _parse_dumps(source)
+        if _dump_stamp() != source:
+            return ds
+        try:
+            _save_snapshot(ds, digest_before)
+        except OSError:
+            return ds
+    # Serve from the mapped file so every worker shares the same pages.
+    return _open_snapshot(source, checksum) or ds
+
+
+async def _reload_if_changed() -> bool:
+    global _failed_source
+
+    current = _DATASET
+    if SHM_NAME:
+        gen = shm.current_generation(SHM_NAME)
+        if gen is not None:
+            # A loader process owns the dumps; just follow its generations.
+            if current is not None and current.generation == gen:
+                return False
+            ds = _attach_shared()
+            if ds is None:
+                return False
+            _install_dataset(ds)
+            return True
+
+    source = _dump_stamp()
+    if (current is not None and current.source == source) or source == _failed_source:
+        return False
+    try:
+        ds = await asyncio.to_thread(_load_dataset)
+    except Exception:
+        # Most likely a dump caught mid-write; keep serving the current
+        # snapshot and retry once the files change again.
+        _failed_source = source
+        return False
+    _failed_source = None
+    _install_dataset(ds)
+    return True
+
+
+# Appends fold batches of new stock and sales records into the dataset's
+# delta and publish the result as a new snapshot. The work follows the
+# batch, the history of the codes it names and the delta; per-code arrays,
+# ranking and tables catch up once per version in _folded(). The watcher
+# folds a delta that grew past DELTA_MAX_EVENTS into a fresh base.
+_append_lock: asyncio.Lock | None = None
+
+
+def open_appends() -> None:
+    global _append_lock
+
+    # Called from the lifespan, so the lock belongs to the serving loop.
+    _append_lock = asyncio.Lock()
+
+
+def _appends_locked() -> asyncio.Lock:
+    global _append_lock
+
+    # Code driven without the lifespan gets its lock on first use, which
+    # is inside a running loop as well.
+    if _append_lock is None:
+        _append_lock = asyncio.Lock()
+    return _append_lock
+
+
+def _delta_size(delta: _Delta | None) -> int:
+    return 0 if delta is None else int(delta.events[2].shape[0] + delta.ledger[2].shape[0])
+
+
+def _delta_lookup(d_rows: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    k = np.searchsorted(d_rows, rows)
+    hit = k < d_rows.shape[0]
+    hit[hit] = d_rows[k[hit]] == rows[hit]
+    return hit, k
+
+
+def _current_segments(
+    base_offsets: np.ndarray,
+    base: Tuple[np.ndarray, ...],
+    d_rows: np.ndarray,
+    d_offsets: np.ndarray,
+    delta: Tuple[np.ndarray, ...],
+    rows: np.ndarray,
+) -> Tuple[np.ndarray, List[np.ndarray]]:
+
+    # Segments of rows as requests see them: the delta one for rows an
+    # append touched, the base one otherwise, none for rows past the base.
+    hit, k = _delta_lookup(d_rows, rows)
+    from_base = ~hit & (rows < base_offsets.shape[0] - 1)
+    b = rows[from_base]
+    d = k[hit]
+    lengths = np.zeros(rows.shape[0], dtype=np.int64)
+    lengths[from_base] = base_offsets[b + 1] - base_offsets[b]
+    lengths[hit] = d_offsets[d + 1] - d_offsets[d]
+    offsets = np.zeros(rows.shape[0] + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    _, to_base = _gather_csr(offsets[:-1][from_base], lengths[from_base])
+    _, at_base = _gather_csr(base_offsets[b], lengths[from_base])
+    _, to_delta = _gather_csr(offsets[:-1][hit], lengths[hit])
+    _, at_delta = _gather_csr(d_offsets[d], lengths[hit])
+    out = []
+    for base_arr, delta_arr in zip(base, delta):
+        arr = np.empty(offsets[-1], dtype=base_arr.dtype)
+        arr[to_base] = base_arr[at_base]
+        arr[to_delta] = delta_arr[at_delta]
+        out.append(arr)
+    return offsets, out
+
+
+def _current_open(ds: _Dataset, events: EventDelta, rows: np.ndarray) -> np.ndarray:
+    hit, k = _delta_lookup(events[0], rows)
+    from_base = ~hit & (rows < ds.offsets.shape[0] - 1)
+    opened = np.zeros(rows.shape[0], dtype=np.uint8)
+    opened[from_base] = ds.open_flags[rows[from_base]]
+    opened[hit] = events[3][k[hit]]
+    return opened
+
+
+def _segment_values(cum: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # Inverse of _segment_cumsum.
+    values = cum.copy()
+    values[1:] -= cum[:-1]
+    heads = offsets[:-1][offsets[1:] > offsets[:-1]]
+    values[heads] = cum[heads]
+    return values
+
+
+def _merge_order(
+    all_rows: np.ndarray, cur_offsets: np.ndarray, rows: np.ndarray, offsets: np.ndarray, stamps: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+
+    # stamps holds the current entries of all_rows followed by the new ones
+    # of rows. np.lexsort is stable, so at equal times the entries already
+    # held stay first, like dump records before appended ones in a rebuild.
+    owner = np.concatenate((
+        np.repeat(np.arange(all_rows.shape[0], dtype=np.int64), np.diff(cur_offsets)),
+        np.repeat(np.searchsorted(all_rows, rows), np.diff(offsets)),
+    ))
+    merged = np.zeros(all_rows.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owner, minlength=all_rows.shape[0]), out=merged[1:])
+    return np.lexsort((stamps, owner)), merged
+
+
+def _with_entries(rows: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    keep = offsets[1:] > offsets[:-1]
+    return rows[keep], np.concatenate((offsets[:1], offsets[1:][keep]))
+
+
+def _merge_events(
+    ds: _Dataset,
+    events: EventDelta,
+    rows: np.ndarray,
+    offsets: np.ndarray,
+    times: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+) -> EventDelta:
+
+    # New stock events, a CSR over rows with absolute times, merged into
+    # the history of their rows.
+    rows, offsets = _with_entries(rows, offsets)
+    if rows.shape[0] == 0:
+        return events
+    d_rows, d_offsets, d_times, d_open, d_ends, _ = events
+    all_rows = np.union1d(d_rows, rows)
+    cur_offsets, (cur_times, cur_ends) = _current_segments(
+        ds.offsets, (ds.times_flat, ds.end_flags), d_rows, d_offsets, (d_times, d_ends), all_rows)
+    stamps = np.concatenate((cur_times, _epoch_seconds(times, ds.epoch)))
+    order, merged = _merge_order(all_rows, cur_offsets, rows, offsets, stamps)
+
+    # Of the start levels only the first event's counts; it changes when a
+    # new event comes first.
+    opened = _current_open(ds, events, all_rows)
+    filled = np.flatnonzero(merged[1:] > merged[:-1])
+    first = order[merged[filled]]
+    new_first = first >= cur_times.shape[0]
+    opened[filled[new_first]] = starts[first[new_first] - cur_times.shape[0]] > 0.0
+
+    m_times = stamps[order]
+    m_ends = np.concatenate((cur_ends, (ends > 0.0).astype(np.uint8)))[order]
+    prefix = _build_avail_prefix(m_times, m_ends, merged)
+    return (
+        _frozen(all_rows), _frozen(merged), _frozen(m_times),
+        _frozen(opened), _frozen(m_ends), _frozen(prefix),
+    )
+
+
+def _merge_ledger(
+    ds: _Dataset,
+    ledger: LedgerDelta,
+    rows: np.ndarray,
+    offsets: np.ndarray,
+    times: np.ndarray,
+    sales: np.ndarray,
+    loss: np.ndarray,
+) -> LedgerDelta:
+
+    rows, offsets = _with_entries(rows, offsets)
+    if rows.shape[0] == 0:
+        return ledger
+    d_rows, d_offsets = ledger[0], ledger[1]
+    all_rows = np.union1d(d_rows, rows)
+    cur_offsets, (cur_times, cur_sales, cur_loss) = _current_segments(
+        ds.ledger_offsets, (ds.ledger_times, ds.ledger_sales, ds.ledger_loss),
+        d_rows, d_offsets, ledger[2:], all_rows)
+    stamps = np.concatenate((cur_times, _epoch_seconds(times, ds.epoch)))
+    order, merged = _merge_order(all_rows, cur_offsets, rows, offsets, stamps)
+    m_sales = np.concatenate((_segment_values(cur_sales, cur_offsets), sales))[order]
+    m_loss = np.concatenate((_segment_values(cur_loss, cur_offsets), loss))[order]
+    return (
+        _frozen(all_rows), _frozen(merged), _frozen(stamps[order]),
+        _frozen(_segment_cumsum(m_sales, merged)), _frozen(_segment_cumsum(m_loss, merged)),
+    )
+
+
+def _row_count(ds: _Dataset) -> int:
+    return len(ds.codes) + (0 if ds.delta is None else len(ds.delta.codes))
+
+
+def _row_of(ds: _Dataset, code: str) -> int | None:
+    row = ds.index_by_code.get(code)
+    if row is None and ds.delta is not None:
+        row = ds.delta.index.get(code)
+    return row
+
+
+def _label_of(ds: _Dataset, code: str) -> Tuple[str, str]:
+    label = None if ds.delta is None else ds.delta.labels.get(code)
+    if label is None:
+        label = (ds.name_by_code.get(code, code), ds.group_by_code.get(code, NO_GROUP))
+    return label
+
+
+def _row_values(ds: _Dataset, rows: np.ndarray) -> np.ndarray:
+
+    # Current per-code values of rows, one column per _VALUE_ARRAYS name:
+    # the overlay's where it has them, the dataset's otherwise, zeros for
+    # rows nothing was recorded for yet.
+    out = np.zeros((rows.shape[0], len(_VALUE_ARRAYS)), dtype=np.float64)
+    old = rows < len(ds.codes)
+    for j, name in enumerate(_VALUE_ARRAYS):
+        out[old, j] = getattr(ds, name)[rows[old]]
+    if ds.delta is not None:
+        hit, k = _delta_lookup(ds.delta.rows, rows)
+        out[hit] = ds.delta.values[k[hit]]
+    return out
+
+
+def _merge_values(
+    d_rows: np.ndarray, d_values: np.ndarray, rows: np.ndarray, values: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    all_rows = np.union1d(d_rows, rows)
+    out = np.empty((all_rows.shape[0], d_values.shape[1]), dtype=np.float64)
+    out[np.searchsorted(all_rows, d_rows)] = d_values
+    out[np.searchsorted(all_rows, rows)] = values
+    return _frozen(all_rows), _frozen(out)
+
+
+def _split_pending(
+    ds: _Dataset, pending: Dict[str, Tuple[Records, Records]], stock: Records, sales: Records
+) -> Tuple[Dict[str, Tuple[Records, Records]], List[str]]:
+
+    # Records of codes the dataset does not have join their pending ones;
+    # returns the new pending table and the codes whose sales moved.
+    fresh: Dict[str, Tuple[Records, Records]] = {}
+    for key, side, records in (("НоменклатураКод", 0, stock), ("Код", 1, sales)):
+        for rec in records:
+            code = str(rec.get(key, "")).strip()
+            if code and _row_of(ds, code) is None:
+                fresh.setdefault(code, ([], []))[side].append(rec)
+    if not fresh:
+        return pending, []
+    pending = dict(pending)
+    for code, (new_stock, new_sales) in fresh.items():
+        old_stock, old_sales = pending.get(code, ([], []))
+        pending[code] = (old_stock + new_stock, old_sales + new_sales)
+    return pending, [code for code, (_, new_sales) in fresh.items() if new_sales]
+
+
+def _batch_labels(ds: _Dataset, batch: DumpIngest) -> Dict[str, Tuple[str, str]]:
+
+    # Names and groups a batch gives codes already in ds, where they differ:
+    # as in a rebuild the latest stock record sets the group and the latest
+    # sales record the name. Codes in ds have sold, so a stock name only
+    # counts for codes that had no name at all.
+    labels = {}
+    for code in dict.fromkeys(itertools.chain(batch.name_sales, batch.name_by_code)):
+        if _row_of(ds, code) is None:
+            continue
+        name, group = _label_of(ds, code)
+        label = (
+            batch.name_sales.get(code) or (name == code and batch.name_by_code.get(code)) or name,
+            batch.group_by_code.get(code, group),
+        )
+        if label != (name, group):
+            labels[code] = label
+    return labels
+
+
+def _indexed(index: Mapping[str, int], added: Dict[str, int]) -> Mapping[str, int]:
+    if not added:
+        return index
+    if isinstance(index, _CodeIndex):
+        return index.extended(added)
+    return {**index, **added}
+
+
+def _label_tables(ds: _Dataset, labels: Dict[str, Tuple[str, str]], codes: List[str]) -> Dict[str, Any]:
+
+    # Lookup tables, row fragments and groups of ds with labels applied to
+    # its codes and new codes, which labels also covers, appended.
+    name_by_code = dict(ds.name_by_code)
+    group_by_code = dict(ds.group_by_code)
+    for code, (name, group) in labels.items():
+        name_by_code[code] = name
+        group_by_code[code] = group
+    n_old = len(ds.codes)
+    all_codes = ds.codes + codes
+    fresh = np.concatenate((
+        np.sort(np.array([ds.index_by_code[code] for code in labels if code in ds.index_by_code], dtype=np.int64)),
+        n_old + np.arange(len(codes), dtype=np.int64),
+    ))
+    fragments, frag_offsets = _build_row_fragments([all_codes[i] for i in fresh], name_by_code, group_by_code)
+
+    # Rows keep their fragments unless relabelled; the rest are spliced in.
+    lengths = np.concatenate((np.diff(ds.row_frag_offsets), np.zeros(len(codes), dtype=np.int64)))
+    lengths[fresh] = np.diff(frag_offsets)
+    row_frag_offsets = np.zeros(len(all_codes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=row_frag_offsets[1:])
+    row_fragments = np.empty(row_frag_offsets[-1], dtype=np.uint8)
+    kept = np.ones(len(all_codes), dtype=bool)
+    kept[fresh] = False
+    kept = np.flatnonzero(kept)
+    _, at = _gather_csr(ds.row_frag_offsets[kept], lengths[kept])
+    _, to = _gather_csr(row_frag_offsets[kept], lengths[kept])
+    row_fragments[to] = ds.row_fragments[at]
+    _, to = _gather_csr(row_frag_offsets[fresh], lengths[fresh])
+    row_fragments[to] = fragments
+
+    tables = {
+        "codes": all_codes,
+        "name_by_code": name_by_code,
+        "group_by_code": group_by_code,
+        "index_by_code": _indexed(ds.index_by_code, {code: n_old + j for j, code in enumerate(codes)}),
+        "row_fragments": _frozen(row_fragments),
+        "row_frag_offsets": _frozen(row_frag_offsets),
+    }
+    if codes or any(group != ds.group_by_code.get(code, NO_GROUP) for code, (_, group) in labels.items()):
+        tables.update(_group_tables(all_codes, group_by_code))
+    return tables
+
+
+# Single entry: requests on the current version all fold it once.
+_last_folded: Tuple[int, _Dataset] | None = None
+
+
+def _folded(ds: _Dataset) -> _Dataset:
+    global _last_folded
+
+    # ds with its delta's overlay applied to the per-code arrays, the ABC
+    # ranking, the lookup tables, row fragments and groups, which is what
+    # requests and compaction read. This is the O(codes) part of appends,
+    # paid once per version rather than once per batch.
+    delta = ds.delta
+    if delta is None or not (delta.rows.shape[0] or delta.codes or delta.labels):
+        return ds
+    last = _last_folded
+    if last is not None and last[0] == ds.version:
+        return last[1]
+    n_old, n_rows = len(ds.codes), _row_count(ds)
+    arrays = {}
+    for j, name in enumerate(_VALUE_ARRAYS):
+        arr = np.zeros(n_rows, dtype=np.float64)
+        arr[:n_old] = getattr(ds, name)
+        arr[delta.rows] = delta.values[:, j]
+        arrays[name] = _frozen(arr)
+
+    abc_arr, rank = ds.abc_arr, ds.rank
+    if delta.resort:
+        # Memory order stays; rank carries the new ABC order instead.
+        order, ranked_abc = assign_abc(arrays["sales_arr"])
+        abc_arr = np.empty_like(ranked_abc)
+        abc_arr[order] = ranked_abc
+        order = order.astype(np.int64)
+        abc_arr = _frozen(abc_arr)
+        rank = None if np.array_equal(order, np.arange(order.shape[0])) else _frozen(order)
+
+    tables = _label_tables(ds, delta.labels, list(delta.codes)) if delta.labels else {}
+    folded = replace(
+        ds, abc_arr=abc_arr, rank=rank, **arrays, **tables,
+        delta=replace(delta, rows=_frozen(np.empty(0, dtype=np.int64)),
+                      values=_frozen(np.empty((0, len(_VALUE_ARRAYS)))),
+                      codes=(), index={}, labels={}, resort=False),
+    )
+    _last_folded = (ds.version, folded)
+    return folded
+
+
+def _append_batch(ds: _Dataset, stock: Records, sales: Records) -> _Dataset:
+
+    if not isinstance(stock, list) or not isinstance(sales, list):
+        raise ValueError("Stock and Sales must be lists")
+    if not all(isinstance(rec, dict) for rec in itertools.chain(stock, sales)):
+        raise ValueError("records must be objects")
+    # Parsing the whole batch first rejects bad records before anything
+    # else is touched.
+    batch = DumpIngest()
+    batch.add_stock(stock)
+    batch.add_sales(sales)
+
+    delta = ds.delta or _Delta(ds.version, _NO_EVENTS, _NO_LEDGER, {})
+    pending, candidates = _split_pending(ds, delta.pending, stock, sales)
+    new_codes: List[str] = []
+    if candidates:
+        # Pending codes whose sales turned positive join the dataset with
+        # their dump history and everything appended for them so far.
+        joined = DumpIngest()
+        unsold = ds.unsold
+        if unsold is not None:
+            joined.add_unsold(unsold.parts, [unsold.index[code] for code in candidates if code in unsold.index])
+        joined.add_stock([rec for code in candidates for rec in pending[code][0]])
+        joined.add_sales([rec for code in candidates for rec in pending[code][1]])
+        parts = joined.csr()
+        new_codes = parts[0]
+        for code in new_codes:
+            del pending[code]
+
+    # Everything below works on the rows the batch names: their current
+    # values come from the overlay or the dataset and go back into the
+    # overlay, with the new codes as rows past the current ones.
+    known = [code for code in batch.code_ids if _row_of(ds, code) is not None]
+    rows = np.array([_row_of(ds, code) for code in known], dtype=np.int64)
+    new_rows = _row_count(ds) + np.arange(len(new_codes), dtype=np.int64)
+    values = _row_values(ds, np.concatenate((rows, new_rows)))
+    sales_v, price_v, lossq_v, base_sales_v, base_loss_v = values.T
+    events, ledger = delta.events, delta.ledger
+
+    if known:
+        events = _merge_events(ds, events, rows, *batch.events(known))
+        led_offsets, led_times, led_sales, led_loss, undated_sales, undated_loss = batch.ledger(known)
+        ledger = _merge_ledger(ds, ledger, rows, led_offsets, led_times, led_sales, led_loss)
+        base_sales_v[:len(known)] += undated_sales
+        base_loss_v[:len(known)] += undated_loss
+        lossq_v[:len(known)] += np.array([batch.loss_qty.get(code, 0.0) for code in known])
+
+    # The dataset keeps totals and average prices only; the quantity sold
+    # so far comes back as total / price.
+    sold = np.array([j for j, code in enumerate(known) if code in batch.sales_sum], dtype=np.int64)
+    if sold.shape[0]:
+        old_price = price_v[sold]
+        qty = np.divide(sales_v[sold], old_price, out=np.zeros(sold.shape[0]), where=old_price > 0.0)
+        qty += np.array([batch.sales_qty[known[j]] for j in sold])
+        sales_v[sold] += np.array([batch.sales_sum[known[j]] for j in sold])
+        price_v[sold] = np.divide(sales_v[sold], qty, out=np.zeros(sold.shape[0]), where=qty > 0.0)
+
+    labels = _batch_labels(ds, batch)
+    if new_codes:
+        events = _merge_events(ds, events, new_rows, *parts[1:5])
+        led_offsets, led_times, led_sales, led_loss, undated_sales, undated_loss = joined.ledger(new_codes)
+        ledger = _merge_ledger(ds, ledger, new_rows, led_offsets, led_times, led_sales, led_loss)
+        values[len(known):] = np.column_stack((parts[5], parts[6], parts[7], undated_sales, undated_loss))
+        labels.update((code, (parts[8][code], parts[9].get(code, NO_GROUP))) for code in new_codes)
+
+    d_rows, d_values = _merge_values(delta.rows, delta.values, np.concatenate((rows, new_rows)), values)
+    return replace(
+        ds,
+        version=next(_versions),
+        delta=replace(
+            delta, events=events, ledger=ledger, pending=pending, rows=d_rows, values=d_values,
+            codes=delta.codes + tuple(new_codes),
+            index={**delta.index, **dict(zip(new_codes, new_rows.tolist()))} if new_codes else delta.index,
+            labels={**delta.labels, **labels} if labels else delta.labels,
+            resort=delta.resort or bool(sold.shape[0]) or bool(new_codes),
+            batches=delta.batches + 1,
+            records=delta.records + len(stock) + len(sales),
+            dropped=delta.dropped or bool(np.any(sales_v[sold] <= 0.0)),
+        ),
+    )
+
+
+def _with_log_offset(ds: _Dataset, offset: int) -> _Dataset:
+    delta = ds.delta or _Delta(ds.version, _NO_EVENTS, _NO_LEDGER, {})
+    return replace(ds, delta=replace(delta, log_offset=offset))
+
+
+def _follow_log(ds: _Dataset) -> _Dataset:
+
+    # Applies what other workers appended since ds last read the log.
+    # Entries written against other dumps are skipped: reloaded dumps are
+    # taken to contain them. Entries a compaction folded into the snapshot
+    # are no longer in the log, so a dataset behind it loads the snapshot.
+    offset = ds.journal if ds.delta is None else ds.delta.log_offset
+    header, entries, end = journal.read_entries(APPEND_LOG, offset)
+    stamp = [list(part) for part in ds.source]
+    if header["source"] == stamp and offset < header["folded"] and _saves_compacted():
+        # Only a snapshot of exactly these dumps will do.
+        saved = _open_snapshot(ds.source, lambda: "")
+        if saved is not None and saved.journal >= header["folded"]:
+            return _follow_log(saved)
+    if end == offset:
+        return ds
+    for entry in entries:
+        if entry.get("source") != stamp:
+            continue
+        try:
+            ds = _append_batch(ds, entry.get("Stock", []), entry.get("Sales", []))
+        except (ValueError, TypeError):
+            continue
+    return _with_log_offset(ds, end)
+
+
+def _append_logged(ds: _Dataset, stock: Records, sales: Records) -> _Dataset:
+
+    if not APPEND_LOG:
+        return _append_batch(ds, stock, sales)
+    # One worker at a time catches up with the log, applies its batch (a bad
+    # one raises before anything is written) and logs it, so every worker
+    # applies batches in log order.
+    with journal.locked(APPEND_LOG):
+        ds = _append_batch(_follow_log(ds), stock, sales)
+        offset = journal.append_entry(APPEND_LOG, {"source": ds.source, "Stock": stock, "Sales": sales})
+    return _with_log_offset(ds, offset)
+
+
+def _saves_compacted() -> bool:
+    # Compacted bases go to the snapshot file; with shared memory the
+    # loader process owns what workers open.
+    return bool(APPEND_LOG and SNAPSHOT_PATH) and not SHM_NAME
+
+
+def _save_compacted(ds: _Dataset) -> bool:
+
+    # Saves a compacted base of the current dumps as the snapshot, then
+    # drops the entries folded into it from the log. Saving first, under
+    # the log lock, means a worker that finds the log rotated always finds
+    # that snapshot too; appends wait for the write.
+    if not _saves_compacted() or _dump_stamp() != ds.source:
+        return False
+    stamp = [list(part) for part in ds.source]
+    try:
+        with snapshot.build_lock(SNAPSHOT_PATH), journal.locked(APPEND_LOG):
+            saved = snapshot.open_snapshot(SNAPSHOT_PATH)
+            meta = saved[2] if saved is not None else {}
+            same = meta.get("layout") == DATASET_LAYOUT and meta.get("source") == stamp
+            if same and meta.get("journal", 0) >= ds.journal:
+                return False
+            checksum = meta.get("checksum") if same else None
+            _save_snapshot(ds, checksum or snapshot.source_checksum((STOCK_DUMP, SALES_DUMP)))
+            journal.rotate(APPEND_LOG, ds.journal, stamp, ds.journal)
+    except OSError:
+        return False
+    return True
+
+
+def _rotate_log(ds: _Dataset) -> None:
+
+    # Once ds serves new dumps, entries logged against the old ones are
+    # only skipped; the log is cut before the first entry for these dumps.
+    if not APPEND_LOG or _dump_stamp() != ds.source:
+        return
+    stamp = [list(part) for part in ds.source]
+    try:
+        with journal.locked(APPEND_LOG):
+            header = journal.read_header(APPEND_LOG)
+            if header["source"] != stamp:
+                journal.rotate(
+                    APPEND_LOG, max(header["start"], ds.journal), stamp, ds.journal,
+                    keep=lambda entry: entry.get("source") == stamp,
+                )
+    except OSError:
+        pass
+
+
+def _compaction_due(ds: _Dataset) -> bool:
+    delta = ds.delta
+    if delta is None or not delta.batches:
+        return False
+    return delta.dropped or max(_delta_size(delta), delta.records) > DELTA_MAX_EVENTS
+
+
+def _unsold_rows(ds: _Dataset, rows: np.ndarray) -> UnsoldParts:
+
+    # Rows of ds in unsold form, for codes that appended refunds took to
+    # zero sales or below. Start levels only keep whether the first event
+    # opened in stock, undated totals become one undated entry per code and
+    # the quantity sold comes back as total / price.
+    events, ledger = _event_delta(ds), _ledger_delta(ds)
+    ev_offsets, (times, ends) = _current_segments(
+        ds.offsets, (ds.times_flat, ds.end_flags), events[0], events[1], (events[2], events[4]), rows)
+    starts = np.zeros(times.shape[0], dtype=np.float64)
+    filled = ev_offsets[1:] > ev_offsets[:-1]
+    starts[ev_offsets[:-1][filled]] = _current_open(ds, events, rows)[filled]
+    led_offsets, (led_times, led_sales, led_loss) = _current_segments(
+        ds.ledger_offsets, (ds.ledger_times, ds.ledger_sales, ds.ledger_loss), ledger[0], ledger[1], ledger[2:], rows)
+
+    offsets = led_offsets + np.arange(rows.shape[0] + 1, dtype=np.int64)
+    undated = offsets[1:] - 1
+    dated = np.ones(offsets[-1], dtype=np.bool_)
+    dated[undated] = False
+    l_times = np.full(offsets[-1], np.nan)
+    l_times[dated] = led_times + ds.epoch
+    l_sales = np.empty(offsets[-1], dtype=np.float64)
+    l_sales[dated] = _segment_values(led_sales, led_offsets)
+    l_sales[undated] = ds.base_sales[rows]
+    l_loss = np.empty(offsets[-1], dtype=np.float64)
+    l_loss[dated] = _segment_values(led_loss, led_offsets)
+    l_loss[undated] = ds.base_loss[rows]
+
+    sales, price = ds.sales_arr[rows], ds.price_arr[rows]
+    codes = [ds.codes[i] for i in rows]
+    names = [ds.name_by_code.get(code) for code in codes]
+    return (
+        codes, ev_offsets, times + ds.epoch, starts, ends.astype(np.float64),
+        offsets, l_times, l_sales, l_loss,
+        sales.copy(), np.divide(sales, price, out=np.zeros(rows.shape[0]), where=price != 0.0),
+        ds.lossq_arr[rows].copy(), names, list(names), [ds.group_by_code.get(code, NO_GROUP) for code in codes],
+    )
+
+
+def _unsold_after(ds: _Dataset, dropped: np.ndarray) -> _Unsold:
+
+    # Unsold table of the compacted ds: the codes it still leaves out, the
+    # ones it drops now, and the pending ones with their appended records.
+    ingest = DumpIngest()
+    if ds.unsold is not None:
+        codes = ds.unsold.parts[0]
+        ingest.add_unsold(ds.unsold.parts, [r for r, code in enumerate(codes) if code not in ds.index_by_code])
+    if dropped.shape[0]:
+        ingest.add_unsold(_unsold_rows(ds, dropped), list(range(dropped.shape[0])))
+    pending = ds.delta.pending.values()
+    ingest.add_stock([rec for stock, _ in pending for rec in stock])
+    ingest.add_sales([rec for _, sales in pending for rec in sales])
+    return _unsold_of(ingest.unsold([]))
+
+
+def _compacted(ds: _Dataset) -> _Dataset:
+
+    # A fresh base with the delta folded in: the merged segments and the
+    # per-code arrays go back through _build_dataset, which ranks them
+    # again. Codes whose sales fell to zero drop out like in a rebuild and,
+    # with the pending ones, move to the unsold table.
+    ds = _folded(ds)
+    delta = ds.delta
+    keep = np.flatnonzero(ds.sales_arr > 0.0)
+    d_rows, d_offsets, d_times, _, d_ends, _ = delta.events
+    offsets, (times, ends) = _current_segments(
+        ds.offsets, (ds.times_flat, ds.end_flags), d_rows, d_offsets, (d_times, d_ends), keep)
+    starts = np.zeros(times.shape[0], dtype=np.float64)
+    filled = offsets[1:] > offsets[:-1]
+    starts[offsets[:-1][filled]] = _current_open(ds, delta.events, keep)[filled]
+    led_offsets, (led_times, led_sales, led_loss) = _current_segments(
+        ds.ledger_offsets, (ds.ledger_times, ds.ledger_sales, ds.ledger_loss),
+        delta.ledger[0], delta.ledger[1], delta.ledger[2:], keep)
+    base = _build_dataset(
+        [ds.codes[i] for i in keep], offsets, times + ds.epoch, starts, ends.astype(np.float64),
+        ds.sales_arr[keep], ds.price_arr[keep], ds.lossq_arr[keep],
+        ds.name_by_code, ds.group_by_code, ds.source,
+        ledger=(
+            led_offsets, led_times + ds.epoch,
+            _segment_values(led_sales, led_offsets), _segment_values(led_loss, led_offsets),
+            ds.base_sales[keep], ds.base_loss[keep],
+        ),
+        unsold=_unsold_after(ds, np.flatnonzero(ds.sales_arr <= 0.0)),
+    )
+    return replace(
+        base, generation=ds.generation,
+        journal=delta.log_offset,
+        delta=_Delta(base.version, _NO_EVENTS, _NO_LEDGER, {}, log_offset=delta.log_offset),
+    )
+
+
+async def _follow_appends() -> bool:
+
+    ds = _DATASET
+    if not APPEND_LOG or ds is None:
+        return False
+    try:
+        new = await asyncio.to_thread(_follow_log, ds)
+    except OSError:
+        return False
+    if new is ds:
+        return False
+    _install_dataset(new)
+    return True
+
+
+async def _compact_if_due() -> bool:
+
+    ds = _DATASET
+    if ds is None or not _compaction_due(ds):
+        return False
+    try:
+        if not APPEND_LOG:
+            # Batches exist only in the log, so without one appends wait
+            # for the rebuild instead of being replayed on top of it.
+            async with _appends_locked():
+                if _DATASET is not ds:
+                    return False
+                _install_dataset(await asyncio.to_thread(_compacted, ds))
+            return True
+        # Appends go on meanwhile; the ones that land during the rebuild
+        # are read back from the log on top of the new base.
+        compacted = await asyncio.to_thread(_compacted, ds)
+        async with _appends_locked():
+            current = _DATASET
+            if current is None or current.delta is None or current.delta.base_version != ds.delta.base_version:
+                return False
+            _install_dataset(await asyncio.to_thread(_follow_log, compacted))
+    except Exception:
+        # Keep serving base plus delta; the next tick tries again.
+        return False
+    try:
+        # Published; the snapshot takes over what the log folded into it.
+        await asyncio.to_thread(_save_compacted, compacted)
+    except Exception:
+        pass
+    return True
+
+
+async def watch_dumps(interval: float = RELOAD_INTERVAL) -> None:
+
+    # Also follows the append log (a reload starts it over on the new
+    # base) and compacts a delta that has grown too large.
+    while True:
+        await asyncio.sleep(interval)
+        async with _appends_locked():
+            if await _reload_if_changed():
+                await asyncio.to_thread(_rotate_log, _DATASET)
+            await _follow_appends()
+        await _compact_if_due()
+
+
+# Two codes in different groups, a spoilage write-off and dated sales:
+# enough to reach every kernel with the argument types of a real dataset.
+_PRECOMPILE_STOCK = [
+    {"НоменклатураКод": "1", "Номенклатура": "a", "Родитель": "g1", "Период": "01.01.2024 08:00:00",
+     "НачальныйОстаток": 0.0, "КонечныйОстаток": 5.0},
+    {"НоменклатураКод": "1", "Номенклатура": "a", "Родитель": "g1", "Период": "01.01.2024 20:00:00",
+     "НачальныйОстаток": 5.0, "КонечныйОстаток": 0.0, "СтатьяРасходов": SPOILAGE},
+    {"НоменклатураКод": "2", "Номенклатура": "b", "Родитель": "g2", "Период": "02.01.2024 09:00:00",
+     "НачальныйОстаток": 0.0, "КонечныйОстаток": 3.0},
+]
+_PRECOMPILE_SALES = [
+    {"Код": "1", "Номенклатура": "a", "Количество": 2.0, "Сумма": 20.0, "Период": "01.01.2024 10:00:00"},
+    {"Код": "2", "Номенклатура": "b", "Количество": 1.0, "Сумма": 5.0},
+]
+# An append touching a known code and bringing in a new one.
+_PRECOMPILE_APPEND_STOCK = [
+    {"НоменклатураКод": "2", "Период": "02.01.2024 18:00:00", "НачальныйОстаток": 3.0, "КонечныйОстаток": 0.0},
+    {"НоменклатураКод": "3", "Номенклатура": "c", "Родитель": "g3", "Период": "01.01.2024 12:00:00",
+     "НачальныйОстаток": 1.0, "КонечныйОстаток": 1.0},
+]
+_PRECOMPILE_APPEND_SALES = [
+    {"Код": "3", "Количество": 1.0, "Сумма": 50.0, "Период": "01.01.2024 13:00:00"},
+]
+
+
+def _jit_counts() -> Dict[str, int]:
+
+    loaded = compiled = 0
+    for module in (sys.modules[__name__], ingest):
+        for value in vars(module).values():
+            if isinstance(value, nb.core.dispatcher.Dispatcher):
+                loaded += sum(value.stats.cache_hits.values())
+                compiled += sum(value.stats.cache_misses.values())
+    return {"cached": loaded, "compiled": compiled}
+
+
+def precompile_kernels() -> Dict[str, int]:
+    global _metrics_parallel_min, _abc_parallel_min, _kernels_ready
+
+    # Runs every request path, parallel and serial variants alike, on a
+    # tiny dataset so that each kernel is loaded from the on-disk cache (or
+    # compiled into it) before the worker serves anything. Not safe once
+    # requests are running: it flips the parallel thresholds.
+    ingest._scan_json_array(np.frombuffer(orjson.dumps(_PRECOMPILE_STOCK), dtype=np.uint8), 0, False, False)
+    ds = _build_from_records(_PRECOMPILE_STOCK, _PRECOMPILE_SALES)
+    start_ts, end_ts = _parse_window("01.01.2024", "02.01.2024")
+    selection = _parse_selection({"ABC": "ABC", "Limit": 1})
+    saved = _metrics_parallel_min, _abc_parallel_min
+    try:
+        for threshold in (0, 1 << 62):
+            _metrics_parallel_min = _abc_parallel_min = threshold
+            _rows_body(ds, start_ts, end_ts, None)
+            _rows_body(ds, start_ts, end_ts, selection)
+            _rows_body(ds, start_ts, end_ts, selection, period=True)
+    finally:
+        _metrics_parallel_min, _abc_parallel_min = saved
+    _groups_body(ds, start_ts, end_ts)
+    labels, edges = _bucket_edges("01.01.2024", "02.01.2024", 1)
+    _series_body(ds, labels, edges, None)
+    _ranges_bodies(ds, [(start_ts, end_ts), (start_ts, end_ts + 3600.0)])
+    appended = _append_batch(ds, _PRECOMPILE_APPEND_STOCK, _PRECOMPILE_APPEND_SALES)
+    _rows_body(appended, start_ts, end_ts, selection, period=True)
+    _compacted(appended)
+    _kernels_ready = True
+    return _jit_counts()
+
+
+def readiness() -> Dict[str, Any]:
+    ds = _DATASET
+    return {
+        "kernels": _kernels_ready,
+        "dataset": ds is not None,
+        "codes": _row_count(ds) if ds is not None else 0,
+        "generation": ds.generation if ds is not None else 0,
+    }
+
+
+def warmup_numba(report: Dict[str, Any] | None = None) -> Dict[str, Any]:
+
+    # Fills report phase by phase, so when a phase raises the caller still
+    # has the timings of the ones before it.
+    report = {} if report is None else report
+    t0 = time.perf_counter()
+    report["kernels"] = {**precompile_kernels(), "seconds": time.perf_counter() - t0}
+
+    t0 = time.perf_counter()
+    ds = _load_dataset()
+    if APPEND_LOG:
+        # Batches appended before this worker started.
+        _rotate_log(ds)
+        ds = _folded(_follow_log(ds))
+    _install_dataset(ds)
+    # Snapshot and shared-memory arrays must hit the same compiled
+    # signatures; if they did not, this compiles now rather than on the
+    # first request.
+    start_ts = 1_700_000_000.0
+    _metrics_all(ds, start_ts, start_ts + 3600.0)
+    report["dataset"] = {
+        "codes": len(ds.codes), "events": int(ds.times_flat.shape[0]), "delta_events": _delta_size(ds.delta),
+        "generation": ds.generation, "seconds": time.perf_counter() - t0,
+    }
+
+    t0 = time.perf_counter()
+    report["calibrate"] = {**calibrate_kernels(), "seconds": time.perf_counter() - t0}
+    report["kernels"].update(_jit_counts())
+    return report
+
+
+def _parse_date(s: str) -> datetime | None:
+    for fmt in ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(s, fmt)
+        except Exception:
+            continue
+    return None
+
+
+_BUCKET_DAYS = {"day": 1, "week": 7}
+
+
+def _bucket_edges(start: Any, finish: Any, days: int) -> Tuple[List[str], np.ndarray] | None:
+    # Buckets start at local midnights, so a DST day is 23 or 25 hours
+    # long; the last bucket is clipped at the end of FinishDate. None for
+    # dates that do not parse, ValueError for more than SERIES_MAX_BUCKETS.
+    start_dt = _parse_date(str(start))
+    finish_dt = _parse_date(str(finish))
+    if start_dt is None or finish_dt is None:
+        return None
+    end_dt = finish_dt + timedelta(days=1)
+    labels: List[str] = []
+    edges: List[float] = []
+    current = start_dt
+    while current < end_dt:
+        if len(labels) >= SERIES_MAX_BUCKETS:
+            raise ValueError("too many buckets")
+        labels.append(current.strftime("%d.%m.%Y"))
+        edges.append(current.timestamp())
+        current += timedelta(days=days)
+    edges.append(end_dt.timestamp())
+    return labels, np.array(edges, dtype=np.float64)
+
+
+def _parse_window(start: Any, finish: Any) -> Tuple[float, float] | None:
+    # FinishDate is inclusive: the window runs to the start of the next day.
+    start_dt = _parse_date(str(start))
+    finish_dt = _parse_date(str(finish))
+    if start_dt is None or finish_dt is None:
+        return None
+    return float(start_dt.timestamp()), float((finish_dt + timedelta(days=1)).timestamp())
+
+
+# (groups, ABC letters, codes, offset, limit); None means "not filtered".
+Selection = Tuple[Tuple[str, ...] | None, str | None, Tuple[str, ...] | None, int, int | None]
+
+
+def _str_tuple(value: Any) -> Tuple[str, ...] | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return (value,)
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return tuple(value)
+    raise ValueError("expected a string or a list of strings")
+
+
+def _count(value: Any, default: int | None) -> int | None:
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError("expected a non-negative integer")
+    return value
+
+
+def _parse_selection(payload: Dict[str, Any]) -> Selection | None:
+
+    groups = _str_tuple(payload.get("Group"))
+    abc = _str_tuple(payload.get("ABC"))
+    letters = None
+    if abc is not None:
+        letters = "".join(sorted(set("".join(abc))))
+        if letters.strip("ABC"):
+            raise ValueError("unknown ABC class")
+    codes = _str_tuple(payload.get("Codes"))
+    offset = _count(payload.get("Offset"), 0)
+    limit = _count(payload.get("Limit"), None)
+    if groups is None and letters is None and codes is None and not offset and limit is None:
+        return None
+    return groups, letters, codes, offset, limit
+
+
+@telemetry.timed("select")
+def _select_rows(
+    ds: _Dataset, selection: Selection, order: np.ndarray | None = None, abc_codes: np.ndarray | None = None
+) -> np.ndarray:
+
+    # order/abc_codes replace the stored ranking when the request ranks by
+    # period sales; abc_codes is indexed by row like every dataset array.
+    groups, letters, codes, offset, limit = selection
+    if order is None:
+        order = ds.rank
+    mask = np.ones(len(ds.codes), dtype=np.bool_)
+    if groups is not None:
+        wanted = set(groups)
+        ids = [i for i, name in enumerate(ds.group_names) if name in wanted]
+        mask &= np.isin(ds.group_ids, np.array(ids, dtype=np.int32))
+    if letters is not None:
+        abc = ds.abc_arr if abc_codes is None else abc_codes
+        mask &= np.isin(abc, np.frombuffer(letters.encode(), dtype=np.uint8))
+    if codes is not None:
+        picked = np.zeros_like(mask)
+        picked[[ds.index_by_code[c] for c in codes if c in ds.index_by_code]] = True
+        mask &= picked
+    # Rows are stored in ABC rank order (unless appends re-ranked them), so
+    # the slice is the top of the list.
+    rows = np.flatnonzero(mask) if order is None else order[mask[order]]
+    stop = None if limit is None else offset + limit
+    return rows[offset:stop]
+
+
+# rows in output order, then ABC, Sales and spoilage quantities indexed by row.
+RowPlan = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
+def _ranked_rows(ds: _Dataset) -> np.ndarray:
+    return np.arange(len(ds.codes), dtype=np.int64) if ds.rank is None else ds.rank
+
+
+# Compute stages: everything CPU-bound of a request, run off the event loop.
+def _row_plan(
+    ds: _Dataset, start_ts: float, end_ts: float, selection: Selection | None, period: bool = False
+) -> RowPlan:
+
+    ds = _folded(ds)
+    if period:
+        # Sales, spoilage and therefore the ABC ranking of this window only;
+        # the price stays the all-time average.
+        sales, lossq = _window_totals(ds, start_ts, end_ts)
+        if ds.rank is None:
+            order, ranked_abc = assign_abc(sales)
+            order = order.astype(np.int64)
+        else:
+            # Ties keep the all-time order, as they do in rank-ordered memory.
+            order, ranked_abc = assign_abc(sales[ds.rank])
+            order = ds.rank[order]
+        abc_codes = np.empty_like(ranked_abc)
+        abc_codes[order] = ranked_abc
+        rows = order if selection is None else _select_rows(ds, selection, order, abc_codes)
+        return rows, abc_codes, sales, lossq
+
+    rows = _ranked_rows(ds) if selection is None else _select_rows(ds, selection)
+    return rows, ds.abc_arr, ds.sales_arr, ds.lossq_arr
+
+
+def _rows_result(
+    ds: _Dataset, start_ts: float, end_ts: float, selection: Selection | None, period: bool = False
+) -> RowsResult:
+
+    if selection is None and not period and ds.rank is None:
+        osa_res, loss_amounts, loss_percents = _metrics_all(ds, start_ts, end_ts)
+        return None, ds.abc_arr, ds.sales_arr, loss_amounts, loss_percents, osa_res
+
+    rows, abc_codes, sales, lossq = _row_plan(ds, start_ts, end_ts, selection, period)
+    osa_res, loss_amounts, loss_percents = _metrics_rows(ds, rows, start_ts, end_ts, sales, lossq)
+    return rows, abc_codes[rows], sales[rows], loss_amounts, loss_percents, osa_res
+
+
+def _subset_json(ds: _Dataset, result: RowsResult) -> bytes:
+    rows, abc_codes, sales, loss_amounts, loss_percents, osa_res = result
+    frag_offsets, frag_idx = _permute_csr(ds.row_frag_offsets, rows)
+    return _rows_json(
+        abc_codes, sales, loss_amounts, loss_percents, osa_res,
+        ds.row_fragments[frag_idx], frag_offsets, [ds.codes[i] for i in rows],
+        ds.name_by_code, ds.group_by_code
+    )
+
+
+def _rows_body(
+    ds: _Dataset, start_ts: float, end_ts: float, selection: Selection | None,
+    period: bool = False, media: str = JSON_MEDIA,
+) -> bytes:
+
+    ds = _folded(ds)
+    result = _rows_result(ds, start_ts, end_ts, selection, period)
+    if media != JSON_MEDIA:
+        return _COLUMN_WRITERS[media](ds, result)
+    rows, abc_codes, sales, loss_amounts, loss_percents, osa_res = result
+    if rows is None:
+        return _rows_json(
+            abc_codes, sales, loss_amounts, loss_percents, osa_res,
+            ds.row_fragments, ds.row_frag_offsets, ds.codes, ds.name_by_code, ds.group_by_code
+        )
+    return _subset_json(ds, result)
+
+
+def _rows_chunk(ds: _Dataset, plan: RowPlan, start_ts: float, end_ts: float, lo: int, hi: int) -> bytes:
+
+    ds = _folded(ds)
+    # Rows lo:hi of the plan, formatted without the enclosing brackets.
+    rows, abc_codes, sales, lossq = plan
+    part = rows[lo:hi]
+    osa_res, loss_amounts, loss_percents = _metrics_rows(ds, part, start_ts, end_ts, sales, lossq)
+    body = _subset_json(ds, (part, abc_codes[part], sales[part], loss_amounts, loss_percents, osa_res))
+    return body[1:-1]
+
+
+async def _stream_rows(ds: _Dataset, plan: RowPlan, start_ts: float, end_ts: float) -> AsyncIterator[bytes]:
+    # The next chunk is only computed once the previous one has been handed
+    # to the server, so at most one chunk per response is buffered.
+    yield b"["
+    for lo in range(0, plan[0].shape[0], STREAM_CHUNK_ROWS):
+        if lo:
+            yield b","
+        yield await _offload(_rows_chunk, ds, plan, start_ts, end_ts, lo, lo + STREAM_CHUNK_ROWS)
+    yield b"]"
+
+
+def _groups_body(ds: _Dataset, start_ts: float, end_ts: float) -> bytes:
+
+    ds = _folded(ds)
+    osa_res, loss_amounts, _ = _metrics_all(ds, start_ts, end_ts)
+    with telemetry.stage("format"):
+        return _groups_json(ds, osa_res, loss_amounts)
+
+
+def _groups_json(ds: _Dataset, osa_res: np.ndarray, loss_amounts: np.ndarray) -> bytes:
+
+    sales, loss, osa, abc_counts = _rollup_groups_numba(
+        ds.group_rows, ds.group_offsets, osa_res, loss_amounts, ds.sales_arr, ds.abc_arr
+    )
+
+    out = []
+    append = out.append
+    sizes = np.diff(ds.group_offsets)
+    for g in np.argsort(-sales, kind="stable"):
+        total = float(sales[g])
+        append({
+            "Group": ds.group_names[g],
+            "Codes": int(sizes[g]),
+            "Sales": round(total, 2),
+            "Loss": round(float(loss[g]), 2),
+            "LossOfProfit": round(float(loss[g]) / total * 100.0, 3) if total > 0.0 else 0.0,
+            "OSA": round(float(osa[g]), 2),
+            "ABC": {"A": int(abc_counts[g, 0]), "B": int(abc_counts[g, 1]), "C": int(abc_counts[g, 2])},
         })
+    return orjson.dumps(out)
+
+
+def _series_body(ds: _Dataset, labels: List[str], edges: np.ndarray, selection: Selection | None) -> bytes:
+
+    ds = _folded(ds)
+    rows = _ranked_rows(ds) if selection is None else _select_rows(ds, selection)
+    with telemetry.stage("metrics"):
+        osa = _compute_osa_buckets_numba(
+            ds.times_flat, ds.open_flags, ds.end_flags, ds.avail_prefix, ds.offsets, _event_delta(ds),
+            rows, edges - ds.epoch
+        )
+    # Columnar: one list of codes, one list of bucket labels and a codes x
+    # buckets matrix serialized straight from the kernel output.
+    with telemetry.stage("format"):
+        return orjson.dumps(
+            {
+                "Buckets": labels,
+                "Codes": [ds.codes[i] for i in rows],
+                "OSA": np.round(osa, 2),
+            },
+            option=orjson.OPT_SERIALIZE_NUMPY,
+        )
+
+
+def _ranges_bodies(ds: _Dataset, windows: List[Tuple[float, float]]) -> List[bytes]:
+
+    ds = _folded(ds)
+    edges = np.array(windows, dtype=np.float64) - ds.epoch
+    bounds, inverse = np.unique(edges.ravel(), return_inverse=True)
+    inverse = inverse.reshape(edges.shape).astype(np.int64)
+    with telemetry.stage("metrics"):
+        osa_res, loss_amounts, loss_percents = _compute_metrics_numba_ranges(
+            ds.times_flat, ds.open_flags, ds.end_flags, ds.avail_prefix, ds.offsets, _event_delta(ds),
+            bounds, inverse[:, 0].copy(), inverse[:, 1].copy(),
+            ds.sales_arr, ds.price_arr, ds.lossq_arr
+        )
+    if ds.rank is not None:
+        rank = ds.rank
+        return [
+            _subset_json(ds, (
+                rank, ds.abc_arr[rank], ds.sales_arr[rank],
+                loss_amounts[rank], loss_percents[rank], osa_res[r][rank],
+            ))
+            for r in range(len(windows))
+        ]
+    return [
+        _rows_json(
+            ds.abc_arr, ds.sales_arr, loss_amounts, loss_percents, osa_res[r],
+            ds.row_fragments, ds.row_frag_offsets, ds.codes, ds.name_by_code, ds.group_by_code
+        )
+        for r in range(len(windows))
+    ]
+
+
+async def _parse_request(request: Request, admin: bool = False) -> Tuple[Dict[str, Any], float] | Response:
+
+    # Shared start of the endpoints: the JSON object body and the time spent
+    # decoding it, or the 400/403 response to send instead. The analytics
+    # user gets the read endpoints, ANALYTICS_ADMIN_IDS the admin ones.
+    raw = await request.body()
+    t0 = time.perf_counter()
+    try:
+        payload = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return ORJSONResponse({"error": "invalid json"}, status_code=400)
+    if not isinstance(payload, dict):
+        return ORJSONResponse({"error": "invalid json"}, status_code=400)
+    parse_s = time.perf_counter() - t0
+
+    token = str(payload.get("token", ""))
+    if admin:
+        if not is_admin(token):
+            return ORJSONResponse({"error": "Forbidden"}, status_code=403)
+    elif get_user_id_from_file(token) != 1:
+        return ORJSONResponse({"error": "InvalidId"}, status_code=403)
+    return payload, parse_s
+
+
+@router.post("/")
+async def item_analytics(request: Request) -> Response:
+
+    parsed = await _parse_request(request)
+    if isinstance(parsed, Response):
+        return parsed
+    payload, parse_s = parsed
+    t0 = time.perf_counter()
+
+    window = _parse_window(payload.get("StartDate", ""), payload.get("FinishDate", ""))
+    if window is None:
+        return ORJSONResponse({"error": "invalid dates"}, status_code=400)
+    start_ts, end_ts = window
+
+    try:
+        selection = _parse_selection(payload)
+    except ValueError:
+        return ORJSONResponse({"error": "invalid filters"}, status_code=400)
+    period = payload.get("PeriodSales", False)
+    if not isinstance(period, bool):
+        return ORJSONResponse({"error": "invalid filters"}, status_code=400)
+    media = _negotiate(request.headers.get("accept", ""))
+    if media is None:
+        return ORJSONResponse({"error": "Arrow output needs pyarrow"}, status_code=406)
+    stream = payload.get("Stream", False)
+    if not isinstance(stream, bool):
+        return ORJSONResponse({"error": "invalid filters"}, status_code=400)
+
+    telemetry.note("parse", parse_s + time.perf_counter() - t0)
+
+    ds = _DATASET
+    if ds is None:
+        return ORJSONResponse({"error": "data not loaded"}, status_code=500)
+
+    cache_key: CacheKey = (start_ts, end_ts, ds.version)
+    if selection is not None or period:
+        cache_key += (selection, period)
+    if media != JSON_MEDIA:
+        cache_key += (media,)
+    body = _cache_get(cache_key)
+    if body is not None:
+        return Response(content=body, media_type=media)
+
+    if stream and media == JSON_MEDIA:
+        # Streamed bodies are never assembled whole, so they are not cached.
+        plan = await _offload(_row_plan, ds, start_ts, end_ts, selection, period)
+        return StreamingResponse(_stream_rows(ds, plan, start_ts, end_ts), media_type=media)
+
+    body = await _offload(_rows_body, ds, start_ts, end_ts, selection, period, media)
+    _cache_put(cache_key, body)
+    return Response(content=body, media_type=media)
+
+
+@router.post("/groups")
+async def item_analytics_groups(request: Request) -> Response:
+
+    parsed = await _parse_request(request)
+    if isinstance(parsed, Response):
+        return parsed
+    payload, parse_s = parsed
+    t0 = time.perf_counter()
+
+    window = _parse_window(payload.get("StartDate", ""), payload.get("FinishDate", ""))
+    if window is None:
+        return ORJSONResponse({"error": "invalid dates"}, status_code=400)
+    start_ts, end_ts = window
+
+    telemetry.note("parse", parse_s + time.perf_counter() - t0)
+
+    ds = _DATASET
+    if ds is None:
+        return ORJSONResponse({"error": "data not loaded"}, status_code=500)
+
+    cache_key: CacheKey = (start_ts, end_ts, ds.version, "groups")
+    body = _cache_get(cache_key)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+
+    body = await _offload(_groups_body, ds, start_ts, end_ts)
+    _cache_put(cache_key, body)
+    return Response(content=body, media_type="application/json")
+
 
-    return ORJSONResponse(out, status_code=200)
+@router.post("/series")
+async def item_analytics_series(request: Request) -> Response:
+
+    parsed = await _parse_request(request)
+    if isinstance(parsed, Response):
+        return parsed
+    payload, parse_s = parsed
+    t0 = time.perf_counter()
+
+    bucket = payload.get("Bucket", "day")
+    if bucket not in _BUCKET_DAYS:
+        return ORJSONResponse({"error": "invalid bucket"}, status_code=400)
+    try:
+        buckets = _bucket_edges(payload.get("StartDate", ""), payload.get("FinishDate", ""), _BUCKET_DAYS[bucket])
+    except ValueError:
+        return ORJSONResponse({"error": f"too many buckets (at most {SERIES_MAX_BUCKETS})"}, status_code=400)
+    if buckets is None:
+        return ORJSONResponse({"error": "invalid dates"}, status_code=400)
+    labels, edges = buckets
+
+    try:
+        selection = _parse_selection(payload)
+    except ValueError:
+        return ORJSONResponse({"error": "invalid filters"}, status_code=400)
+
+    telemetry.note("parse", parse_s + time.perf_counter() - t0)
+
+    ds = _DATASET
+    if ds is None:
+        return ORJSONResponse({"error": "data not loaded"}, status_code=500)
+
+    cache_key: CacheKey = (float(edges[0]), float(edges[-1]), ds.version, "series", bucket, selection)
+    body = _cache_get(cache_key)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
+
+    body = await _offload(_series_body, ds, labels, edges, selection)
+    _cache_put(cache_key, body)
+    return Response(content=body, media_type="application/json")
+
+
+@router.post("/batch")
+async def item_analytics_batch(request: Request) -> Response:
+
+    parsed = await _parse_request(request)
+    if isinstance(parsed, Response):
+        return parsed
+    payload, parse_s = parsed
+    t0 = time.perf_counter()
+
+    ranges = payload.get("Ranges")
+    if not isinstance(ranges, list) or not ranges:
+        return ORJSONResponse({"error": "invalid ranges"}, status_code=400)
+    if len(ranges) > BATCH_MAX_RANGES:
+        return ORJSONResponse({"error": "too many ranges"}, status_code=400)
+
+    # Keyed by the dates as sent; a range repeated in the request is
+    # answered once, so the response object has no duplicate keys.
+    windows: Dict[str, Tuple[float, float]] = {}
+    for item in ranges:
+        if not isinstance(item, dict):
+            return ORJSONResponse({"error": "invalid ranges"}, status_code=400)
+        start_s = str(item.get("StartDate", ""))
+        finish_s = str(item.get("FinishDate", ""))
+        window = _parse_window(start_s, finish_s)
+        if window is None:
+            return ORJSONResponse({"error": "invalid dates"}, status_code=400)
+        windows[f"{start_s}-{finish_s}"] = window
+
+    telemetry.note("parse", parse_s + time.perf_counter() - t0)
+
+    ds = _DATASET
+    if ds is None:
+        return ORJSONResponse({"error": "data not loaded"}, status_code=500)
+
+    # Ranges share cache entries with single-range requests; only the
+    # missing ones go to the kernel, all in the same launch.
+    bodies: Dict[Tuple[float, float], bytes] = {}
+    missing: List[Tuple[float, float]] = []
+    for window in dict.fromkeys(windows.values()):
+        body = _cache_get((window[0], window[1], ds.version))
+        if body is None:
+            missing.append(window)
+        else:
+            bodies[window] = body
+
+    if missing:
+        computed = await _offload(_ranges_bodies, ds, missing)
+        for window, body in zip(missing, computed):
+            _cache_put((window[0], window[1], ds.version), body)
+            bodies[window] = body
+
+    parts = [orjson.dumps(key) + b":" + bodies[window] for key, window in windows.items()]
+    return Response(content=b"{" + b",".join(parts) + b"}", media_type="application/json")
+
+
+@router.post("/append")
+async def item_analytics_append(request: Request) -> Response:
+
+    parsed = await _parse_request(request, admin=True)
+    if isinstance(parsed, Response):
+        return parsed
+    payload, parse_s = parsed
+
+    stock = payload.get("Stock", [])
+    sales = payload.get("Sales", [])
+    if not isinstance(stock, list) or not isinstance(sales, list):
+        return ORJSONResponse({"error": "invalid records"}, status_code=400)
+    if len(stock) + len(sales) > APPEND_MAX_RECORDS:
+        return ORJSONResponse({"error": "too many records"}, status_code=400)
+
+    telemetry.note("parse", parse_s)
+
+    if _DATASET is None:
+        return ORJSONResponse({"error": "data not loaded"}, status_code=500)
+
+    # One append at a time per worker; requests in flight keep the
+    # snapshot they started with.
+    async with _appends_locked():
+        try:
+            ds = await asyncio.to_thread(_append_logged, _DATASET, stock, sales)
+        except (ValueError, TypeError):
+            return ORJSONResponse({"error": "invalid records"}, status_code=400)
+        except OSError:
+            return ORJSONResponse({"error": "append log unavailable"}, status_code=503)
+        _install_dataset(ds)
+
+    return ORJSONResponse({
+        "Stock": len(stock),
+        "Sales": len(sales),
+        "Codes": _row_count(ds),
+        "DeltaEvents": _delta_size(ds.delta),
+        "Pending": len(ds.delta.pending),
+    })
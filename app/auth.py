@@ -12,6 +12,7 @@ from fastapi.responses import ORJSONResponse
 
 from cachetools import TTLCache
 
+from .telemetry import stage
 from .userid import get_user_id_from_file
 
 router = APIRouter(prefix="/auth", tags=["auth"])
@@ -75,8 +76,10 @@ def _verify_token(token: str) -> Optional[dict]:
 def get_token(body: dict):
     email = str(body.get("email", ""))
     password = str(body.get("password", ""))
-    token = _create_token(email, password)
-    if _verify_token(token) is None:
+    with stage("token"):
+        token = _create_token(email, password)
+        verified = _verify_token(token) is not None
+    if not verified:
         return ORJSONResponse({"error": "Invalid credentials"}, status_code=403)
 
     user_id = get_user_id_from_file(token)
@@ -0,0 +1,492 @@
+from __future__ import annotations
+
+import os
+import itertools
+from typing import Any, Dict, Iterator, List, Tuple
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import numpy as np
+import numba as nb
+import orjson
+
+STREAM_CHUNK_BYTES = int(os.getenv("ANALYTICS_STREAM_CHUNK_BYTES", str(8 * 1024 * 1024)))
+
+NO_GROUP = "Без группы 🤔"
+SPOILAGE = "Порча на складах (94)"
+
+CsrParts = Tuple[
+    List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+    np.ndarray, np.ndarray, np.ndarray, Dict[str, str], Dict[str, str],
+]
+# offsets, times, sales sums, spoilage quantities of dated entries grouped per
+# code in time order, then per-code totals of the undated sales and spoilage.
+LedgerParts = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+# What csr() leaves out, for codes without positive sales: the codes; offsets,
+# times, start and end levels of their stock events; offsets, times (NaN when
+# undated), sales and spoilage of their ledger entries, both grouped per code
+# in dump order; per-code sales totals, quantities and spoilage quantities;
+# stock names, sales names and groups (None where no such record was seen).
+UnsoldParts = Tuple[
+    List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+    np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+    np.ndarray, np.ndarray, np.ndarray, List[Any], List[Any], List[Any],
+]
+
+
+def _parse_dt(val: str) -> datetime | None:
+    for fmt in ("%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(val, fmt)
+        except Exception:
+            continue
+    return None
+
+
+@nb.njit(cache=True)
+def _scan_json_array(buf: np.ndarray, depth: int, in_str: bool, esc: bool):
+    # Finds the span of complete top-level elements of a JSON array inside
+    # buf. When the buffer ends inside an element, scanning resumes from that
+    # element's first byte once more data has been read.
+    first = -1
+    last = -1
+    elem_start = -1
+    n = buf.shape[0]
+    for k in range(n):
+        c = buf[k]
+        if in_str:
+            if esc:
+                esc = False
+            elif c == 92:
+                esc = True
+            elif c == 34:
+                in_str = False
+            continue
+        if c == 34:
+            in_str = True
+        elif c == 123 or c == 91:
+            if depth == 1:
+                elem_start = k
+            depth += 1
+        elif c == 125 or c == 93:
+            depth -= 1
+            if depth == 1:
+                if first < 0:
+                    first = elem_start
+                last = k + 1
+
+    if depth >= 2:
+        return first, last, elem_start, 1, False, False
+    return first, last, n, depth, in_str, esc
+
+
+@nb.njit(cache=True, inline="always")
+def _read_int(row, pos: int, end: int, max_digits: int):
+    value = 0
+    k = pos
+    while k < end and k - pos < max_digits and 48 <= row[k] <= 57:
+        value = value * 10 + (row[k] - 48)
+        k += 1
+    return value, k - pos
+
+
+@nb.njit(cache=True, inline="always")
+def _days_from_civil(y: int, m: int, d: int) -> int:
+    y -= m <= 2
+    era = (y if y >= 0 else y - 399) // 400
+    yoe = y - era * 400
+    doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+@nb.njit(cache=True, parallel=True)
+def _parse_periods(chars: np.ndarray, lengths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Parses "dd.mm.YYYY[ HH:MM[:SS]]" rows of UCS-4 code points into naive
+    # epoch seconds. status: 1 parsed, 2 empty, 0 left for _parse_dt (odd
+    # whitespace, non-ASCII digits, out-of-range fields ...).
+    n = chars.shape[0]
+    naive = np.zeros(n, dtype=np.float64)
+    status = np.zeros(n, dtype=np.uint8)
+    mdays = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+    for r in nb.prange(n):
+        row = chars[r]
+        end = lengths[r]
+        if end == 0:
+            status[r] = 2
+            continue
+
+        day, nd = _read_int(row, 0, end, 2)
+        pos = nd
+        if nd == 0 or pos >= end or row[pos] != 46:
+            continue
+        month, nm = _read_int(row, pos + 1, end, 2)
+        pos += 1 + nm
+        if nm == 0 or pos >= end or row[pos] != 46:
+            continue
+        year, ny = _read_int(row, pos + 1, end, 4)
+        pos += 1 + ny
+        if ny != 4:
+            continue
+
+        hour = 0
+        minute = 0
+        second = 0
+        if pos < end:
+            if row[pos] != 32:
+                continue
+            while pos < end and row[pos] == 32:
+                pos += 1
+            hour, nh = _read_int(row, pos, end, 2)
+            pos += nh
+            if nh == 0 or pos >= end or row[pos] != 58:
+                continue
+            minute, nmi = _read_int(row, pos + 1, end, 2)
+            pos += 1 + nmi
+            if nmi == 0:
+                continue
+            if pos < end:
+                if row[pos] != 58:
+                    continue
+                second, ns = _read_int(row, pos + 1, end, 2)
+                pos += 1 + ns
+                if ns == 0 or pos != end:
+                    continue
+
+        if month < 1 or month > 12 or year < 1 or day < 1:
+            continue
+        dim = mdays[month - 1]
+        if month == 2 and (year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)):
+            dim = 29
+        if day > dim or hour > 23 or minute > 59 or second > 59:
+            continue
+
+        naive[r] = (
+            _days_from_civil(year, month, day) * 86400.0 +
+            hour * 3600.0 + minute * 60.0 + second
+        )
+        status[r] = 1
+    return naive, status
+
+
+def _local_timestamps(naive: np.ndarray) -> np.ndarray:
+    # Same result as datetime.timestamp() on the naive value: the local UTC
+    # offset is looked up once per distinct 15-minute slot, the granularity
+    # of every zone's offsets and transitions.
+    if naive.shape[0] == 0:
+        return naive
+    slots = naive // 900.0
+    uniq, inv = np.unique(slots, return_inverse=True)
+    epoch = datetime(1970, 1, 1)
+    shift = np.array([
+        (epoch + timedelta(seconds=q * 900)).timestamp() - q * 900.0
+        for q in uniq.astype(np.int64).tolist()
+    ], dtype=np.float64)
+    return naive + shift[inv.reshape(-1)]
+
+
+def parse_periods(values: List[str]) -> np.ndarray:
+
+    n = len(values)
+    if n == 0:
+        return np.empty(0, dtype=np.float64)
+    text = np.array(values, dtype=str)
+    width = text.dtype.itemsize // 4
+    chars = text.view(np.uint32).reshape(n, width)
+    lengths = np.fromiter(map(len, values), dtype=np.int64, count=n)
+
+    naive, status = _parse_periods(chars, lengths)
+    out = np.full(n, np.nan, dtype=np.float64)
+    ok = status == 1
+    out[ok] = _local_timestamps(naive[ok])
+    for r in np.flatnonzero(status == 0).tolist():
+        dt = _parse_dt(values[r])
+        if dt is not None:
+            out[r] = dt.timestamp()
+    return out
+
+
+def iter_json_batches(path: str, chunk_size: int = STREAM_CHUNK_BYTES) -> Iterator[List[Dict[str, Any]]]:
+
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        head = f.read(chunk_size)
+        if not head.lstrip().startswith(b"["):
+            return
+
+        depth, in_str, esc = 0, False, False
+        tail = b""
+        chunk = head
+        while chunk:
+            data = tail + chunk if tail else chunk
+            first, last, resume, depth, in_str, esc = _scan_json_array(
+                np.frombuffer(data, dtype=np.uint8), depth, in_str, esc)
+            if first >= 0:
+                batch = orjson.loads(b"[" + data[first:last] + b"]")
+                yield [rec for rec in batch if isinstance(rec, dict)]
+            tail = data[resume:]
+            chunk = f.read(chunk_size)
+
+    if depth != 0 or tail.strip():
+        raise ValueError(f"truncated JSON array in {path}")
+
+
+class ColumnBuffer:
+    __slots__ = ("data", "size")
+
+    def __init__(self, dtype: Any, capacity: int = 4096) -> None:
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values: Any) -> None:
+        values = np.asarray(values, dtype=self.data.dtype)
+        need = self.size + values.shape[0]
+        if need > self.data.shape[0]:
+            grown = np.empty(max(need, self.data.shape[0] * 3 // 2), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:need] = values
+        self.size = need
+
+    def view(self) -> np.ndarray:
+        return self.data[:self.size]
+
+
+def _segments(offsets: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Flat index of the CSR segments of rows, laid end to end, and their lengths.
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if lengths.size else 0, dtype=np.int64) + np.repeat(starts - ends + lengths, lengths), lengths
+
+
+def _grouped(pos: np.ndarray, n_codes: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Entries with pos >= 0 grouped by pos, keeping their order within a code.
+    idx = np.flatnonzero(pos >= 0)
+    idx = idx[np.argsort(pos[idx], kind="stable")]
+    offsets = np.zeros(n_codes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pos[idx], minlength=n_codes), out=offsets[1:])
+    return idx, offsets
+
+
+class DumpIngest:
+
+    def __init__(self) -> None:
+        self.code_ids: Dict[str, int] = {}
+        self.ev_code = ColumnBuffer(np.int32)
+        self.ev_time = ColumnBuffer(np.float64)
+        self.ev_start = ColumnBuffer(np.float64)
+        self.ev_end = ColumnBuffer(np.float64)
+        self.loss_qty: Dict[str, float] = defaultdict(float)
+        self.name_by_code: Dict[str, str] = {}
+        self.group_by_code: Dict[str, str] = {}
+        self.sales_sum: Dict[str, float] = defaultdict(float)
+        self.sales_qty: Dict[str, float] = defaultdict(float)
+        self.name_sales: Dict[str, str] = {}
+        self.led_code = ColumnBuffer(np.int32)
+        self.led_time = ColumnBuffer(np.float64)
+        self.led_sales = ColumnBuffer(np.float64)
+        self.led_loss = ColumnBuffer(np.float64)
+
+    def _code_id(self, code: str) -> int:
+        cid = self.code_ids.get(code)
+        if cid is None:
+            cid = len(self.code_ids)
+            self.code_ids[code] = cid
+        return cid
+
+    def add_stock(self, batch: List[Dict[str, Any]]) -> None:
+
+        codes = [str(item.get("НоменклатураКод", "")).strip() for item in batch]
+        keep = [k for k, code in enumerate(codes) if code]
+        if not keep:
+            return
+        if len(keep) != len(codes):
+            batch = [batch[k] for k in keep]
+            codes = [codes[k] for k in keep]
+
+        self.name_by_code.update(zip(codes, [item.get("Номенклатура") for item in batch]))
+        self.group_by_code.update(zip(codes, [item.get("Родитель") or NO_GROUP for item in batch]))
+
+        starts = np.array([float(item.get("НачальныйОстаток", 0) or 0.0) for item in batch])
+        ends = np.array([float(item.get("КонечныйОстаток", 0) or 0.0) for item in batch])
+        times = parse_periods([str(item.get("Период", "")) for item in batch])
+
+        spoiled = []
+        for k, item in enumerate(batch):
+            if item.get("СтатьяРасходов") == SPOILAGE and starts[k] - ends[k] > 0.0:
+                self.loss_qty[codes[k]] += starts[k] - ends[k]
+                spoiled.append(k)
+        if spoiled:
+            self._add_ledger(
+                [codes[k] for k in spoiled], times[spoiled], np.zeros(len(spoiled)),
+                starts[spoiled] - ends[spoiled])
+
+        has_event = np.flatnonzero(~np.isnan(times))
+        if has_event.shape[0] == 0:
+            return
+        uniq, inv = np.unique(np.array(codes, dtype=str)[has_event], return_inverse=True)
+        ids = np.array([self._code_id(code) for code in uniq.tolist()], dtype=np.int32)
+
+        self.ev_code.extend(ids[inv.reshape(-1)])
+        self.ev_time.extend(times[has_event])
+        self.ev_start.extend(starts[has_event])
+        self.ev_end.extend(ends[has_event])
+
+    def add_sales(self, batch: List[Dict[str, Any]]) -> None:
+
+        codes: List[str] = []
+        sums: List[float] = []
+        kept: List[Dict[str, Any]] = []
+        for rec in batch:
+            code = str(rec.get("Код", "")).strip()
+            if not code:
+                continue
+            total = float(rec.get("Сумма", 0) or 0.0)
+            self.name_sales[code] = rec.get("Номенклатура")
+            self.sales_sum[code] += total
+            self.sales_qty[code] += float(rec.get("Количество", 0) or 0.0)
+            codes.append(code)
+            sums.append(total)
+            kept.append(rec)
+
+        if not codes:
+            return
+        if any("Период" in rec for rec in kept):
+            times = parse_periods([str(rec.get("Период", "")) for rec in kept])
+        else:
+            times = np.full(len(codes), np.nan)
+        self._add_ledger(codes, times, np.array(sums), np.zeros(len(codes)))
+
+    def _add_ledger(self, codes: List[str], times: np.ndarray, sales: np.ndarray, loss: np.ndarray) -> None:
+
+        uniq, inv = np.unique(np.array(codes, dtype=str), return_inverse=True)
+        ids = np.array([self._code_id(code) for code in uniq.tolist()], dtype=np.int32)
+        self.led_code.extend(ids[inv.reshape(-1)])
+        self.led_time.extend(times)
+        self.led_sales.extend(sales)
+        self.led_loss.extend(loss)
+
+    def _positions(self, codes: List[str]) -> np.ndarray:
+        pos_by_id = np.full(len(self.code_ids), -1, dtype=np.int64)
+        for i, code in enumerate(codes):
+            cid = self.code_ids.get(code)
+            if cid is not None:
+                pos_by_id[cid] = i
+        return pos_by_id
+
+    def ledger(self, codes: List[str]) -> LedgerParts:
+
+        n_codes = len(codes)
+        pos = self._positions(codes)[self.led_code.view()]
+        times = self.led_time.view()
+        sales = self.led_sales.view()
+        loss = self.led_loss.view()
+        undated = (pos >= 0) & np.isnan(times)
+        base_sales = np.bincount(pos[undated], weights=sales[undated], minlength=n_codes)
+        base_loss = np.bincount(pos[undated], weights=loss[undated], minlength=n_codes)
+
+        idx = np.flatnonzero((pos >= 0) & ~np.isnan(times))
+        idx = idx[np.lexsort((times[idx], pos[idx]))]
+        offsets = np.zeros(n_codes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pos[idx], minlength=n_codes), out=offsets[1:])
+        return offsets, times[idx], sales[idx], loss[idx], base_sales, base_loss
+
+    def events(self, codes: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+
+        # Stock events of the given codes as offsets, times, start and end
+        # levels, grouped per code in time order.
+        n_codes = len(codes)
+        ev_time = self.ev_time.view()
+        ev_pos = self._positions(codes)[self.ev_code.view()]
+        idx = np.flatnonzero(ev_pos >= 0)
+        # np.lexsort is stable, so same-time events keep their dump order
+        # exactly like the per-code list.sort() did.
+        idx = idx[np.lexsort((ev_time[idx], ev_pos[idx]))]
+
+        offsets = np.zeros(n_codes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ev_pos[idx], minlength=n_codes), out=offsets[1:])
+        return offsets, ev_time[idx], self.ev_start.view()[idx], self.ev_end.view()[idx]
+
+    def unsold(self, sold: List[str]) -> UnsoldParts:
+
+        # Everything known about the codes that are not in sold, so that a
+        # later add_unsold() can bring them back when appends make them sell.
+        sold_set = set(sold)
+        codes = [code for code in dict.fromkeys(itertools.chain(self.name_by_code, self.sales_sum))
+                 if code not in sold_set]
+        pos = self._positions(codes)
+        ev_idx, ev_offsets = _grouped(pos[self.ev_code.view()], len(codes))
+        led_idx, led_offsets = _grouped(pos[self.led_code.view()], len(codes))
+        return (
+            codes, ev_offsets, self.ev_time.view()[ev_idx],
+            self.ev_start.view()[ev_idx], self.ev_end.view()[ev_idx],
+            led_offsets, self.led_time.view()[led_idx],
+            self.led_sales.view()[led_idx], self.led_loss.view()[led_idx],
+            np.array([self.sales_sum.get(code, 0.0) for code in codes], dtype=np.float64),
+            np.array([self.sales_qty.get(code, 0.0) for code in codes], dtype=np.float64),
+            np.array([self.loss_qty.get(code, 0.0) for code in codes], dtype=np.float64),
+            [self.name_by_code.get(code) for code in codes],
+            [self.name_sales.get(code) for code in codes],
+            [self.group_by_code.get(code) for code in codes],
+        )
+
+    def add_unsold(self, parts: UnsoldParts, rows: List[int]) -> None:
+
+        # Seeds the given rows of unsold() parts; records added afterwards
+        # combine with them as if they followed in the dumps.
+        if not rows:
+            return
+        (codes, ev_offsets, ev_times, ev_starts, ev_ends, led_offsets, led_times, led_sales, led_loss,
+         sales, qty, loss_qty, names, sale_names, groups) = parts
+        at = np.array(rows, dtype=np.int64)
+        ids = np.array([self._code_id(codes[r]) for r in rows], dtype=np.int32)
+        idx, lengths = _segments(ev_offsets, at)
+        self.ev_code.extend(np.repeat(ids, lengths))
+        self.ev_time.extend(ev_times[idx])
+        self.ev_start.extend(ev_starts[idx])
+        self.ev_end.extend(ev_ends[idx])
+        idx, lengths = _segments(led_offsets, at)
+        self.led_code.extend(np.repeat(ids, lengths))
+        self.led_time.extend(led_times[idx])
+        self.led_sales.extend(led_sales[idx])
+        self.led_loss.extend(led_loss[idx])
+        for r in rows:
+            code = codes[r]
+            self.sales_sum[code] += float(sales[r])
+            self.sales_qty[code] += float(qty[r])
+            if loss_qty[r]:
+                self.loss_qty[code] += float(loss_qty[r])
+            if groups[r] is not None:
+                self.name_by_code[code] = names[r]
+                self.group_by_code[code] = groups[r]
+            if sale_names[r] is not None:
+                self.name_sales[code] = sale_names[r]
+
+    def csr(self) -> CsrParts:
+
+        codes = [code for code, total in self.sales_sum.items() if total > 0.0]
+        n_codes = len(codes)
+        offsets, times_flat, starts_flat, ends_flat = self.events(codes)
+
+        sales_arr = np.empty(n_codes, dtype=np.float64)
+        price_arr = np.empty(n_codes, dtype=np.float64)
+        loss_arr = np.empty(n_codes, dtype=np.float64)
+        name_by_code = self.name_by_code
+        group_by_code = self.group_by_code
+        for i, code in enumerate(codes):
+            total = self.sales_sum[code]
+            qty = self.sales_qty[code]
+            sales_arr[i] = total
+            price_arr[i] = (total / qty) if qty > 0.0 else 0.0
+            loss_arr[i] = self.loss_qty.get(code, 0.0)
+            name_by_code[code] = self.name_sales.get(code) or name_by_code.get(code) or code
+            if code not in group_by_code:
+                group_by_code[code] = NO_GROUP
+
+        return (
+            codes, offsets, times_flat, starts_flat, ends_flat,
+            sales_arr, price_arr, loss_arr, name_by_code, group_by_code,
+        )
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import os
+from importlib.metadata import PackageNotFoundError, version
+
+# Imported by app/__init__.py before anything imports numba. numba reads
+# the CPU target and thread count once, at import, and a cache=True kernel
+# picks its cache directory when it is decorated, so setting these later
+# (e.g. in the FastAPI lifespan) is too late.
+os.environ.setdefault("NUMBA_CPU_NAME", "haswell")
+os.environ.setdefault("NUMBA_THREADING_LAYER", "tbb")
+os.environ.setdefault("NUMBA_NUM_THREADS", str(min(10, os.cpu_count() or 1)))
+
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+os.environ.setdefault("MKL_DYNAMIC", "FALSE")
+
+CACHE_ROOT = os.getenv(
+    "ANALYTICS_JIT_CACHE_DIR", os.path.join(os.path.dirname(__file__), "..", ".numba-cache")
+)
+
+
+def cpu_target() -> str:
+
+    cpu = os.environ.get("NUMBA_CPU_NAME", "")
+    if cpu in ("", "host"):
+        from llvmlite import binding
+
+        cpu = binding.get_host_cpu_name()
+    return cpu
+
+
+def cache_key() -> str:
+
+    # Machine code is only valid for the CPU it was built for, and numba
+    # rewrites a cache index written by another numba version; one
+    # directory per (target, version) lets hosts and images share a root.
+    try:
+        numba_version = version("numba")
+    except PackageNotFoundError:
+        numba_version = "unknown"
+    return f"{cpu_target()}-numba{numba_version}"
+
+
+def cache_dir() -> str:
+    return os.environ.get("NUMBA_CACHE_DIR", "")
+
+
+if CACHE_ROOT and "NUMBA_CACHE_DIR" not in os.environ:
+    os.environ["NUMBA_CACHE_DIR"] = os.path.abspath(os.path.join(CACHE_ROOT, cache_key()))
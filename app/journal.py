@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import os
+import fcntl
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Tuple
+
+import orjson
+
+# Append log shared by the workers: one JSON object per line, each written
+# with a single O_APPEND write. Readers only take lines up to the last
+# newline, so a line still being written is picked up on the next read.
+#
+# The first line is a header. Offsets are logical: they count entry bytes
+# from the creation of the log, and "start" is the logical offset of the
+# first entry the file still holds, so offsets stay valid when rotate()
+# drops a prefix. "folded" is how far the entries of "source" were folded
+# into a saved dataset, which a reader behind it has to load instead.
+
+HEADER_KEY = "journal"
+_NO_HEADER = {HEADER_KEY: 1, "start": 0, "folded": 0, "source": None}
+
+
+@contextmanager
+def locked(path: str) -> Iterator[None]:
+
+    # Serialises appends and rotations across workers. The kernel drops a
+    # flock when its holder dies, so nobody waits on a stale lock, and a
+    # failure to lock raises instead of letting a writer in unlocked.
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _read_header(f: BinaryIO) -> Tuple[Dict[str, Any], int]:
+
+    # Header and its length in bytes, leaving f after it. Logs written
+    # before headers existed read as starting at 0 for any source.
+    line = f.readline()
+    try:
+        header = orjson.loads(line) if line.endswith(b"\n") else None
+    except orjson.JSONDecodeError:
+        header = None
+    if not isinstance(header, dict) or HEADER_KEY not in header:
+        f.seek(0)
+        return dict(_NO_HEADER), 0
+    return header, len(line)
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "rb") as f:
+            return _read_header(f)[0]
+    except FileNotFoundError:
+        return dict(_NO_HEADER)
+
+
+def read_entries(path: str, offset: int) -> Tuple[Dict[str, Any], List[Dict[str, Any]], int]:
+
+    # Header, entries after offset and the offset to continue from. An
+    # offset before the start of the file continues from the start, one
+    # past its end means the log was replaced and is read from the start.
+    try:
+        with open(path, "rb") as f:
+            header, head_len = _read_header(f)
+            start = header["start"]
+            pos = head_len + offset - start
+            if pos < head_len or pos > os.fstat(f.fileno()).st_size:
+                pos = head_len
+            f.seek(pos)
+            data = f.read()
+    except FileNotFoundError:
+        return dict(_NO_HEADER), [], 0
+    end = data.rfind(b"\n") + 1
+    entries: List[Dict[str, Any]] = []
+    for line in data[:end].splitlines():
+        if not line.strip():
+            continue
+        try:
+            entry = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            continue
+        if isinstance(entry, dict):
+            entries.append(entry)
+    return header, entries, start + pos + end - head_len
+
+
+def append_entry(path: str, entry: Dict[str, Any]) -> int:
+
+    # Returns the offset after the entry, which is where a reader that has
+    # seen everything up to it continues. A new log gets its header first,
+    # and a torn last line left by a crashed writer is closed so this entry
+    # stays readable. Callers hold locked(path).
+    line = orjson.dumps(entry) + b"\n"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        if not os.fstat(fd).st_size:
+            header = {**_NO_HEADER, "source": entry.get("source")}
+            os.write(fd, orjson.dumps(header) + b"\n")
+        size = os.fstat(fd).st_size
+        with open(path, "rb") as f:
+            header, head_len = _read_header(f)
+            f.seek(size - 1)
+            if size > head_len and f.read(1) != b"\n":
+                line = b"\n" + line
+        os.write(fd, line)
+        return header["start"] + os.fstat(fd).st_size - head_len
+    finally:
+        os.close(fd)
+
+
+def rotate(
+    path: str,
+    offset: int,
+    source: Any,
+    folded: int,
+    keep: Callable[[Dict[str, Any]], bool] | None = None,
+) -> int:
+
+    # Replaces the log with one that starts at offset, or further at the
+    # first entry keep accepts, under a header for source. Returns the new
+    # start. The bytes kept are copied unchanged, so offsets into them mean
+    # the same in both files and readers of the old one stay consistent.
+    # Callers hold locked(path).
+    try:
+        with open(path, "rb") as f:
+            header, head_len = _read_header(f)
+            f.seek(0)
+            data = f.read()
+    except FileNotFoundError:
+        return 0
+    pos = min(max(head_len + offset - header["start"], head_len), len(data))
+    if keep is not None:
+        while pos < len(data):
+            nl = data.find(b"\n", pos)
+            if nl < 0:
+                break
+            try:
+                entry = orjson.loads(data[pos:nl])
+            except orjson.JSONDecodeError:
+                entry = None
+            if isinstance(entry, dict) and keep(entry):
+                break
+            pos = nl + 1
+    start = header["start"] + pos - head_len
+    head = {HEADER_KEY: 1, "start": start, "folded": folded, "source": source}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(head) + b"\n")
+            f.write(data[pos:])
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return start
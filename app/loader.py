@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import os
+import sys
+import time
+import signal
+import argparse
+
+from . import analytics
+from .shm import Publisher
+
+
+def main(argv: list[str] | None = None) -> None:
+
+    parser = argparse.ArgumentParser(
+        prog="python -m app.loader",
+        description="Publish the item-analytics dataset into shared memory for all workers.",
+    )
+    parser.add_argument("--name", default=os.getenv("ANALYTICS_SHM_NAME") or "rtu-analytics")
+    parser.add_argument("--interval", type=float, default=analytics.RELOAD_INTERVAL or 5.0)
+    args = parser.parse_args(argv)
+
+    # The loader always reads the dumps (or the snapshot file) itself.
+    analytics.SHM_NAME = ""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    publisher = Publisher(args.name)
+    try:
+        ds = analytics._load_dataset()
+        gen = publisher.publish(*analytics._snapshot_parts(ds))
+        print(f"published generation {gen}: {len(ds.codes)} codes, "
+              f"{ds.times_flat.shape[0]} events as {args.name}", flush=True)
+        failed = None
+        while True:
+            time.sleep(args.interval)
+            stamp = analytics._dump_stamp()
+            if stamp == ds.source or stamp == failed:
+                continue
+            try:
+                ds = analytics._load_dataset()
+            except Exception as exc:
+                failed = stamp
+                print(f"reload failed, keeping generation {gen}: {exc}", flush=True)
+                continue
+            gen = publisher.publish(*analytics._snapshot_parts(ds))
+            print(f"published generation {gen}: {len(ds.codes)} codes", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        publisher.close()
+
+
+if __name__ == "__main__":
+    main()
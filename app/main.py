@@ -1,45 +1,88 @@
 from __future__ import annotations
 
 import os
+import time
+import asyncio
+import traceback
 from contextlib import asynccontextmanager
+from typing import Any, Dict
 
 from fastapi import FastAPI
 from fastapi.responses import ORJSONResponse
 
-from numba import set_num_threads
-
-from .analytics import router as analytics_router, warmup_numba
+from .analytics import (
+    RELOAD_INTERVAL, open_appends, readiness, router as analytics_router, shutdown_compute, warmup_numba, watch_dumps,
+)
+from . import jit, profiler, telemetry
 from .auth import router as auth_router
 from .userid import router as userid_router
 
+# What the worker did at startup and how long each phase took; served by
+# /ready and printed once.
+_startup: Dict[str, Any] = {}
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
 
-    os.environ.setdefault("NUMBA_CPU_NAME", "haswell")
-    os.environ.setdefault("NUMBA_THREADING_LAYER", "tbb")
+def _startup_line(report: Dict[str, Any]) -> str:
 
-    os.environ.setdefault("NUMBA_NUM_THREADS", "10")
+    parts = []
+    kernels = report.get("kernels")
+    if kernels:
+        parts.append(f"kernels {kernels['seconds']:.2f} s ({kernels['cached']} cached, "
+                     f"{kernels['compiled']} compiled, {report['cpu']})")
+    dataset = report.get("dataset")
+    if dataset:
+        parts.append(f"dataset {dataset['seconds']:.2f} s ({dataset['codes']} codes, {dataset['events']} events)")
+    calibrate = report.get("calibrate")
+    if calibrate:
+        parts.append(f"calibrate {calibrate['seconds']:.2f} s")
+    parts.append(f"failed: {report['error']}" if "error" in report else "ready")
+    return f"startup {os.getpid()} in {report['seconds']:.2f} s: " + ", ".join(parts)
 
-    os.environ.setdefault("OMP_NUM_THREADS", "1")
-    os.environ.setdefault("MKL_NUM_THREADS", "1")
-    os.environ.setdefault("MKL_DYNAMIC", "FALSE")
 
-    try:
-        set_num_threads(int(os.environ.get("NUMBA_NUM_THREADS", "10")))
-    except Exception:
-        pass
+@asynccontextmanager
+async def lifespan(app: FastAPI):
 
+    open_appends()
+    _startup.clear()
+    _startup["cpu"] = jit.cpu_target()
+    _startup["cache_dir"] = jit.cache_dir()
+    t0 = time.perf_counter()
     try:
-        warmup_numba()
-    except Exception:
-        pass
+        warmup_numba(_startup)
+    except Exception as exc:
+        # The worker stays up so the dump watcher can still load data, but
+        # /ready keeps saying no until it has.
+        _startup["error"] = f"{type(exc).__name__}: {exc}"
+        traceback.print_exc()
+    _startup["seconds"] = time.perf_counter() - t0
+    print(_startup_line(_startup), flush=True)
+
+    watcher = asyncio.create_task(watch_dumps()) if RELOAD_INTERVAL > 0 else None
 
     yield
 
+    if watcher is not None:
+        watcher.cancel()
+        try:
+            await watcher
+        except asyncio.CancelledError:
+            pass
+    shutdown_compute()
+    telemetry.close()
+
 
 app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(telemetry.TelemetryMiddleware)
 
 app.include_router(auth_router)
 app.include_router(userid_router)
 app.include_router(analytics_router)
+app.include_router(telemetry.router)
+app.include_router(profiler.router)
+
+
+@app.get("/ready")
+async def ready():
+    state = readiness()
+    ok = state["kernels"] and state["dataset"]
+    return ORJSONResponse({"ready": ok, **state, "startup": _startup}, status_code=200 if ok else 503)
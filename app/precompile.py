@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+import sys
+import time
+import argparse
+
+from . import analytics, jit
+
+
+def main(argv: list[str] | None = None) -> None:
+
+    parser = argparse.ArgumentParser(
+        prog="python -m app.precompile",
+        description="Compile the analytics kernels into the shared numba cache for this CPU target.",
+    )
+    parser.add_argument("--check", action="store_true",
+                        help="exit with status 1 if any kernel was not already in the cache")
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    counts = analytics.precompile_kernels()
+    seconds = time.perf_counter() - t0
+    print(f"{counts['compiled']} compiled, {counts['cached']} loaded from cache in {seconds:.2f} s; "
+          f"target {jit.cpu_target()}, cache {jit.cache_dir() or 'next to the sources'}", flush=True)
+    if args.check and counts["compiled"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import os
+import sys
+import time
+import asyncio
+import threading
+from typing import Dict, List, Tuple
+
+import orjson
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import ORJSONResponse
+
+from .userid import is_admin
+
+PROFILE_RATE = float(os.getenv("ANALYTICS_PROFILE_RATE", "100"))
+PROFILE_MAX_RATE = float(os.getenv("ANALYTICS_PROFILE_MAX_RATE", "1000"))
+PROFILE_MAX_SECONDS = float(os.getenv("ANALYTICS_PROFILE_MAX_SECONDS", "120"))
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+# Python frames a thread sits in while it waits for work; stacks ending
+# in one of them are dropped unless idle samples are asked for, like
+# py-spy does without --idle.
+_IDLE_LEAVES = frozenset({
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+})
+
+# One session per worker; nothing is installed while it is not running.
+_busy = threading.Lock()
+_labels: Dict[Tuple[object, int], str] = {}
+
+
+def _short_path(path: str) -> str:
+
+    # The same file names py-spy prints: relative to the longest sys.path
+    # entry that contains the file.
+    best = ""
+    for entry in sys.path:
+        if entry and path.startswith(entry.rstrip(os.sep) + os.sep) and len(entry) > len(best):
+            best = entry.rstrip(os.sep) + os.sep
+    return path[len(best):] if best else path
+
+
+def _label(code, lineno: int) -> str:
+    key = (code, lineno)
+    label = _labels.get(key)
+    if label is None:
+        label = f"{code.co_name} ({_short_path(code.co_filename)}:{lineno})"
+        _labels[key] = label
+    return label
+
+
+def sample(seconds: float, rate: float, threads: bool = True, idle: bool = False) -> Tuple[Dict[str, int], int]:
+
+    # Wakes up rate times a second and walks every other thread's Python
+    # stack. Counts identical stacks; returns them and the number of ticks.
+    me = threading.get_ident()
+    interval = 1.0 / rate
+    counts: Dict[str, int] = {}
+    ticks = 0
+    deadline = time.perf_counter() + seconds
+    next_at = time.perf_counter()
+    while True:
+        names = {t.ident: t.name for t in threading.enumerate()} if threads else {}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            code = frame.f_code
+            if not idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+                continue
+            stack: List[str] = []
+            while frame is not None:
+                stack.append(_label(frame.f_code, frame.f_lineno))
+                frame = frame.f_back
+            if threads:
+                stack.append(f"thread ({names.get(ident, hex(ident))})")
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        ticks += 1
+        next_at += interval
+        now = time.perf_counter()
+        if next_at >= deadline:
+            break
+        if next_at > now:
+            time.sleep(next_at - now)
+        else:
+            # Fell behind (a long GIL hold); skip the missed ticks.
+            next_at = now
+    return counts, ticks
+
+
+def collapsed(counts: Dict[str, int]) -> bytes:
+    return "".join(f"{stack} {n}\n" for stack, n in sorted(counts.items())).encode()
+
+
+@router.post("/profile")
+async def profile(request: Request):
+
+    try:
+        body = orjson.loads(await request.body())
+        token = str(body.get("token", ""))
+        seconds = float(body.get("Seconds", 10))
+        rate = float(body.get("Rate", PROFILE_RATE))
+        threads = bool(body.get("Threads", True))
+        idle = bool(body.get("Idle", False))
+    except (orjson.JSONDecodeError, AttributeError, TypeError, ValueError):
+        return ORJSONResponse({"error": "invalid json"}, status_code=400)
+
+    if not is_admin(token):
+        return ORJSONResponse({"error": "Forbidden"}, status_code=403)
+    if not (0 < seconds <= PROFILE_MAX_SECONDS) or not (0 < rate <= PROFILE_MAX_RATE):
+        return ORJSONResponse({"error": "invalid profile parameters"}, status_code=400)
+    if not _busy.acquire(blocking=False):
+        return ORJSONResponse({"error": "profiler is already running"}, status_code=409)
+
+    try:
+        # The sampler gets its own thread so the event loop keeps serving
+        # the requests being profiled.
+        counts, ticks = await asyncio.to_thread(sample, seconds, rate, threads, idle)
+    finally:
+        _busy.release()
+        _labels.clear()
+    return Response(
+        content=collapsed(counts),
+        media_type="text/plain; charset=utf-8",
+        headers={"x-profile-samples": str(ticks), "x-profile-rate": f"{rate:g}", "x-profile-pid": str(os.getpid())},
+    )
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from .snapshot import Snapshot, pack_snapshot, unpack_snapshot
+
+# A small control segment named after the dataset holds the current
+# generation as a little-endian u64. Generation g lives in the data segment
+# "<name>.<g>" in the snapshot file layout, fully written before the
+# control word is bumped, so a reader never sees a half-built dataset.
+_CONTROL_SIZE = 8
+
+
+def _open_segment(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers attached segments with the resource
+        # tracker, which would unlink them when this worker exits.
+        seg = shared_memory.SharedMemory(name=name)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(seg._name, "shared_memory")
+        except Exception:
+            pass
+        return seg
+
+
+def current_generation(name: str) -> int | None:
+
+    try:
+        ctrl = _open_segment(name)
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+    try:
+        gen = int.from_bytes(bytes(ctrl.buf[:_CONTROL_SIZE]), "little")
+    finally:
+        ctrl.close()
+    return gen or None
+
+
+def attach(name: str) -> Tuple[int, Snapshot, shared_memory.SharedMemory] | None:
+
+    gen = current_generation(name)
+    if gen is None:
+        return None
+    try:
+        seg = _open_segment(f"{name}.{gen}")
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+    snap = unpack_snapshot(np.ndarray((seg.size,), dtype=np.uint8, buffer=seg.buf))
+    if snap is None:
+        seg.close()
+        return None
+    for arr in snap[0].values():
+        arr.flags.writeable = False
+    return gen, snap, seg
+
+
+class Publisher:
+
+    def __init__(self, name: str, keep: int = 2) -> None:
+        self.name = name
+        self.keep = keep
+        self.generation = 0
+        self.segments: List[shared_memory.SharedMemory] = []
+        try:
+            self.control = shared_memory.SharedMemory(
+                name=name, create=True, size=_CONTROL_SIZE)
+        except FileExistsError:
+            # Left behind by a previous loader; continue its numbering so
+            # attached workers see the next dataset as new.
+            self.control = _open_segment(name)
+            self.generation = int.from_bytes(bytes(self.control.buf[:_CONTROL_SIZE]), "little")
+
+    def publish(
+        self, arrays: Dict[str, np.ndarray], tables: Dict[str, List[Any]], meta: Dict[str, Any]
+    ) -> int:
+
+        head, placed, total = pack_snapshot(arrays, tables, meta)
+        gen = self.generation + 1
+        seg_name = f"{self.name}.{gen}"
+        try:
+            seg = shared_memory.SharedMemory(name=seg_name, create=True, size=total)
+        except FileExistsError:
+            stale = _open_segment(seg_name)
+            stale.close()
+            stale.unlink()
+            seg = shared_memory.SharedMemory(name=seg_name, create=True, size=total)
+
+        seg.buf[:len(head)] = head
+        for pos, blob in placed:
+            data = memoryview(blob).cast("B") if isinstance(blob, np.ndarray) else blob
+            seg.buf[pos:pos + len(data)] = data
+
+        self.control.buf[:_CONTROL_SIZE] = gen.to_bytes(_CONTROL_SIZE, "little")
+        self.generation = gen
+        self.segments.append(seg)
+        # Workers still attached to retired generations keep their mapping;
+        # only the name goes away.
+        while len(self.segments) > self.keep:
+            old = self.segments.pop(0)
+            old.close()
+            old.unlink()
+        return gen
+
+    def close(self) -> None:
+        for seg in self.segments:
+            seg.close()
+            seg.unlink()
+        self.segments = []
+        self.control.close()
+        self.control.unlink()
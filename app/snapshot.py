@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import os
+import time
+import hashlib
+import struct
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+import orjson
+
+# Layout: MAGIC | u32 format | u32 header length | JSON header | blobs.
+# Blob offsets in the header are relative to the first ALIGN boundary after
+# the header, and every blob starts on an ALIGN boundary so it can be viewed
+# in place.
+MAGIC = b"RTUSNAP\0"
+FORMAT_VERSION = 1
+ALIGN = 64
+
+_PREFIX = struct.Struct("<8sII")
+
+Snapshot = Tuple[Dict[str, np.ndarray], Dict[str, List[Any]], Dict[str, Any]]
+
+
+def _aligned(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def source_checksum(paths: Sequence[str]) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    for path in paths:
+        h.update(os.path.basename(path).encode())
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    block = f.read(1 << 20)
+                    if not block:
+                        break
+                    h.update(block)
+        except FileNotFoundError:
+            h.update(b"\0missing")
+    return h.hexdigest()
+
+
+def pack_snapshot(
+    arrays: Dict[str, np.ndarray], tables: Dict[str, List[Any]], meta: Dict[str, Any]
+) -> Tuple[bytes, List[Tuple[int, bytes | np.ndarray]], int]:
+
+    header: Dict[str, Any] = {"meta": meta, "arrays": {}, "tables": {}}
+    placed: List[Tuple[int, bytes | np.ndarray]] = []
+    pos = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        header["arrays"][name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": pos}
+        placed.append((pos, arr))
+        pos = _aligned(pos + arr.nbytes)
+    for name, values in tables.items():
+        blob = orjson.dumps(values)
+        header["tables"][name] = {"offset": pos, "length": len(blob)}
+        placed.append((pos, blob))
+        pos = _aligned(pos + len(blob))
+
+    head = orjson.dumps(header)
+    prefix = _PREFIX.pack(MAGIC, FORMAT_VERSION, len(head)) + head
+    head_size = _aligned(len(prefix))
+    return prefix.ljust(head_size, b"\0"), [(head_size + off, blob) for off, blob in placed], head_size + pos
+
+
+def write_snapshot(
+    path: str, arrays: Dict[str, np.ndarray], tables: Dict[str, List[Any]], meta: Dict[str, Any]
+) -> None:
+
+    head, placed, _ = pack_snapshot(arrays, tables, meta)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(head)
+            for pos, blob in placed:
+                f.seek(pos)
+                f.write(memoryview(blob).cast("B") if isinstance(blob, np.ndarray) else blob)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def unpack_snapshot(buf: np.ndarray) -> Snapshot | None:
+
+    if buf.shape[0] < _PREFIX.size:
+        return None
+    magic, fmt, head_len = _PREFIX.unpack(buf[:_PREFIX.size].tobytes())
+    if magic != MAGIC or fmt != FORMAT_VERSION:
+        return None
+    header = orjson.loads(buf[_PREFIX.size:_PREFIX.size + head_len].tobytes())
+    base = _aligned(_PREFIX.size + head_len)
+
+    arrays: Dict[str, np.ndarray] = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        count = int(np.prod(shape, dtype=np.int64))
+        start = base + spec["offset"]
+        arrays[name] = np.asarray(
+            buf[start:start + count * dtype.itemsize]).view(dtype).reshape(shape)
+    tables = {
+        name: orjson.loads(buf[base + spec["offset"]:base + spec["offset"] + spec["length"]].tobytes())
+        for name, spec in header["tables"].items()
+    }
+    return arrays, tables, header["meta"]
+
+
+def open_snapshot(path: str) -> Snapshot | None:
+
+    try:
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+    except (OSError, ValueError):
+        return None
+    try:
+        return unpack_snapshot(buf)
+    except (ValueError, KeyError, struct.error):
+        return None
+
+
+@contextmanager
+def build_lock(path: str, timeout: float = 300.0, poll: float = 0.05) -> Iterator[None]:
+    # Lets exactly one worker rebuild a stale snapshot while the others wait
+    # and then open its result. A lock older than timeout is treated as left
+    # behind by a crashed worker.
+    lock = path + ".lock"
+    fd = None
+    deadline = time.monotonic() + timeout
+    while fd is None:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                stale = time.time() - os.path.getmtime(lock) > timeout
+            except OSError:
+                stale = False
+            if stale:
+                try:
+                    os.unlink(lock)
+                except OSError:
+                    pass
+            elif time.monotonic() > deadline:
+                break
+            else:
+                time.sleep(poll)
+        except OSError:
+            break
+    try:
+        yield
+    finally:
+        if fd is not None:
+            os.close(fd)
+            try:
+                os.unlink(lock)
+            except OSError:
+                pass
@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import os
+import glob
+import time
+import bisect
+import functools
+import tempfile
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from fastapi import APIRouter, Response
+
+METRICS_DIR = os.getenv("ANALYTICS_METRICS_DIR", os.path.join(tempfile.gettempdir(), "rtu-metrics"))
+SERVER_TIMING = os.getenv("ANALYTICS_SERVER_TIMING", "1") != "0"
+
+router = APIRouter(tags=["metrics"])
+
+# Fixed series so every worker's slab has the same layout and /metrics can
+# add them up element-wise.
+STAGES = (
+    "token", "user_lookup", "parse", "cache", "queue",
+    "select", "totals", "metrics", "abc", "format",
+)
+ROUTES = (
+    "/auth/token", "/userid/", "/item-analytics/", "/item-analytics/groups",
+    "/item-analytics/series", "/item-analytics/batch", "/item-analytics/append",
+    "/metrics", "/ready", "/admin/profile", "other",
+)
+BUCKETS = (
+    1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+    1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+STATUS_CLASSES = ("2xx", "3xx", "4xx", "5xx")
+KERNELS = ("metrics:parallel", "metrics:serial", "abc:parallel", "abc:serial")
+COUNTERS = ("cache_hits", "cache_misses")
+GAUGES = (
+    "dataset_codes", "dataset_events", "dataset_generation", "delta_events", "numba_threads", "compute_workers",
+)
+
+# Slab layout, float64: per histogram series len(BUCKETS) + 1 bucket counts
+# (the last one is +Inf) and the sum; then per-route status counts, kernel
+# calls, counters and gauges. LAYOUT is part of the file name.
+LAYOUT = 4
+_HIST = len(BUCKETS) + 2
+_SERIES = len(STAGES) + len(ROUTES)
+_STATUS_AT = _SERIES * _HIST
+_KERNELS_AT = _STATUS_AT + len(ROUTES) * len(STATUS_CLASSES)
+_COUNTERS_AT = _KERNELS_AT + len(KERNELS)
+_GAUGES_AT = _COUNTERS_AT + len(COUNTERS)
+_SLAB_SIZE = _GAUGES_AT + len(GAUGES)
+
+_STAGE_INDEX = {name: i for i, name in enumerate(STAGES)}
+_ROUTE_INDEX = {name: i for i, name in enumerate(ROUTES)}
+_KERNEL_INDEX = {name: i for i, name in enumerate(KERNELS)}
+
+
+class _Trace:
+    __slots__ = ("stages", "kernels")
+
+    def __init__(self) -> None:
+        self.stages: List[Tuple[str, float]] = []
+        self.kernels: List[str] = []
+
+
+_trace: contextvars.ContextVar[_Trace | None] = contextvars.ContextVar("rtu_trace", default=None)
+_slab: np.ndarray | None = None
+_slab_pid = 0
+_gauge_source: Callable[[], Dict[str, float]] | None = None
+
+
+def note(name: str, seconds: float) -> None:
+    trace = _trace.get()
+    if trace is not None:
+        trace.stages.append((name, seconds))
+
+
+def note_kernel(kernel: str, parallel: bool) -> None:
+    trace = _trace.get()
+    if trace is not None:
+        trace.kernels.append(f"{kernel}:parallel" if parallel else f"{kernel}:serial")
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    # Appends to the current request's trace from whatever thread runs the
+    # stage; the numbers reach the shared slab only in the middleware.
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        note(name, time.perf_counter() - t0)
+
+
+def timed(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    def wrap(fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def inner(*args: Any, **kwargs: Any) -> Any:
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                note(name, time.perf_counter() - t0)
+        return inner
+    return wrap
+
+
+def set_gauge_source(fn: Callable[[], Dict[str, float]]) -> None:
+    global _gauge_source
+    _gauge_source = fn
+
+
+def _slab_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"{pid}.v{LAYOUT}.bin")
+
+
+def _worker_slab() -> np.ndarray:
+    global _slab, _slab_pid
+
+    pid = os.getpid()
+    if _slab is not None and _slab_pid == pid:
+        return _slab
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _slab = np.memmap(_slab_path(pid), dtype=np.float64, mode="w+", shape=(_SLAB_SIZE,))
+    except OSError:
+        # No shared directory: this worker still serves its own numbers.
+        _slab = np.zeros(_SLAB_SIZE, dtype=np.float64)
+    _slab_pid = pid
+    return _slab
+
+
+def close() -> None:
+    global _slab
+
+    if _slab is not None and _slab_pid == os.getpid() and isinstance(_slab, np.memmap):
+        try:
+            os.unlink(_slab_path(_slab_pid))
+        except OSError:
+            pass
+    _slab = None
+
+
+def _observe(slab: np.ndarray, series: int, seconds: float) -> None:
+    base = series * _HIST
+    slab[base + bisect.bisect_left(BUCKETS, seconds)] += 1.0
+    slab[base + _HIST - 1] += seconds
+
+
+def _record(trace: _Trace, route: str, status: int, total: float) -> None:
+    slab = _worker_slab()
+    route_i = _ROUTE_INDEX.get(route, len(ROUTES) - 1)
+    for name, seconds in trace.stages:
+        i = _STAGE_INDEX.get(name)
+        if i is not None:
+            _observe(slab, i, seconds)
+    _observe(slab, len(STAGES) + route_i, total)
+    cls = min(max(status // 100 - 2, 0), len(STATUS_CLASSES) - 1)
+    slab[_STATUS_AT + route_i * len(STATUS_CLASSES) + cls] += 1.0
+    for kernel in trace.kernels:
+        slab[_KERNELS_AT + _KERNEL_INDEX[kernel]] += 1.0
+    _refresh_gauges(slab)
+
+
+def _refresh_gauges(slab: np.ndarray) -> None:
+    if _gauge_source is None:
+        return
+    values = _gauge_source()
+    for i, name in enumerate(COUNTERS):
+        slab[_COUNTERS_AT + i] = values.get(name, 0.0)
+    for i, name in enumerate(GAUGES):
+        slab[_GAUGES_AT + i] = values.get(name, 0.0)
+
+
+def _server_timing(trace: _Trace, total: float) -> bytes:
+    # Stages of the same name (several kernel calls in /batch) add up.
+    merged: Dict[str, float] = {}
+    for name, seconds in trace.stages:
+        merged[name] = merged.get(name, 0.0) + seconds
+    parts = [f"{name};dur={seconds * 1e3:.3f}" for name, seconds in merged.items()]
+    parts.append(f"total;dur={total * 1e3:.3f}")
+    return ", ".join(parts).encode()
+
+
+class TelemetryMiddleware:
+    # Plain ASGI so that it costs a context variable, two clocks and a few
+    # array increments per request; everything is written from the event
+    # loop thread, one slab per worker process, without locks.
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = _Trace()
+        token = _trace.set(trace)
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", _server_timing(trace, time.perf_counter() - t0)))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _trace.reset(token)
+            _record(trace, scope.get("path", ""), status, time.perf_counter() - t0)
+
+
+def _live(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _collect() -> Tuple[np.ndarray, Dict[int, np.ndarray]]:
+
+    # Sum of all live workers' slabs; slabs of workers that are gone are
+    # removed, so their counts drop out like a counter reset.
+    own = _worker_slab()
+    _refresh_gauges(own)
+    slabs: Dict[int, np.ndarray] = {os.getpid(): np.array(own)}
+    for path in glob.glob(os.path.join(METRICS_DIR, f"*.v{LAYOUT}.bin")):
+        try:
+            pid = int(os.path.basename(path).split(".", 1)[0])
+        except ValueError:
+            continue
+        if pid in slabs:
+            continue
+        if not _live(pid):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            continue
+        try:
+            data = np.fromfile(path, dtype=np.float64)
+        except OSError:
+            continue
+        if data.shape[0] == _SLAB_SIZE:
+            slabs[pid] = data
+    return np.sum(list(slabs.values()), axis=0), slabs
+
+
+def _histogram(lines: List[str], name: str, label: str, value: str, data: np.ndarray) -> None:
+    cumulative = np.cumsum(data[:_HIST - 1])
+    for le, count in zip(BUCKETS, cumulative[:-1]):
+        lines.append(f'{name}_bucket{{{label}="{value}",le="{le:g}"}} {count:.0f}')
+    lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {cumulative[-1]:.0f}')
+    lines.append(f'{name}_sum{{{label}="{value}"}} {float(data[_HIST - 1])!r}')
+    lines.append(f'{name}_count{{{label}="{value}"}} {cumulative[-1]:.0f}')
+
+
+def render() -> str:
+
+    total, slabs = _collect()
+    lines = [
+        "# HELP rtu_stage_seconds Time spent in each request stage.",
+        "# TYPE rtu_stage_seconds histogram",
+    ]
+    for i, name in enumerate(STAGES):
+        _histogram(lines, "rtu_stage_seconds", "stage", name, total[i * _HIST:(i + 1) * _HIST])
+    lines += [
+        "# HELP rtu_request_seconds Wall time of whole requests by route.",
+        "# TYPE rtu_request_seconds histogram",
+    ]
+    for i, route in enumerate(ROUTES):
+        j = len(STAGES) + i
+        _histogram(lines, "rtu_request_seconds", "route", route, total[j * _HIST:(j + 1) * _HIST])
+    lines += [
+        "# HELP rtu_responses_total Responses by route and status class.",
+        "# TYPE rtu_responses_total counter",
+    ]
+    for i, route in enumerate(ROUTES):
+        for k, cls in enumerate(STATUS_CLASSES):
+            value = total[_STATUS_AT + i * len(STATUS_CLASSES) + k]
+            lines.append(f'rtu_responses_total{{route="{route}",code="{cls}"}} {value:.0f}')
+    lines += [
+        "# HELP rtu_kernel_calls_total Analytics kernel calls by variant (parallel uses numba threads).",
+        "# TYPE rtu_kernel_calls_total counter",
+    ]
+    for i, kernel in enumerate(KERNELS):
+        name, variant = kernel.split(":")
+        lines.append(f'rtu_kernel_calls_total{{kernel="{name}",variant="{variant}"}} {total[_KERNELS_AT + i]:.0f}')
+    for i, name in enumerate(COUNTERS):
+        lines += [f"# TYPE rtu_{name}_total counter", f"rtu_{name}_total {total[_COUNTERS_AT + i]:.0f}"]
+    # Gauges stay per worker: workers may briefly hold different datasets.
+    for i, name in enumerate(GAUGES):
+        lines.append(f"# TYPE rtu_{name} gauge")
+        for pid, slab in sorted(slabs.items()):
+            lines.append(f'rtu_{name}{{worker="{pid}"}} {slab[_GAUGES_AT + i]:.0f}')
+    lines += ["# TYPE rtu_workers gauge", f"rtu_workers {len(slabs)}"]
+    return "\n".join(lines) + "\n"
+
+
+@router.get("/metrics")
+async def metrics() -> Response:
+    return Response(content=render(), media_type="text/plain; version=0.0.4; charset=utf-8")
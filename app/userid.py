@@ -1,19 +1,27 @@
 from __future__ import annotations
 
 import os
-from typing import Optional
+from typing import FrozenSet, Optional
 import mmap
 import hyperscan as hs
 
 from fastapi import APIRouter
 from fastapi.responses import ORJSONResponse
 
+from .telemetry import timed
+
 BASE_DIR = os.path.dirname(__file__)
 LOGPAS_FILE = os.path.join(BASE_DIR, "..", "routes", "LogPas.txt")
+# Empty unless configured: admin-only endpoints stay closed. ID 1 is the
+# regular analytics user and must not be an admin by default.
+ADMIN_IDS: FrozenSet[int] = frozenset(
+    int(v) for v in os.getenv("ANALYTICS_ADMIN_IDS", "").split(",") if v.strip()
+)
 
 router = APIRouter(prefix="/userid", tags=["userid"])
 
 
+@timed("user_lookup")
 def get_user_id_from_file(token: str, file_path: str = LOGPAS_FILE) -> Optional[int]:
     try:
         db = hs.Database()
@@ -62,6 +70,10 @@ def get_user_id_from_file(token: str, file_path: str = LOGPAS_FILE) -> Optional[
     return None
 
 
+def is_admin(token: str) -> bool:
+    return get_user_id_from_file(token) in ADMIN_IDS
+
+
 @router.post("/")
 def get_user_id(body: dict):
     token = str(body.get("token", ""))
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import sys
+import argparse
+from typing import Dict, List, Tuple
+
+import orjson
+
+Key = Tuple[str, int, int, int]
+
+
+def load(path: str) -> Dict[Key, float]:
+
+    # The last measurement of a configuration wins, so re-running a sweep
+    # into the same file replaces the earlier numbers.
+    best: Dict[Key, float] = {}
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            r = orjson.loads(line)
+            best[(r["stage"], r["codes"], r["events_per_code"], r["threads"])] = r["seconds"]
+    return best
+
+
+def compare(baseline: Dict[Key, float], candidate: Dict[Key, float]) -> List[Tuple[Key, float, float, float]]:
+    rows = []
+    for key in sorted(baseline.keys() & candidate.keys()):
+        old, new = baseline[key], candidate[key]
+        rows.append((key, old, new, old / new if new > 0 else float("inf")))
+    return rows
+
+
+def main(argv: list[str] | None = None) -> None:
+
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.compare",
+        description="Compare two bench.kernels result files (speedup > 1 means the candidate is faster).",
+    )
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--fail-below", type=float, default=0.0,
+                        help="exit with status 1 if any speedup is below this ratio")
+    args = parser.parse_args(argv)
+
+    rows = compare(load(args.baseline), load(args.candidate))
+    print(f"{'stage':>18} {'codes':>8} {'ev/code':>7} {'thr':>3} {'base ms':>10} {'cand ms':>10} {'speedup':>8}")
+    worst = float("inf")
+    for (stage, codes, events, threads), old, new, ratio in rows:
+        worst = min(worst, ratio)
+        print(f"{stage:>18} {codes:>8} {events:>7} {threads:>3} {old * 1e3:10.3f} {new * 1e3:10.3f} {ratio:8.2f}")
+    if rows and worst < args.fail_below:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import orjson
+
+from app import analytics as an
+from routes import GetItemAnalytics as legacy
+
+from .generate import Records, generate
+
+# Largest difference that still counts as equal, per numeric field; the
+# legacy service rounds exactly like the app does, so these only absorb
+# fastmath reassociation and float summation order.
+TOLERANCES: Dict[str, float] = {"Sales": 0.01, "Loss": 0.01, "LossOfProfit": 0.001, "OSA": 0.01}
+EXACT_FIELDS = ("Name", "Group", "ABC")
+
+# (StartDate, FinishDate) as the endpoints take them.
+Window = Tuple[str, str]
+
+
+def default_windows(start: str, days: int) -> List[Window]:
+
+    # The whole span, a window inside it, a single day, one that starts
+    # before the first event and one entirely after the data.
+    t0 = datetime.strptime(start, "%d.%m.%Y")
+
+    def day(n: int) -> str:
+        return (t0 + timedelta(days=n)).strftime("%d.%m.%Y")
+
+    return [
+        (day(0), day(days - 1)),
+        (day(days // 4), day(days // 2)),
+        (day(days // 3), day(days // 3)),
+        (day(-30), day(days // 5)),
+        (day(days + 10), day(days + 20)),
+    ]
+
+
+class _OsaTimer:
+    # Wraps legacy._calculate_osa to split _prepare_data into its OSA part
+    # and everything else without copying the legacy code.
+    def __init__(self, fn: Callable[..., float]) -> None:
+        self.fn = fn
+        self.seconds = 0.0
+
+    def __call__(self, *args: Any) -> float:
+        t0 = time.perf_counter()
+        try:
+            return self.fn(*args)
+        finally:
+            self.seconds += time.perf_counter() - t0
+
+
+def run_legacy(stock: Records, sales: Records, window: Window) -> Tuple[List[Dict[str, Any]], Dict[str, float]]:
+
+    start_dt = datetime.strptime(window[0], "%d.%m.%Y")
+    end_dt = datetime.strptime(window[1], "%d.%m.%Y") + timedelta(days=1)
+    timer = _OsaTimer(legacy._calculate_osa)
+    original = legacy._calculate_osa
+    legacy._calculate_osa = timer
+    try:
+        t0 = time.perf_counter()
+        items = legacy._prepare_data(stock, sales, start_dt, end_dt)
+        total = time.perf_counter() - t0
+    finally:
+        legacy._calculate_osa = original
+    return items, {"prepare": total - timer.seconds, "osa": timer.seconds, "total": total}
+
+
+def run_app(ds: an._Dataset, window: Window) -> Tuple[List[Dict[str, Any]], Dict[str, float]]:
+
+    start_ts, end_ts = an._parse_window(*window)
+    t0 = time.perf_counter()
+    result = an._rows_result(ds, start_ts, end_ts, None)
+    t1 = time.perf_counter()
+    _, abc_codes, sales, loss_amounts, loss_percents, osa_res = result
+    body = an._rows_json(
+        abc_codes, sales, loss_amounts, loss_percents, osa_res,
+        ds.row_fragments, ds.row_frag_offsets, ds.codes, ds.name_by_code, ds.group_by_code
+    )
+    t2 = time.perf_counter()
+    return orjson.loads(body), {"metrics": t1 - t0, "format": t2 - t1, "total": t2 - t0}
+
+
+def diff_rows(expected: List[Dict[str, Any]], actual: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+
+    got = {row["Code"]: row for row in actual}
+    for row in expected:
+        other = got.pop(row["Code"], None)
+        if other is None:
+            yield {"Code": row["Code"], "field": "row", "legacy": "present", "app": "missing"}
+            continue
+        for name, tol in TOLERANCES.items():
+            if abs(float(row[name]) - float(other[name])) > tol:
+                yield {"Code": row["Code"], "field": name, "legacy": row[name], "app": other[name]}
+        for name in EXACT_FIELDS:
+            if row.get(name) != other.get(name):
+                yield {"Code": row["Code"], "field": name, "legacy": row.get(name), "app": other.get(name)}
+    for code in got:
+        yield {"Code": code, "field": "row", "legacy": "missing", "app": "present"}
+
+
+def compare(stock: Records, sales: Records, windows: List[Window]) -> Dict[str, Any]:
+
+    t0 = time.perf_counter()
+    ds = an._build_from_records(stock, sales)
+    build = time.perf_counter() - t0
+    # Compile outside the timed region; the service does this at startup.
+    run_app(ds, windows[0])
+
+    report: Dict[str, Any] = {
+        "stock_records": len(stock), "sales_records": len(sales), "codes": len(ds.codes),
+        "app_build": build, "windows": [],
+    }
+    for window in windows:
+        expected, legacy_times = run_legacy(stock, sales, window)
+        actual, app_times = run_app(ds, window)
+        diffs = list(diff_rows(expected, actual))
+        report["windows"].append({
+            "StartDate": window[0],
+            "FinishDate": window[1],
+            "rows": len(expected),
+            "legacy": legacy_times,
+            "app": app_times,
+            "speedup": legacy_times["total"] / app_times["total"] if app_times["total"] > 0 else None,
+            "differences": diffs,
+        })
+    return report
+
+
+def _print_report(report: Dict[str, Any], limit: int) -> None:
+    print(f"{report['stock_records']} stock / {report['sales_records']} sales records, "
+          f"{report['codes']} codes; app build {report['app_build'] * 1e3:.1f} ms")
+    for w in report["windows"]:
+        lg, ap = w["legacy"], w["app"]
+        print(
+            f"  {w['StartDate']}-{w['FinishDate']}: {w['rows']} rows, "
+            f"legacy {lg['total'] * 1e3:.1f} ms (osa {lg['osa'] * 1e3:.1f}), "
+            f"app {ap['total'] * 1e3:.2f} ms (metrics {ap['metrics'] * 1e3:.2f}, format {ap['format'] * 1e3:.2f}), "
+            f"x{w['speedup'] or 0:.0f}, {len(w['differences'])} differences"
+        )
+        for d in w["differences"][:limit]:
+            print(f"    {d['Code']} {d['field']}: legacy={d['legacy']!r} app={d['app']!r}")
+
+
+def main(argv: list[str] | None = None) -> None:
+
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.differential",
+        description="Run routes/GetItemAnalytics.py and app.analytics on the same generated data and compare.",
+    )
+    parser.add_argument("--codes", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=30)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--start", default="01.01.2024")
+    parser.add_argument("--seeds", default="0", help="comma-separated generator seeds")
+    parser.add_argument("--snap", type=int, default=3600,
+                        help="event time granularity in seconds; whole hours exercise window edges")
+    parser.add_argument("--window", action="append", default=[],
+                        help="StartDate:FinishDate, repeatable (default: a fixed set around the data span)")
+    parser.add_argument("--show", type=int, default=10, help="differences listed per window")
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    args = parser.parse_args(argv)
+
+    windows = [tuple(w.split(":", 1)) for w in args.window] or default_windows(args.start, args.days)
+    failed = False
+    for seed in [int(s) for s in args.seeds.split(",") if s]:
+        stock, sales = generate(
+            codes=args.codes, events=args.events, days=args.days, seed=seed, start=args.start, snap=args.snap)
+        report = compare(stock, sales, windows)
+        report["seed"] = seed
+        failed = failed or any(w["differences"] for w in report["windows"])
+        if args.json:
+            sys.stdout.buffer.write(orjson.dumps(report) + b"\n")
+        else:
+            print(f"seed {seed}:")
+            _print_report(report, args.show)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
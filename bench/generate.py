@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import os
+import argparse
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import orjson
+
+from app.ingest import SPOILAGE
+
+Records = List[Dict[str, Any]]
+
+_PERIOD_FORMAT = "%d.%m.%Y %H:%M:%S"
+
+
+def _periods(stamps: np.ndarray) -> List[str]:
+    # Naive local datetimes, exactly what the services parse back.
+    return [datetime.fromtimestamp(ts).strftime(_PERIOD_FORMAT) for ts in stamps.tolist()]
+
+
+def generate(
+    codes: int = 1000,
+    events: int = 30,
+    days: int = 90,
+    spoilage: float = 0.02,
+    stockout: float = 0.1,
+    groups: int = 20,
+    sales_per_code: int = 5,
+    dead: float = 0.02,
+    dated_sales: bool = True,
+    seed: int = 0,
+    start: str = "01.01.2024",
+    snap: int = 1,
+) -> Tuple[Records, Records]:
+
+    rng = np.random.default_rng(seed)
+    t0 = datetime.strptime(start, "%d.%m.%Y").timestamp()
+    span = days * 86_400.0
+
+    # Stock movements: a Poisson number of events per code across the span,
+    # on multiples of snap seconds (large values put many events exactly on
+    # day boundaries). Each event starts from the previous closing balance,
+    # and a share of them empties the shelf.
+    counts = np.maximum(rng.poisson(events, codes), 1)
+    owner = np.repeat(np.arange(codes), counts)
+    times = t0 + np.floor(rng.uniform(0.0, span, owner.shape[0]) / snap) * snap
+    order = np.lexsort((times, owner))
+    owner, times = owner[order], times[order]
+    ends = rng.integers(1, 40, owner.shape[0]).astype(np.float64)
+    ends[rng.random(owner.shape[0]) < stockout] = 0.0
+    starts = np.roll(ends, 1)
+    first = np.r_[0, np.cumsum(counts)[:-1]]
+    starts[first] = rng.integers(0, 40, codes)
+    spoiled = rng.random(owner.shape[0]) < spoilage
+    starts[spoiled] = ends[spoiled] + rng.integers(1, 5, int(spoiled.sum()))
+
+    names = [f"Товар {i + 1}" for i in range(codes)]
+    group_of = rng.integers(0, max(groups, 1), codes)
+    periods = _periods(times)
+    stock: Records = []
+    for k, i in enumerate(owner.tolist()):
+        item: Dict[str, Any] = {
+            "НоменклатураКод": str(100_000 + i),
+            "Номенклатура": names[i],
+            "Родитель": f"Группа {group_of[i] + 1}" if groups else None,
+            "Период": periods[k],
+            "НачальныйОстаток": float(starts[k]),
+            "КонечныйОстаток": float(ends[k]),
+        }
+        if spoiled[k]:
+            item["СтатьяРасходов"] = SPOILAGE
+        stock.append(item)
+
+    # Sales: a long-tailed price and volume per code so the ABC split is
+    # realistic; "dead" codes never sell and drop out of the analytics.
+    price = np.round(rng.lognormal(5.0, 1.0, codes), 2)
+    volume = rng.pareto(1.2, codes) + 0.1
+    live = np.flatnonzero(rng.random(codes) >= dead)
+    sale_owner = np.repeat(live, sales_per_code)
+    qty = np.maximum(np.round(volume[sale_owner] * rng.uniform(0.5, 1.5, sale_owner.shape[0])), 1.0)
+    sale_periods = _periods(np.floor(t0 + rng.uniform(0.0, span, sale_owner.shape[0]))) if dated_sales else None
+    sales: Records = []
+    for k, i in enumerate(sale_owner.tolist()):
+        rec: Dict[str, Any] = {
+            "Код": str(100_000 + i),
+            "Номенклатура": names[i],
+            "Количество": float(qty[k]),
+            "Сумма": round(float(qty[k] * price[i]), 2),
+        }
+        if sale_periods is not None:
+            rec["Период"] = sale_periods[k]
+        sales.append(rec)
+    return stock, sales
+
+
+def write_dump(path: str, records: Records, batch: int = 10_000) -> None:
+
+    # Written in slices so a multi-gigabyte dump never exists as one bytes
+    # object.
+    with open(path, "wb") as f:
+        f.write(b"[\n")
+        for lo in range(0, len(records), batch):
+            if lo:
+                f.write(b",\n")
+            f.write(b",\n".join(orjson.dumps(rec) for rec in records[lo:lo + batch]))
+        f.write(b"\n]\n")
+
+
+def write_dumps(out_dir: str, stock: Records, sales: Records) -> Tuple[str, str]:
+
+    os.makedirs(out_dir, exist_ok=True)
+    stock_path = os.path.join(out_dir, "stock_dump.json")
+    sales_path = os.path.join(out_dir, "sales_dump.json")
+    write_dump(stock_path, stock)
+    write_dump(sales_path, sales)
+    return stock_path, sales_path
+
+
+def main(argv: list[str] | None = None) -> None:
+
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.generate",
+        description="Write synthetic stock_dump.json / sales_dump.json for benchmarks.",
+    )
+    parser.add_argument("--out", default="bench-data")
+    parser.add_argument("--codes", type=int, default=1000)
+    parser.add_argument("--events", type=int, default=30, help="mean stock events per code")
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--spoilage", type=float, default=0.02, help="share of events written off as spoilage")
+    parser.add_argument("--stockout", type=float, default=0.1, help="share of events that empty the shelf")
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--sales-per-code", type=int, default=5)
+    parser.add_argument("--dead", type=float, default=0.02, help="share of codes without sales")
+    parser.add_argument("--undated-sales", action="store_true")
+    parser.add_argument("--start", default="01.01.2024")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--snap", type=int, default=1, help="event times are multiples of this many seconds")
+    args = parser.parse_args(argv)
+
+    stock, sales = generate(
+        codes=args.codes, events=args.events, days=args.days, spoilage=args.spoilage,
+        stockout=args.stockout, groups=args.groups, sales_per_code=args.sales_per_code,
+        dead=args.dead, dated_sales=not args.undated_sales, seed=args.seed, start=args.start,
+        snap=args.snap,
+    )
+    stock_path, sales_path = write_dumps(args.out, stock, sales)
+    print(f"{len(stock)} stock records -> {stock_path}")
+    print(f"{len(sales)} sales records -> {sales_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import os
+import sys
+import time
+import argparse
+import platform
+import tempfile
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import numba as nb
+import orjson
+
+from app import analytics as an
+from app.ingest import DumpIngest, iter_json_batches
+
+from . import git_commit
+from .generate import generate, write_dumps
+
+# One JSON object per measurement; "rate" is items per second where items
+# are the unit named in "unit" (stock events, codes or rows).
+Result = Dict[str, Any]
+
+
+def _best(fn: Callable[[], Any], repeat: int) -> float:
+    fn()
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _ingest_files(stock_path: str, sales_path: str) -> an._Dataset:
+    ingest = DumpIngest()
+    for batch in iter_json_batches(stock_path):
+        ingest.add_stock(batch)
+    for batch in iter_json_batches(sales_path):
+        ingest.add_sales(batch)
+    parts = ingest.csr()
+    return an._build_dataset(*parts, ledger=ingest.ledger(parts[0]))
+
+
+def _stages(
+    ds: an._Dataset, stock: List[Dict[str, Any]], sales: List[Dict[str, Any]], paths: Tuple[str, str]
+) -> Dict[str, Tuple[Callable[[], Any], int, str, bool]]:
+
+    # name -> (callable, item count, unit, whether numba threads apply)
+    start_ts = ds.epoch
+    end_ts = float(ds.epoch + ds.times_flat.max()) + 1.0 if ds.times_flat.shape[0] else start_ts + 1.0
+    lo, hi = start_ts - ds.epoch, end_ts - ds.epoch
+    metrics_args = (
+        ds.times_flat, ds.open_flags, ds.end_flags, ds.avail_prefix, ds.offsets, an._NO_EVENTS,
+        lo, hi, ds.sales_arr, ds.price_arr, ds.lossq_arr,
+    )
+    osa_res, loss_amounts, loss_percents = an._compute_metrics_numba_csr(*metrics_args)
+    n_events = int(ds.times_flat.shape[0])
+    n_codes = len(ds.codes)
+    # A fixed-size append: its cost should not grow with the dataset.
+    added_stock, added_sales = stock[-1000:], sales[-100:]
+    return {
+        "ingest_files": (lambda: _ingest_files(*paths), len(stock) + len(sales), "records", True),
+        "prepare_records": (lambda: an._build_from_records(stock, sales), len(stock) + len(sales), "records", True),
+        "metrics_csr": (lambda: an._compute_metrics_numba_csr(*metrics_args), n_events, "events", True),
+        "metrics_csr_serial": (lambda: an._compute_metrics_serial_csr(*metrics_args), n_events, "events", False),
+        "abc": (lambda: an._assign_abc_numba(ds.sales_arr), n_codes, "codes", True),
+        "abc_serial": (lambda: an._assign_abc_serial(ds.sales_arr), n_codes, "codes", False),
+        "append_batch": (
+            lambda: an._append_batch(ds, added_stock, added_sales), len(added_stock) + len(added_sales), "records", False,
+        ),
+        "window_totals": (lambda: an._window_totals(ds, start_ts, end_ts), n_codes, "codes", True),
+        "format_rows": (
+            lambda: an._rows_json(
+                ds.abc_arr, ds.sales_arr, loss_amounts, loss_percents, osa_res,
+                ds.row_fragments, ds.row_frag_offsets, ds.codes, ds.name_by_code, ds.group_by_code),
+            n_codes, "rows", True,
+        ),
+    }
+
+
+def run(
+    codes: List[int], events: List[int], threads: List[int], stages: List[str] | None = None,
+    repeat: int = 5, days: int = 90, seed: int = 0,
+) -> Iterator[Result]:
+
+    base = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numba": nb.__version__,
+        "cpus": os.cpu_count(),
+        "threading_layer": os.getenv("NUMBA_THREADING_LAYER", "default"),
+    }
+    max_threads = nb.config.NUMBA_NUM_THREADS
+    with tempfile.TemporaryDirectory(prefix="rtu-bench-") as tmp:
+        for n_codes in codes:
+            for per_code in events:
+                stock, sales = generate(codes=n_codes, events=per_code, days=days, seed=seed)
+                paths = write_dumps(tmp, stock, sales)
+                ds = _ingest_files(*paths)
+                table = _stages(ds, stock, sales, paths)
+                for name, (fn, items, unit, threaded) in table.items():
+                    if stages and name not in stages:
+                        continue
+                    timings: Dict[int, float] = {}
+                    for t in (sorted(threads) if threaded else [1]):
+                        if t > max_threads:
+                            continue
+                        nb.set_num_threads(t)
+                        seconds = _best(fn, repeat)
+                        timings[t] = seconds
+                        yield {
+                            **base,
+                            "stage": name,
+                            "codes": n_codes,
+                            "events_per_code": per_code,
+                            "events": int(ds.times_flat.shape[0]),
+                            "threads": t,
+                            "seconds": seconds,
+                            "unit": unit,
+                            "rate": items / seconds if seconds > 0 else None,
+                            # Speedup over the smallest thread count measured.
+                            "speedup": timings[min(timings)] / seconds if seconds > 0 else None,
+                        }
+                nb.set_num_threads(max_threads)
+
+
+def _ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main(argv: list[str] | None = None) -> None:
+
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.kernels",
+        description="Time ingestion and the analytics kernels across dataset sizes and thread counts.",
+    )
+    parser.add_argument("--codes", type=_ints, default=[1_000, 10_000, 100_000])
+    parser.add_argument("--events", type=_ints, default=[30], help="mean stock events per code")
+    parser.add_argument("--threads", type=_ints, default=None,
+                        help="numba thread counts (default: 1, 2, 4, ... up to NUMBA_NUM_THREADS)")
+    parser.add_argument("--stages", default="", help="comma-separated subset of stages")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="", help="append JSON lines here instead of stdout")
+    args = parser.parse_args(argv)
+
+    threads = args.threads
+    if threads is None:
+        threads = [1 << k for k in range(nb.config.NUMBA_NUM_THREADS.bit_length())]
+        if threads[-1] != nb.config.NUMBA_NUM_THREADS:
+            threads.append(nb.config.NUMBA_NUM_THREADS)
+    stages = [s for s in args.stages.split(",") if s] or None
+
+    out = open(args.out, "ab") if args.out else sys.stdout.buffer
+    try:
+        for result in run(args.codes, args.events, threads, stages, args.repeat, args.days, args.seed):
+            out.write(orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")
+            out.flush()
+            print(
+                f"{result['stage']:>18} codes={result['codes']:<8} threads={result['threads']:<3} "
+                f"{result['seconds'] * 1e3:10.3f} ms  {result['rate'] or 0:14,.0f} {result['unit']}/s",
+                file=sys.stderr,
+            )
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
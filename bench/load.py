@@ -0,0 +1,384 @@
+from __future__ import annotations
+
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import subprocess
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import httpx
+import numpy as np
+import orjson
+
+from . import git_commit
+
+ROOT = Path(__file__).resolve().parents[1]
+PERCENTILES = (50.0, 75.0, 90.0, 95.0, 99.0, 99.9, 99.99)
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    path: str
+    body: bytes
+    weight: float = 1.0
+    headers: Tuple[Tuple[str, str], ...] = ()
+
+
+@dataclass
+class Stats:
+    # Latencies per scenario and completion times, both in seconds, the
+    # latter since the measured phase started; then response accounting.
+    latency: Dict[str, List[float]] = field(default_factory=dict)
+    done_at: List[float] = field(default_factory=list)
+    status: Counter = field(default_factory=Counter)
+    errors: int = 0
+    bytes_read: int = 0
+    elapsed: float = 0.0
+
+
+def read_token() -> str:
+    return (ROOT / "routes" / "LogPas.txt").read_text().split()[0]
+
+
+def _with_token(value: Any, token: str) -> Any:
+    if isinstance(value, str):
+        return value.replace("$TOKEN", token)
+    if isinstance(value, list):
+        return [_with_token(v, token) for v in value]
+    if isinstance(value, dict):
+        return {k: _with_token(v, token) for k, v in value.items()}
+    return value
+
+
+def builtin_scenarios(token: str, start: str, finish: str) -> Dict[str, Scenario]:
+
+    # "item" is the body script.lua sends to wrk.
+    window = {"token": token, "StartDate": start, "FinishDate": finish}
+    return {
+        "auth": Scenario("auth", "/auth/token", orjson.dumps({"email": "string", "password": "string"})),
+        "userid": Scenario("userid", "/userid/", orjson.dumps({"token": token})),
+        "item": Scenario("item", "/item-analytics/", orjson.dumps(window)),
+        "item-top": Scenario("item-top", "/item-analytics/", orjson.dumps({**window, "Limit": 50})),
+        "groups": Scenario("groups", "/item-analytics/groups", orjson.dumps(window)),
+    }
+
+
+def parse_mix(mix: str, known: Dict[str, Scenario]) -> List[Scenario]:
+
+    picked = []
+    for part in mix.split(","):
+        if not part:
+            continue
+        name, _, weight = part.partition("=")
+        if name not in known:
+            raise SystemExit(f"unknown scenario {name!r}; known: {', '.join(known)}")
+        scenario = known[name]
+        picked.append(Scenario(scenario.name, scenario.path, scenario.body, float(weight or 1), scenario.headers))
+    return picked
+
+
+def load_bodies(path: str, token: str) -> List[Scenario]:
+
+    # One JSON object per line: {"name", "path", "body", "weight", "headers"};
+    # "$TOKEN" anywhere in the body or headers becomes the token.
+    scenarios = []
+    with open(path, "rb") as f:
+        for n, line in enumerate(f):
+            if not line.strip():
+                continue
+            spec = _with_token(orjson.loads(line), token)
+            scenarios.append(Scenario(
+                spec.get("name") or f"line{n + 1}",
+                spec.get("path", "/item-analytics/"),
+                orjson.dumps(spec.get("body", {})),
+                float(spec.get("weight", 1)),
+                tuple((spec.get("headers") or {}).items()),
+            ))
+    return scenarios
+
+
+async def _connection(
+    client: httpx.AsyncClient, scenarios: List[Scenario], rng: random.Random,
+    measure_from: float, deadline: float, stats: Stats,
+) -> None:
+    weights = [s.weight for s in scenarios]
+    while time.perf_counter() < deadline:
+        scenario = rng.choices(scenarios, weights)[0]
+        t0 = time.perf_counter()
+        try:
+            resp = await client.post(
+                scenario.path, content=scenario.body,
+                headers={"content-type": "application/json", **dict(scenario.headers)},
+            )
+            body = resp.content
+        except httpx.HTTPError:
+            if time.perf_counter() >= measure_from:
+                stats.errors += 1
+            continue
+        t1 = time.perf_counter()
+        if t1 < measure_from:
+            continue
+        stats.latency.setdefault(scenario.name, []).append(t1 - t0)
+        stats.done_at.append(t1 - measure_from)
+        stats.status[resp.status_code] += 1
+        # Approximate wire size: the body plus one line per header.
+        stats.bytes_read += len(body) + sum(len(k) + len(v) + 4 for k, v in resp.headers.raw)
+
+
+async def run_load(
+    url: str, scenarios: List[Scenario], connections: int, duration: float, warmup: float = 0.0,
+    seed: int = 0, transport: httpx.AsyncBaseTransport | None = None, timeout: float = 30.0,
+) -> Stats:
+
+    stats = Stats()
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout, transport=transport) as client:
+        measure_from = time.perf_counter() + warmup
+        deadline = measure_from + duration
+        await asyncio.gather(*(
+            _connection(client, scenarios, random.Random(seed * 100_003 + i), measure_from, deadline, stats)
+            for i in range(connections)
+        ))
+        stats.elapsed = time.perf_counter() - measure_from
+    return stats
+
+
+def _process_main(args: Tuple[str, List[Scenario], int, float, float, int]) -> Stats:
+    return asyncio.run(run_load(*args))
+
+
+def _spread(total: int, parts: int) -> List[int]:
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def summarize(parts: List[Stats]) -> Dict[str, Any]:
+
+    # Each part is one client process, like one wrk thread.
+    elapsed = max((p.elapsed for p in parts), default=0.0)
+    names = sorted({name for p in parts for name in p.latency})
+    per_name = {
+        name: np.concatenate([np.asarray(p.latency.get(name, []), dtype=np.float64) for p in parts])
+        for name in names
+    }
+    latency = np.concatenate(list(per_name.values())) if per_name else np.empty(0)
+    requests = int(latency.shape[0])
+
+    rate_samples: List[float] = []
+    for p in parts:
+        whole = int(p.elapsed)
+        if whole >= 1:
+            done = np.asarray(p.done_at)
+            rate_samples.extend(np.bincount(done[done < whole].astype(np.int64), minlength=whole).tolist())
+        elif p.elapsed > 0:
+            rate_samples.append(len(p.done_at) / p.elapsed)
+
+    def dist(values: np.ndarray) -> Dict[str, Any]:
+        if values.shape[0] == 0:
+            return {"count": 0}
+        mean = float(values.mean())
+        std = float(values.std())
+        return {
+            "count": int(values.shape[0]),
+            "mean": mean,
+            "stdev": std,
+            "max": float(values.max()),
+            "within_stdev": float(np.mean(np.abs(values - mean) <= std)) * 100.0,
+            "percentiles": {f"{q:g}": float(v) for q, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))},
+        }
+
+    status: Counter = Counter()
+    for p in parts:
+        status.update(p.status)
+    return {
+        "duration": elapsed,
+        "processes": len(parts),
+        "requests": requests,
+        "rps": requests / elapsed if elapsed > 0 else 0.0,
+        "bytes_read": sum(p.bytes_read for p in parts),
+        "errors": sum(p.errors for p in parts),
+        "non_2xx": sum(n for code, n in status.items() if not 200 <= code < 400),
+        "status": {str(code): n for code, n in sorted(status.items())},
+        "latency": dist(latency),
+        "req_per_sec": dist(np.asarray(rate_samples, dtype=np.float64)),
+        "scenarios": {name: dist(values) for name, values in per_name.items()},
+    }
+
+
+def _fmt_time(seconds: float) -> str:
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.2f}us"
+    if seconds < 1.0:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds:.2f}s"
+
+
+def _fmt_count(n: float) -> str:
+    if n >= 1e6:
+        return f"{n / 1e6:.2f}M"
+    if n >= 1e3:
+        return f"{n / 1e3:.2f}k"
+    return f"{n:.2f}"
+
+
+def _fmt_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024.0 or unit == "GB":
+            return f"{n:.2f}{unit}"
+        n /= 1024.0
+    return f"{n:.2f}GB"
+
+
+def format_report(summary: Dict[str, Any], url: str, connections: int) -> str:
+
+    # The first block mirrors wrk's output so it can sit next to wrk-*.md.
+    dur = summary["duration"]
+    lat, rps = summary["latency"], summary["req_per_sec"]
+    lines = [
+        f"Running {dur / 60:.2f}m test @ {url}" if dur >= 60 else f"Running {dur:.2f}s test @ {url}",
+        f"  {summary['processes']} processes and {connections} connections",
+        "  Thread Stats   Avg      Stdev     Max   +/- Stdev",
+    ]
+    if lat["count"]:
+        lines.append(
+            f"    Latency {_fmt_time(lat['mean']):>9} {_fmt_time(lat['stdev']):>9} "
+            f"{_fmt_time(lat['max']):>9} {lat['within_stdev']:8.2f}%")
+    if rps["count"]:
+        lines.append(
+            f"    Req/Sec {_fmt_count(rps['mean']):>9} {_fmt_count(rps['stdev']):>9} "
+            f"{_fmt_count(rps['max']):>9} {rps['within_stdev']:8.2f}%")
+    if lat["count"]:
+        lines.append("  Latency Distribution")
+        for q, v in lat["percentiles"].items():
+            lines.append(f"  {q:>6}% {_fmt_time(v):>9}")
+    took = f"{dur / 60:.2f}m" if dur >= 60 else f"{dur:.2f}s"
+    lines.append(f"  {summary['requests']} requests in {took}, {_fmt_bytes(summary['bytes_read'])} read")
+    if summary["errors"]:
+        lines.append(f"  Socket errors: {summary['errors']}")
+    if summary["non_2xx"]:
+        lines.append(f"  Non-2xx or 3xx responses: {summary['non_2xx']}")
+    lines.append(f"Requests/sec: {summary['rps']:10.2f}")
+    lines.append(f"Transfer/sec: {_fmt_bytes(summary['bytes_read'] / dur if dur > 0 else 0.0):>10}")
+    if len(summary["scenarios"]) > 1:
+        lines.append("")
+        lines.append(f"  {'scenario':<12} {'count':>8} {'p50':>9} {'p90':>9} {'p99':>9} {'p99.9':>9} {'max':>9}")
+        for name, d in summary["scenarios"].items():
+            p = d["percentiles"]
+            lines.append(
+                f"  {name:<12} {d['count']:>8} {_fmt_time(p['50']):>9} {_fmt_time(p['90']):>9} "
+                f"{_fmt_time(p['99']):>9} {_fmt_time(p['99.9']):>9} {_fmt_time(d['max']):>9}")
+    return "\n".join(lines)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(port: int, workers: int, ready_timeout: float = 300.0) -> subprocess.Popen:
+
+    cmd = [
+        sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--no-server-header", "--log-level", "warning", "--lifespan", "on",
+    ]
+    proc = subprocess.Popen(cmd, cwd=ROOT)
+    # The lifespan loads the dumps and compiles the kernels before the
+    # socket accepts connections.
+    deadline = time.monotonic() + ready_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with status {proc.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("server did not start in time")
+
+
+def _seconds(value: str) -> float:
+    units = {"ms": 1e-3, "s": 1.0, "m": 60.0, "h": 3600.0}
+    for suffix in ("ms", "s", "m", "h"):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * units[suffix]
+    return float(value)
+
+
+def main(argv: list[str] | None = None) -> None:
+
+    parser = argparse.ArgumentParser(
+        prog="python -m bench.load",
+        description="Replay a weighted mix of request bodies against the service and report wrk-style results.",
+    )
+    parser.add_argument("--url", default="", help="running service; omit with --spawn")
+    parser.add_argument("--spawn", action="store_true", help="start uvicorn app.main:app on a free local port")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for --spawn")
+    parser.add_argument("-c", "--connections", type=int, default=64)
+    parser.add_argument("-p", "--processes", type=int, default=1, help="client processes (wrk threads)")
+    parser.add_argument("-d", "--duration", type=_seconds, default=30.0)
+    parser.add_argument("--warmup", type=_seconds, default=2.0)
+    parser.add_argument("--mix", default="item=1",
+                        help="weighted built-in scenarios: auth, userid, item, item-top, groups")
+    parser.add_argument("--bodies", default="", help="JSON lines of custom scenarios (replaces --mix)")
+    parser.add_argument("--start", default="01.01.2024")
+    parser.add_argument("--finish", default="3.01.2024")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json-out", default="", help="append the summary as a JSON line here")
+    args = parser.parse_args(argv)
+
+    token = read_token()
+    if args.bodies:
+        scenarios = load_bodies(args.bodies, token)
+    else:
+        scenarios = parse_mix(args.mix, builtin_scenarios(token, args.start, args.finish))
+    if not scenarios:
+        raise SystemExit("no scenarios to run")
+
+    server = None
+    url = args.url
+    if args.spawn:
+        port = _free_port()
+        server = spawn_server(port, args.workers)
+        url = f"http://127.0.0.1:{port}"
+    elif not url:
+        raise SystemExit("pass --url or --spawn")
+
+    try:
+        procs = max(1, min(args.processes, args.connections))
+        jobs = [
+            (url, scenarios, conns, args.duration, args.warmup, args.seed + i)
+            for i, conns in enumerate(_spread(args.connections, procs))
+        ]
+        if procs == 1:
+            parts = [_process_main(jobs[0])]
+        else:
+            with ProcessPoolExecutor(max_workers=procs) as pool:
+                parts = list(pool.map(_process_main, jobs))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    summary = summarize(parts)
+    print(format_report(summary, url, args.connections))
+    if args.json_out:
+        record = {
+            "url": url, "connections": args.connections, "workers": args.workers if args.spawn else None,
+            "scenarios": {s.name: s.weight for s in scenarios}, "time": time.time(),
+            "commit": git_commit(), **summary,
+        }
+        with open(args.json_out, "ab") as f:
+            f.write(orjson.dumps(record) + b"\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,743 @@
+from pathlib import Path
+import asyncio
+import fcntl
+import os
+import sys
+
+import numpy as np
+import orjson
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from app import analytics as an
+from app import ingest as ingest_mod
+from app import journal as journal_mod
+from app import shm as shm_mod
+from bench import differential as diff_mod
+from bench import generate as gen_mod
+
+
+def _linear_osa(times, starts, ends, start_ts, end_ts):
+    avail = 0.0
+    balance = starts[0]
+    current = start_ts
+    for t, end_val in zip(times, ends):
+        if t < start_ts:
+            balance = end_val
+            continue
+        if t > end_ts:
+            break
+        if balance > 0:
+            avail += t - current
+        balance = end_val
+        current = t
+    if current < end_ts and balance > 0:
+        avail += end_ts - current
+    return 100.0 * avail / (end_ts - start_ts)
+
+
+def _random_csr(rng, n_codes, max_events):
+    lengths = rng.integers(1, max_events, size=n_codes)
+    offsets = np.zeros(n_codes + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    times = np.empty(offsets[-1], dtype=np.float64)
+    for i in range(n_codes):
+        steps = rng.integers(0, 5, size=lengths[i]) * 3600.0
+        times[offsets[i]:offsets[i + 1]] = 1_700_000_000.0 + np.cumsum(steps)
+    starts = rng.integers(0, 3, size=offsets[-1]).astype(np.float64)
+    ends = rng.integers(0, 3, size=offsets[-1]).astype(np.float64)
+    return offsets, times, starts, ends
+
+
+def _compact(offsets, times, starts, ends):
+    epoch, rel, opened, flags, prefix = an._compact_events(offsets, times, starts, ends)
+    return epoch, (rel, opened, flags, prefix, offsets, an._NO_EVENTS)
+
+
+def test_prefix_osa_matches_linear_walk():
+    rng = np.random.default_rng(7)
+    n_codes = 50
+    offsets, times, starts, ends = _random_csr(rng, n_codes, 40)
+    epoch, events = _compact(offsets, times, starts, ends)
+    assert events[0].dtype == np.int32 and events[3].dtype == np.int32
+    ones = np.ones(n_codes, dtype=np.float64)
+
+    for _ in range(20):
+        a, b = np.sort(rng.integers(-10, 200, size=2))
+        start_ts = 1_700_000_000.0 + a * 3600.0
+        end_ts = start_ts + (b - a + 1) * 3600.0
+        osa, _, _ = an._compute_metrics_numba_csr(
+            *events, start_ts - epoch, end_ts - epoch, ones, ones, ones
+        )
+        for i in range(n_codes):
+            s, e = offsets[i], offsets[i + 1]
+            expected = _linear_osa(times[s:e], starts[s:e], ends[s:e], start_ts, end_ts)
+            assert abs(osa[i] - expected) < 1e-9
+
+
+def test_osa_window_after_last_event_is_capped():
+    offsets = np.array([0, 2], dtype=np.int64)
+    times = np.array([1_700_000_000.0, 1_700_003_600.0])
+    starts = np.array([1.0, 1.0])
+    ends = np.array([1.0, 1.0])
+    epoch, events = _compact(offsets, times, starts, ends)
+    ones = np.ones(1, dtype=np.float64)
+    start_ts = 1_700_086_400.0 - epoch
+    osa, _, _ = an._compute_metrics_numba_csr(
+        *events, start_ts, start_ts + 86_400.0, ones, ones, ones
+    )
+    assert osa[0] == 100.0
+
+
+def test_range_batch_kernel_matches_single_range_kernel():
+    rng = np.random.default_rng(11)
+    n_codes = 40
+    offsets, times, starts, ends = _random_csr(rng, n_codes, 30)
+    epoch, events = _compact(offsets, times, starts, ends)
+    sales = rng.random(n_codes) * 100.0
+    price = rng.random(n_codes) * 10.0
+    lossq = rng.random(n_codes)
+
+    edges = np.sort(rng.integers(-10, 200, size=(25, 2)), axis=1) * 3600.0 + 1_700_000_000.0 - epoch
+    edges[3] = edges[4]
+    bounds, inverse = np.unique(edges.ravel(), return_inverse=True)
+    inverse = inverse.reshape(edges.shape).astype(np.int64)
+    osa, loss, lop = an._compute_metrics_numba_ranges(
+        *events, bounds, inverse[:, 0].copy(), inverse[:, 1].copy(), sales, price, lossq
+    )
+    assert osa.shape == (25, n_codes)
+    for r, (start_ts, end_ts) in enumerate(edges):
+        exp_osa, exp_loss, exp_lop = an._compute_metrics_numba_csr(
+            *events, start_ts, end_ts, sales, price, lossq
+        )
+        assert np.allclose(osa[r], exp_osa, rtol=0, atol=1e-9)
+        assert np.array_equal(loss, exp_loss)
+        assert np.array_equal(lop, exp_lop)
+
+
+def test_serial_kernels_match_parallel_and_calibration(monkeypatch):
+    rng = np.random.default_rng(5)
+    n_codes = 60
+    offsets, times, starts, ends = _random_csr(rng, n_codes, 20)
+    epoch, events = _compact(offsets, times, starts, ends)
+    sales = rng.random(n_codes) * 100.0
+    args = events + (1_700_010_000.0 - epoch, 1_700_200_000.0 - epoch, sales, sales, sales)
+    for par, ser in zip(an._compute_metrics_numba_csr(*args), an._compute_metrics_serial_csr(*args)):
+        assert np.allclose(par, ser, rtol=0, atol=1e-9)
+
+    rows = np.array([5, 0, 42], dtype=np.int64)
+    rows_args = args[:6] + (rows,) + args[6:]
+    for par, ser in zip(an._compute_metrics_numba_rows(*rows_args), an._compute_metrics_serial_rows(*rows_args)):
+        assert np.allclose(par, ser, rtol=0, atol=1e-9)
+
+    for par, ser in zip(an._assign_abc_numba(sales), an._assign_abc_serial(sales)):
+        assert np.array_equal(par, ser)
+
+    monkeypatch.setattr(an, "_metrics_parallel_min", an._metrics_parallel_min)
+    monkeypatch.setattr(an, "_abc_parallel_min", an._abc_parallel_min)
+    thresholds = an.calibrate_kernels()
+    assert thresholds["metrics"] > 0 and thresholds["abc"] > 0
+    monkeypatch.setattr(an, "PARALLEL_MIN_WORK", 0)
+    assert an.calibrate_kernels() == {"metrics": 0, "abc": 0}
+
+
+def test_fast_row_formatter_matches_orjson_rows():
+    rng = np.random.default_rng(3)
+    n = 300
+    codes = [f"C{i}" for i in range(n)]
+    names = {c: f"Товар \"{c}\"\\n" for c in codes}
+    groups = {c: "Группа 🤔" for c in codes}
+    sales = rng.random(n) * 1e6
+    loss = rng.random(n) * 1e3
+    lop = rng.random(n) * 10.0
+    osa = rng.random(n) * 100.0
+    osa[:5] = [0.0, 100.0, 0.004, 0.005, 99.995]
+    # Decimal ties on both sides of zero; period sales go negative with refunds.
+    sales[5:12] = [-202.635, -0.005, 2.675, -1.005, 1.005, -0.125, -12345.675]
+    loss[5:9] = [-3.345, 3.345, -0.015, 0.015]
+    lop[5:9] = [-1.0005, 1.0005, -2.0015, 2.0015]
+    _, abc = an._assign_abc_numba(sales)
+    fragments, frag_offsets = an._build_row_fragments(codes, names, groups)
+
+    fast = an._rows_json(abc, sales, loss, lop, osa,
+                         fragments, frag_offsets, codes, names, groups)
+    huge = sales.copy()
+    huge[0] = 1e13
+    slow = an._rows_json(abc, huge, loss, lop, osa,
+                         fragments, frag_offsets, codes, names, groups)
+
+    expected = orjson.loads(slow)
+    expected[0]["Sales"] = round(float(sales[0]), 2)
+    assert orjson.loads(fast) == expected
+    assert an._rows_json(abc[:0], sales, loss, lop, osa,
+                         fragments, frag_offsets, codes, names, groups) == b"[]"
+
+
+def test_install_keeps_dataset_in_abc_rank_order():
+    an._install_csr(
+        ["low", "top", "mid"],
+        np.array([0, 1, 3, 3], dtype=np.int64),
+        np.array([1.0, 2.0, 3.0]),
+        np.array([10.0, 20.0, 21.0]),
+        np.array([11.0, 22.0, 23.0]),
+        np.array([5.0, 80.0, 15.0]),
+        np.array([0.1, 0.9, 0.5]),
+        np.array([0.0, 1.0, 2.0]),
+        {},
+        {},
+    )
+    ds = an._DATASET
+    assert ds.codes == ["top", "mid", "low"]
+    assert ds.offsets.tolist() == [0, 2, 2, 3]
+    assert ds.epoch == 1.0
+    assert ds.times_flat.dtype == np.int32
+    assert ds.times_flat.tolist() == [1, 2, 0]
+    assert ds.end_flags.tolist() == [1, 1, 1]
+    assert ds.open_flags.tolist() == [1, 0, 1]
+    assert ds.price_arr.tolist() == [0.9, 0.5, 0.1]
+    assert bytes(ds.abc_arr).decode() == "ABC"
+
+
+def _write_dumps(tmp_path, sales_sum):
+    stock = [{
+        "НоменклатураКод": "1", "Номенклатура": "A", "Родитель": "G",
+        "Период": "01.01.2024", "НачальныйОстаток": 1, "КонечныйОстаток": 1,
+    }]
+    sales = [{"Код": "1", "Номенклатура": "A", "Количество": 1, "Сумма": sales_sum}]
+    (tmp_path / "stock.json").write_bytes(orjson.dumps(stock))
+    (tmp_path / "sales.json").write_bytes(orjson.dumps(sales))
+
+
+def test_reload_swaps_snapshot_when_dumps_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(an, "STOCK_DUMP", str(tmp_path / "stock.json"))
+    monkeypatch.setattr(an, "SALES_DUMP", str(tmp_path / "sales.json"))
+    monkeypatch.setattr(an, "SNAPSHOT_PATH", "")
+    _write_dumps(tmp_path, 10)
+    an._install_dataset(an._load_dataset())
+    old = an._DATASET
+
+    assert asyncio.run(an._reload_if_changed()) is False
+
+    _write_dumps(tmp_path, 20.5)
+    os.utime(tmp_path / "sales.json", ns=(0, 1))
+    assert asyncio.run(an._reload_if_changed()) is True
+    new = an._DATASET
+    assert new is not old and new.version > old.version
+    assert old.sales_arr.tolist() == [10.0]
+    assert new.sales_arr.tolist() == [20.5]
+    assert not new.times_flat.flags.writeable
+
+    (tmp_path / "sales.json").write_bytes(b"[{")
+    assert asyncio.run(an._reload_if_changed()) is False
+    assert an._DATASET is new
+
+
+def _tricky_dumps():
+    stock = [
+        {"НоменклатураКод": "1", "Номенклатура": "Товар {1}", "Родитель": "G\"1\"",
+         "Период": "02.01.2024 10:00:00", "НачальныйОстаток": 3, "КонечныйОстаток": 0},
+        {"НоменклатураКод": "2", "Номенклатура": "Товар ]2[", "Родитель": None,
+         "Период": "01.01.2024", "НачальныйОстаток": 5, "КонечныйОстаток": 4,
+         "СтатьяРасходов": "Порча на складах (94)", "Extra": {"nested": [1, {"x": "}"}]}},
+        {"НоменклатураКод": "1", "Номенклатура": "Товар {1}", "Родитель": "G\"1\"",
+         "Период": "01.01.2024 10:00", "НачальныйОстаток": 0, "КонечныйОстаток": 3},
+        {"НоменклатураКод": "1", "Период": "bad", "НачальныйОстаток": 1, "КонечныйОстаток": 1},
+        {"НоменклатураКод": "3", "Номенклатура": "Без продаж", "Период": "01.01.2024"},
+        {"НоменклатураКод": "", "Период": "01.01.2024"},
+    ]
+    sales = [
+        {"Код": "2", "Номенклатура": "Товар 2\\\\", "Количество": 2, "Сумма": 200},
+        {"Код": "1", "Номенклатура": None, "Количество": 1, "Сумма": 150.5},
+        {"Код": "4", "Номенклатура": "Только продажи", "Количество": 0, "Сумма": 10},
+        {"Код": "3", "Количество": 1, "Сумма": 0},
+    ]
+    return stock, sales
+
+
+def _assert_same_dataset(a, b):
+    assert a.codes == b.codes
+    assert a.epoch == b.epoch
+    for field in ("offsets", "times_flat", "open_flags", "end_flags", "avail_prefix",
+                  "sales_arr", "price_arr", "lossq_arr", "abc_arr",
+                  "ledger_offsets", "ledger_times", "ledger_sales", "ledger_loss",
+                  "base_sales", "base_loss", "row_fragments", "row_frag_offsets"):
+        assert np.array_equal(getattr(a, field), getattr(b, field)), field
+    assert a.name_by_code == b.name_by_code
+    assert a.group_by_code == b.group_by_code
+
+
+def test_period_sales_use_only_entries_inside_the_window():
+    stock = [
+        {"НоменклатураКод": code, "Номенклатура": code, "Родитель": "G",
+         "Период": "01.02.2024", "НачальныйОстаток": 1, "КонечныйОстаток": 1}
+        for code in ("a", "b", "c")
+    ] + [
+        {"НоменклатураКод": "a", "Период": "03.02.2024 12:00:00", "НачальныйОстаток": 5,
+         "КонечныйОстаток": 2, "СтатьяРасходов": "Порча на складах (94)"},
+        {"НоменклатураКод": "b", "Период": "10.02.2024", "НачальныйОстаток": 4,
+         "КонечныйОстаток": 3, "СтатьяРасходов": "Порча на складах (94)"},
+        {"НоменклатураКод": "c", "Период": "", "НачальныйОстаток": 2,
+         "КонечныйОстаток": 1, "СтатьяРасходов": "Порча на складах (94)"},
+    ]
+    sales = [
+        {"Код": "a", "Период": "02.02.2024 09:00:00", "Количество": 1, "Сумма": 10},
+        {"Код": "a", "Период": "20.02.2024", "Количество": 1, "Сумма": 10},
+        {"Код": "b", "Период": "05.02.2024", "Количество": 10, "Сумма": 100},
+        {"Код": "b", "Период": "06.02.2024", "Количество": 10, "Сумма": 100},
+        {"Код": "c", "Количество": 1, "Сумма": 5},
+    ]
+    ds = an._build_from_records(stock, sales)
+    assert [row["Code"] for row in orjson.loads(an._rows_body(ds, 0.0, 2e9, None))] == ["b", "a", "c"]
+
+    def period(start, finish, selection=None):
+        start_ts, end_ts = an._parse_window(start, finish)
+        rows = orjson.loads(an._rows_body(ds, start_ts, end_ts, selection, period=True))
+        return {row["Code"]: row for row in rows}, [row["Code"] for row in rows]
+
+    rows, order = period("01.02.2024", "04.02.2024")
+    assert order == ["a", "c", "b"]
+    assert (rows["a"]["Sales"], rows["b"]["Sales"], rows["c"]["Sales"]) == (10.0, 0.0, 5.0)
+    # Spoilage of 3 in the window at the all-time price of 10, plus c's
+    # undated spoilage which counts in every window.
+    assert rows["a"]["Loss"] == 30.0 and rows["a"]["LossOfProfit"] == 300.0
+    assert rows["b"]["Loss"] == 0.0 and rows["c"]["Loss"] == 5.0
+    assert [rows[c]["ABC"] for c in order] == ["A", "C", "C"]
+
+    rows, order = period("05.02.2024", "05.02.2024")
+    assert order[0] == "b" and rows["b"]["Sales"] == 100.0 and rows["a"]["Sales"] == 0.0
+
+    rows, order = period("01.02.2024", "29.02.2024")
+    assert (rows["a"]["Sales"], rows["b"]["Sales"]) == (20.0, 200.0)
+    assert rows["b"]["Loss"] == 10.0
+
+    _, order = period("01.02.2024", "04.02.2024", (None, "C", None, 0, None))
+    assert order == ["c", "b"]
+
+    # Without dated entries the window totals are the all-time totals.
+    undated = an._build_from_records(stock[:3], [dict(rec, Период="") for rec in sales])
+    start_ts, end_ts = an._parse_window("01.02.2024", "04.02.2024")
+    assert an._rows_body(undated, start_ts, end_ts, None, period=True) == \
+        an._rows_body(undated, start_ts, end_ts, None)
+
+
+def test_streaming_ingest_matches_in_memory_build(tmp_path):
+    stock, sales = _tricky_dumps()
+    stock_path = tmp_path / "stock.json"
+    sales_path = tmp_path / "sales.json"
+    stock_path.write_bytes(orjson.dumps(stock, option=orjson.OPT_INDENT_2))
+    sales_path.write_bytes(orjson.dumps(sales))
+    expected = an._build_from_records(stock, sales)
+
+    for chunk in (1, 7, 64, 1 << 20):
+        ingest = ingest_mod.DumpIngest()
+        for batch in ingest_mod.iter_json_batches(str(stock_path), chunk):
+            assert len(batch) <= len(stock)
+            ingest.add_stock(batch)
+        for batch in ingest_mod.iter_json_batches(str(sales_path), chunk):
+            ingest.add_sales(batch)
+        parts = ingest.csr()
+        _assert_same_dataset(an._build_dataset(*parts, ledger=ingest.ledger(parts[0])), expected)
+
+
+def test_synthetic_dumps_load_like_real_ones(tmp_path):
+    stock, sales = gen_mod.generate(codes=40, events=6, days=10, spoilage=0.2, dead=0.1, seed=3)
+    assert gen_mod.generate(codes=40, events=6, days=10, spoilage=0.2, dead=0.1, seed=3) == (stock, sales)
+    assert any(item.get("СтатьяРасходов") == ingest_mod.SPOILAGE for item in stock)
+    expected = an._build_from_records(stock, sales)
+    assert len(expected.codes) == len({rec["Код"] for rec in sales})
+    assert expected.lossq_arr.sum() > 0
+
+    ingest = ingest_mod.DumpIngest()
+    for path, add in zip(gen_mod.write_dumps(str(tmp_path), stock, sales), (ingest.add_stock, ingest.add_sales)):
+        for batch in ingest_mod.iter_json_batches(path, 4096):
+            add(batch)
+    parts = ingest.csr()
+    _assert_same_dataset(an._build_dataset(*parts, ledger=ingest.ledger(parts[0])), expected)
+
+
+def test_engine_agrees_with_legacy_service():
+    stock, sales = gen_mod.generate(codes=60, events=8, days=20, spoilage=0.1, seed=5, snap=3600)
+    report = diff_mod.compare(stock, sales, diff_mod.default_windows("01.01.2024", 20))
+    for window in report["windows"]:
+        assert window["rows"] == report["codes"]
+        assert window["differences"] == []
+    # A perturbed row must be reported.
+    rows, _ = diff_mod.run_app(an._build_from_records(stock, sales), ("01.01.2024", "20.01.2024"))
+    legacy_rows, _ = diff_mod.run_legacy(stock, sales, ("01.01.2024", "20.01.2024"))
+    rows[0]["OSA"] += 1.0
+    assert [d["field"] for d in diff_mod.diff_rows(legacy_rows, rows)] == ["OSA"]
+
+
+def test_streaming_ingest_rejects_truncated_dump(tmp_path):
+    path = tmp_path / "stock.json"
+    path.write_bytes(b'[{"a": 1}, {"b": ')
+    try:
+        list(ingest_mod.iter_json_batches(str(path), 4))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("truncated dump accepted")
+    path.write_bytes(b'{"not": [{"a": 1}]}')
+    assert list(ingest_mod.iter_json_batches(str(path))) == []
+
+
+def _reference_csr(stock, sales):
+    events, loss, names, groups = {}, {}, {}, {}
+    for item in stock:
+        code = str(item.get("НоменклатураКод", "")).strip()
+        if not code:
+            continue
+        names[code] = item.get("Номенклатура")
+        groups[code] = item.get("Родитель") or "Без группы 🤔"
+        sv = float(item.get("НачальныйОстаток", 0) or 0.0)
+        ev = float(item.get("КонечныйОстаток", 0) or 0.0)
+        dt = ingest_mod._parse_dt(str(item.get("Период", "")))
+        if dt is not None:
+            events.setdefault(code, []).append((dt, sv, ev))
+        if item.get("СтатьяРасходов") == "Порча на складах (94)" and sv - ev > 0.0:
+            loss[code] = loss.get(code, 0.0) + sv - ev
+    totals = {}
+    for rec in sales:
+        code = str(rec.get("Код", "")).strip()
+        if code:
+            totals[code] = totals.get(code, 0.0) + float(rec.get("Сумма", 0) or 0.0)
+    codes = [c for c, v in totals.items() if v > 0.0]
+    times, offsets = [], [0]
+    for code in codes:
+        evs = sorted(events.get(code, []), key=lambda x: x[0])
+        times.extend((dt.timestamp(), sv, ev) for dt, sv, ev in evs)
+        offsets.append(len(times))
+    return codes, offsets, times, [loss.get(c, 0.0) for c in codes]
+
+
+def test_vectorized_ingest_matches_per_record_parsing():
+    periods = [
+        "01.01.2024", "1.1.2024 7:05", "02.01.2024  10:00:00", "02.01.2024\t10:00",
+        "29.02.2024 23:59:59", "29.02.2023", "31.04.2024", "01.01.2024 24:00",
+        "01.01.2024 10:00:60", "01.01.2024 10:0:5", "٠١.01.2024", "01.01.24",
+        "01.01.2024 ", "", "None", "15.06.2024 12:30", "01.13.2024", "00.01.2024",
+        "31.12.1999 23:00:00", "27.10.2024 02:30:00", "10.03.2024 02:30",
+    ]
+    rng = np.random.default_rng(11)
+    stock = []
+    for k in range(400):
+        stock.append({
+            "НоменклатураКод": str(rng.integers(0, 25)),
+            "Номенклатура": f"N{k}",
+            "Родитель": None if k % 7 == 0 else f"G{k % 3}",
+            "Период": periods[k % len(periods)] if k % 5 else f"{rng.integers(1, 29):02d}.0{rng.integers(1, 9)}.2024 {rng.integers(0, 24)}:{rng.integers(0, 60):02d}",
+            "НачальныйОстаток": int(rng.integers(0, 4)),
+            "КонечныйОстаток": None if k % 11 == 0 else int(rng.integers(0, 4)),
+            "СтатьяРасходов": "Порча на складах (94)" if k % 6 == 0 else "",
+        })
+    sales = [{"Код": str(c), "Количество": 1, "Сумма": float(c)} for c in range(-2, 30)]
+
+    codes, offsets, events, loss = _reference_csr(stock, sales)
+    ingest = ingest_mod.DumpIngest()
+    ingest.add_stock(stock[:150])
+    ingest.add_stock(stock[150:])
+    ingest.add_sales(sales)
+    got = ingest.csr()
+    assert got[0] == codes
+    assert got[1].tolist() == offsets
+    assert got[2].tolist() == [t for t, _, _ in events]
+    assert got[3].tolist() == [s for _, s, _ in events]
+    assert got[4].tolist() == [e for _, _, e in events]
+    assert got[7].tolist() == loss
+
+    expected = [ingest_mod._parse_dt(p) for p in periods]
+    parsed = ingest_mod.parse_periods(periods)
+    for value, dt in zip(parsed.tolist(), expected):
+        assert (np.isnan(value) and dt is None) or value == dt.timestamp()
+
+
+def test_snapshot_file_is_reused_until_sources_change(tmp_path, monkeypatch):
+    stock, sales = _tricky_dumps()
+    monkeypatch.setattr(an, "STOCK_DUMP", str(tmp_path / "stock.json"))
+    monkeypatch.setattr(an, "SALES_DUMP", str(tmp_path / "sales.json"))
+    monkeypatch.setattr(an, "SNAPSHOT_PATH", str(tmp_path / "data.snapshot"))
+    (tmp_path / "stock.json").write_bytes(orjson.dumps(stock))
+    (tmp_path / "sales.json").write_bytes(orjson.dumps(sales))
+
+    parsed = an._parse_dumps(an._dump_stamp())
+    first = an._load_dataset()
+    assert (tmp_path / "data.snapshot").exists()
+    assert not os.path.exists(str(tmp_path / "data.snapshot.lock"))
+    assert first.codes == parsed.codes
+    for field in an._SNAPSHOT_ARRAYS:
+        assert np.array_equal(getattr(first, field), getattr(parsed, field)), field
+    assert not first.times_flat.flags.writeable
+    assert all(first.name_by_code[c] == parsed.name_by_code[c] for c in parsed.codes)
+    # Row lookups read the sorted codes in the mapped file.
+    assert isinstance(first.index_by_code, an._CodeIndex)
+    assert dict(first.index_by_code) == parsed.index_by_code
+    assert first.index_by_code.get("missing") is None and first.index_by_code.get(1) is None
+    # Codes without sales keep their dump data for later appends.
+    assert first.unsold.parts[0] == parsed.unsold.parts[0] == ["3"]
+    for a, b in zip(first.unsold.parts[1:12], parsed.unsold.parts[1:12]):
+        assert np.array_equal(a, b, equal_nan=True)
+    assert first.unsold.parts[12:] == parsed.unsold.parts[12:] == (["Без продаж"], [None], [ingest_mod.NO_GROUP])
+
+    calls = []
+    monkeypatch.setattr(an, "_parse_dumps", lambda source: calls.append(source))
+    os.utime(tmp_path / "sales.json", ns=(0, 12345))
+    second = an._load_dataset()
+    assert calls == []
+    assert second.version != first.version
+    assert np.array_equal(second.sales_arr, first.sales_arr)
+
+    (tmp_path / "sales.json").write_bytes(orjson.dumps(sales[:1]))
+    monkeypatch.setattr(an, "_parse_dumps", lambda source: calls.append(source) or parsed)
+    an._load_dataset()
+    assert len(calls) == 1
+
+    # Dumps replaced while they are parsed are served but not saved under
+    # either checksum; the next load parses the new ones.
+    def replaced_mid_parse(source):
+        calls.append(source)
+        (tmp_path / "sales.json").write_bytes(orjson.dumps(sales))
+        return parsed
+
+    os.unlink(tmp_path / "data.snapshot")
+    monkeypatch.setattr(an, "_parse_dumps", replaced_mid_parse)
+    assert an._load_dataset() is parsed
+    assert len(calls) == 2 and not (tmp_path / "data.snapshot").exists()
+
+
+def test_shared_memory_publish_and_attach(monkeypatch):
+    stock, sales = _tricky_dumps()
+    ds = an._build_from_records(stock, sales)
+    name = f"rtu-test-{os.getpid()}"
+    publisher = shm_mod.Publisher(name)
+    try:
+        monkeypatch.setattr(an, "SHM_NAME", name)
+        assert an._attach_shared() is None
+
+        publisher.publish(*an._snapshot_parts(ds))
+        first = an._attach_shared()
+        assert first.generation == 1
+        assert first.codes == ds.codes
+        for field in an._SNAPSHOT_ARRAYS:
+            assert np.array_equal(getattr(first, field), getattr(ds, field)), field
+        assert not first.offsets.flags.writeable
+
+        an._install_dataset(first)
+        assert asyncio.run(an._reload_if_changed()) is False
+        empty = an._build_from_records([], [])
+        publisher.publish(*an._snapshot_parts(empty))
+        publisher.publish(*an._snapshot_parts(empty))
+        publisher.publish(*an._snapshot_parts(ds))
+        assert asyncio.run(an._reload_if_changed()) is True
+        assert an._DATASET.generation == 4
+        assert first.sales_arr.tolist() == ds.sales_arr.tolist()
+    finally:
+        publisher.close()
+    assert shm_mod.current_generation(name) is None
+
+
+def _split_appends(seed):
+    # A base dump and two append batches that add up to the generated
+    # dumps: every seventh code arrives only through the appends, every
+    # seventh from the fourth has its stock in the base but sells only in
+    # the appends, the rest get their history split at random (also
+    # before base events).
+    stock, sales = gen_mod.generate(codes=50, events=6, days=10, spoilage=0.2, dead=0.1, seed=seed)
+    rng = np.random.default_rng(seed)
+    late = {str(100_000 + i) for i in range(0, 50, 7)}
+    joining = {str(100_000 + i) for i in range(3, 50, 7)}
+    parts = ([], [], []), ([], [], [])
+    # A code's first record of each kind stays in the base, which is where
+    # names, groups and the code itself come from.
+    for records, key, target in ((stock, "НоменклатураКод", parts[0]), (sales, "Код", parts[1])):
+        seen = set()
+        for rec in records:
+            code = rec[key]
+            if code in late or (code in joining and key == "Код"):
+                part = int(rng.integers(1, 3)) if code in joining else 2
+            else:
+                part = int(rng.integers(0, 3)) if code in seen else 0
+            target[part].append(rec)
+            seen.add(code)
+    return stock, sales, parts, joining
+
+
+def _assert_same_rows(a, b):
+    a, b = orjson.loads(a), orjson.loads(b)
+    assert [row["Code"] for row in a] == [row["Code"] for row in b]
+    for x, y in zip(a, b):
+        for key, value in x.items():
+            if isinstance(value, float):
+                assert abs(value - y[key]) <= 0.011, (x["Code"], key)
+            else:
+                assert value == y[key], (x["Code"], key)
+
+
+def test_appended_batches_match_a_full_rebuild(monkeypatch):
+    monkeypatch.setattr(an, "APPEND_LOG", "")
+    stock, sales, (stock_parts, sales_parts), joining = _split_appends(7)
+    base = an._build_from_records(stock_parts[0], sales_parts[0])
+    mid = an._append_batch(base, stock_parts[1], sales_parts[1])
+    assert mid.delta.pending and base.delta is None
+    final = an._append_batch(mid, stock_parts[2], sales_parts[2])
+    full = an._build_from_records(stock, sales)
+    # Appends only grow the overlay, the base arrays stay shared until a
+    # request folds it in.
+    assert final.sales_arr is base.sales_arr and final.name_by_code is base.name_by_code
+    assert len(final.delta.rows) == len(final.delta.values) == an._row_count(final) > len(base.codes)
+    folded = an._folded(final)
+    assert an._folded(final) is folded and folded.version == final.version
+    # Codes with dump stock but no sales yet join with their dump history.
+    joined = joining & set(full.codes)
+    assert joined and joined <= set(base.unsold.index) and joined <= set(folded.codes)
+    assert sorted(folded.codes) == sorted(full.codes) and len(folded.codes) > len(base.codes)
+    assert set(final.delta.pending) == set(mid.delta.pending) - set(full.codes)
+
+    windows = [an._parse_window("01.01.2024", "10.01.2024"), an._parse_window("03.01.2024", "05.01.2024")]
+    for start_ts, end_ts in windows:
+        for selection in (None, (None, "AB", None, 0, None)):
+            for period in (False, True):
+                _assert_same_rows(an._rows_body(final, start_ts, end_ts, selection, period),
+                                  an._rows_body(full, start_ts, end_ts, selection, period))
+    for a, b in zip(an._ranges_bodies(final, windows), an._ranges_bodies(full, windows)):
+        _assert_same_rows(a, b)
+    labels, edges = an._bucket_edges("01.01.2024", "10.01.2024", 2)
+    assert orjson.loads(an._series_body(final, labels, edges, None)).keys() == \
+        orjson.loads(an._series_body(full, labels, edges, None)).keys()
+
+    # A compacted base, with the later batch appended to it, serves the
+    # same numbers without a delta.
+    for ds in (an._compacted(final), an._append_batch(an._compacted(mid), stock_parts[2], sales_parts[2])):
+        for start_ts, end_ts in windows:
+            _assert_same_rows(an._rows_body(ds, start_ts, end_ts, None, True),
+                              an._rows_body(full, start_ts, end_ts, None, True))
+    compacted = an._compacted(final)
+    assert an._delta_size(compacted.delta) == 0 and compacted.rank is None
+    assert not compacted.delta.pending and set(final.delta.pending) <= set(compacted.unsold.index)
+
+
+def test_append_log_is_followed_by_other_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(an, "APPEND_LOG", str(tmp_path / "appends"))
+    stock, sales, (stock_parts, sales_parts), _ = _split_appends(11)
+    base = an._build_from_records(stock_parts[0], sales_parts[0])
+    first = an._append_logged(base, stock_parts[1], sales_parts[1])
+    # The second worker still holds the base and catches up before its own batch.
+    second = an._append_logged(base, stock_parts[2], sales_parts[2])
+    # Entries logged against other dumps are skipped.
+    journal_mod.append_entry(an.APPEND_LOG, {"source": [["other", 0, 0]], "Stock": stock_parts[1], "Sales": []})
+    followed = an._follow_log(first)
+    assert followed.delta.log_offset == journal_mod.read_entries(an.APPEND_LOG, 0)[2]
+    assert followed.delta.batches == second.delta.batches == 2
+
+    full = an._build_from_records(stock, sales)
+    start_ts, end_ts = an._parse_window("01.01.2024", "10.01.2024")
+    for ds in (followed, second):
+        _assert_same_rows(an._rows_body(ds, start_ts, end_ts, None, True),
+                          an._rows_body(full, start_ts, end_ts, None, True))
+
+    with pytest.raises(ValueError):
+        an._append_logged(followed, ["not a record"], [])
+    assert journal_mod.read_entries(an.APPEND_LOG, 0)[2] == followed.delta.log_offset
+
+    # Another writer waits for the lock instead of going on without it.
+    with journal_mod.locked(an.APPEND_LOG):
+        fd = os.open(an.APPEND_LOG + ".lock", os.O_RDWR)
+        try:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            os.close(fd)
+
+
+def test_compaction_and_reload_rotate_the_append_log(tmp_path, monkeypatch):
+    monkeypatch.setattr(an, "APPEND_LOG", str(tmp_path / "appends"))
+    monkeypatch.setattr(an, "SNAPSHOT_PATH", str(tmp_path / "data.snapshot"))
+    monkeypatch.setattr(an, "SHM_NAME", "")
+    monkeypatch.setattr(an, "STOCK_DUMP", str(tmp_path / "stock.json"))
+    monkeypatch.setattr(an, "SALES_DUMP", str(tmp_path / "sales.json"))
+    stock, sales, (stock_parts, sales_parts), _ = _split_appends(13)
+    (tmp_path / "stock.json").write_bytes(orjson.dumps(stock_parts[0]))
+    (tmp_path / "sales.json").write_bytes(orjson.dumps(sales_parts[0]))
+    first, second = an._load_dataset(), an._load_dataset()
+
+    first = an._append_logged(first, stock_parts[1], sales_parts[1])
+    folded = an._compacted(first)
+    assert folded.journal == first.delta.log_offset > 0
+    assert an._save_compacted(folded)
+    header = journal_mod.read_header(an.APPEND_LOG)
+    assert header["start"] == header["folded"] == folded.journal
+    assert journal_mod.read_entries(an.APPEND_LOG, 0)[1] == []
+    after = an._append_logged(folded, stock_parts[2], sales_parts[2])
+
+    # Workers behind the rotation, or just started, load the compacted
+    # snapshot and replay only what was logged after it.
+    full = an._build_from_records(stock, sales)
+    start_ts, end_ts = an._parse_window("01.01.2024", "10.01.2024")
+    for ds in (after, an._follow_log(second), an._follow_log(an._load_dataset())):
+        assert ds.journal == folded.journal and ds.delta.batches == 1
+        _assert_same_rows(an._rows_body(ds, start_ts, end_ts, None, True),
+                          an._rows_body(full, start_ts, end_ts, None, True))
+
+    # New dumps leave the entries logged against the old ones behind, and
+    # the snapshot with appends folded in goes with the old dumps.
+    (tmp_path / "stock.json").write_bytes(orjson.dumps(stock))
+    (tmp_path / "sales.json").write_bytes(orjson.dumps(sales))
+    reloaded = an._load_dataset()
+    assert reloaded.journal == 0
+    an._rotate_log(reloaded)
+    header, entries, end = journal_mod.read_entries(an.APPEND_LOG, 0)
+    assert header["source"] == [list(stamp) for stamp in reloaded.source] and entries == []
+    followed = an._follow_log(reloaded)
+    assert end == after.delta.log_offset == followed.delta.log_offset and followed.delta.batches == 0
+
+
+def test_codes_dropped_by_refunds_keep_their_history(monkeypatch):
+    monkeypatch.setattr(an, "APPEND_LOG", "")
+    stock, sales = gen_mod.generate(codes=30, events=6, days=10, spoilage=0.2, dead=0.1, seed=4)
+    base = an._build_from_records(stock, sales)
+    code = base.codes[0]
+    qty = sum(rec["Количество"] for rec in sales if rec["Код"] == code)
+    refund = [{"Код": code, "Количество": -qty, "Сумма": -float(base.sales_arr[0]), "Период": "05.01.2024"}]
+    dropped = an._compacted(an._append_batch(base, [], refund))
+    assert code not in dropped.index_by_code and code in dropped.unsold.index
+
+    sale = [{"Код": code, "Количество": 2.0, "Сумма": 100.0, "Период": "06.01.2024"}]
+    stock_more = [dict(stock[0], НоменклатураКод=code, Период="07.01.2024")]
+    again = an._append_batch(dropped, stock_more, sale)
+    full = an._build_from_records(stock + stock_more, sales + refund + sale)
+    assert code in an._folded(again).index_by_code
+    for start, finish in (("01.01.2024", "10.01.2024"), ("04.01.2024", "08.01.2024")):
+        start_ts, end_ts = an._parse_window(start, finish)
+        for period in (False, True):
+            _assert_same_rows(an._rows_body(again, start_ts, end_ts, None, period),
+                              an._rows_body(full, start_ts, end_ts, None, period))
+
+
+def test_appends_relabel_known_codes(monkeypatch):
+    monkeypatch.setattr(an, "APPEND_LOG", "")
+    stock, sales = gen_mod.generate(codes=30, events=6, days=10, spoilage=0.2, dead=0.1, seed=5)
+    base = an._build_from_records(stock, sales)
+    renamed, regrouped, moved = base.codes[0], base.codes[5], base.codes[-1]
+    # The latest records win: names come from sales, groups from stock,
+    # also one no code had before.
+    more_stock = [
+        dict(stock[0], НоменклатураКод=renamed, Номенклатура="Старое имя", Период="08.01.2024"),
+        dict(stock[0], НоменклатураКод=regrouped, Номенклатура=None, Родитель="Группа 1", Период="08.01.2024"),
+        dict(stock[0], НоменклатураКод=moved, Родитель="Новая группа", Период="09.01.2024"),
+    ]
+    more_sales = [{"Код": renamed, "Номенклатура": "Новое имя", "Количество": 1.0, "Сумма": 10.0,
+                   "Период": "08.01.2024"}]
+    appended = an._append_batch(base, more_stock, more_sales)
+    full = an._build_from_records(stock + more_stock, sales + more_sales)
+    folded = an._folded(appended)
+    assert folded.name_by_code[renamed] == full.name_by_code[renamed] == "Новое имя"
+    assert folded.group_by_code[moved] == "Новая группа"
+    assert folded.group_names == full.group_names
+    start_ts, end_ts = an._parse_window("01.01.2024", "10.01.2024")
+    _assert_same_rows(an._rows_body(appended, start_ts, end_ts, None, True),
+                      an._rows_body(full, start_ts, end_ts, None, True))
+    groups = [orjson.loads(an._groups_body(ds, start_ts, end_ts)) for ds in (appended, full)]
+    assert [(g["Group"], g["Codes"], g["ABC"]) for g in groups[0]] == \
+        [(g["Group"], g["Codes"], g["ABC"]) for g in groups[1]]
+    _assert_same_rows(an._rows_body(an._compacted(appended), start_ts, end_ts, None, False),
+                      an._rows_body(full, start_ts, end_ts, None, False))
@@ -1,11 +1,20 @@
 import tempfile
+import asyncio
+import subprocess
+import io
 import os
+import threading
 from app import userid as userid_module
 from app import analytics as an
+from app import jit, profiler, telemetry
 from app.main import app
+from bench import load as load_mod
 from fastapi.testclient import TestClient
 from pathlib import Path
+import httpx
+import numba
 import numpy as np
+import pytest
 import sys
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
@@ -20,6 +29,21 @@ def _read_token():
     return parts[0], int(parts[1])
 
 
+def _install_codes(codes, sales, groups, names=None, *, closes=14_400.0, start=1_706_745_600.0,
+                   price=2.0, loss=0.0, stock=1.0):
+    # One event pair per code: stock arrives at start and sells out closes
+    # seconds later. closes, price and loss are per code or one for all.
+    n = len(codes)
+    times = np.full(2 * n, start)
+    times[1::2] += closes
+    flags = np.tile([stock, 0.0], n)
+    an._install_csr(
+        codes, np.arange(0, 2 * n + 1, 2, dtype=np.int64), times, flags, flags,
+        np.asarray(sales, dtype=np.float64), np.broadcast_to(price, n).astype(np.float64),
+        np.broadcast_to(loss, n).astype(np.float64), names or {}, groups,
+    )
+
+
 def test_auth_token():
     response = client.post(
         "/auth/token", json={"email": "string", "password": "string"})
@@ -37,17 +61,18 @@ def test_userid():
 
 def test_item_analytics():
 
-    an._CODES = ["X"]
-    an._OFFSETS = np.array([0, 2], dtype=np.int64)
-    an._TIMES_FLAT = np.array(
-        [1_700_000_000.0, 1_700_003_600.0], dtype=np.float64)
-    an._STARTS_FLAT = np.array([5.0, 4.0], dtype=np.float64)
-    an._ENDS_FLAT = np.array([4.0, 3.0], dtype=np.float64)
-    an._SALES_ARR = np.array([100.0], dtype=np.float64)
-    an._PRICE_ARR = np.array([10.0], dtype=np.float64)
-    an._LOSSQ_ARR = np.array([1.0], dtype=np.float64)
-    an._NAME_BY_CODE = {"X": "X"}
-    an._GROUP_BY_CODE = {"X": "G"}
+    an._install_csr(
+        ["X"],
+        np.array([0, 2], dtype=np.int64),
+        np.array([1_700_000_000.0, 1_700_003_600.0], dtype=np.float64),
+        np.array([5.0, 4.0], dtype=np.float64),
+        np.array([4.0, 3.0], dtype=np.float64),
+        np.array([100.0], dtype=np.float64),
+        np.array([10.0], dtype=np.float64),
+        np.array([1.0], dtype=np.float64),
+        {"X": "X"},
+        {"X": "G"},
+    )
 
     token, _ = _read_token()
     payload = {
@@ -69,6 +94,478 @@ def test_item_analytics():
         assert resp.json().get("error") == "InvalidId"
 
 
+def test_item_analytics_endpoints_reject_bodies_alike():
+    # Every endpoint answers a malformed or non-object body with 400 and a
+    # foreign token with 403.
+    for path in ("/", "/groups", "/series", "/batch", "/append"):
+        for body in (b"{", b"[1, 2]", b"null"):
+            resp = client.post(f"/item-analytics{path}", content=body)
+            assert resp.status_code == 400 and resp.json() == {"error": "invalid json"}, (path, body)
+        assert client.post(f"/item-analytics{path}", json={"token": "nope"}).status_code == 403
+
+
+def test_item_analytics_cache_hits_and_invalidation():
+    an._install_csr(
+        ["X"],
+        np.array([0, 1], dtype=np.int64),
+        np.array([1_700_000_000.0], dtype=np.float64),
+        np.array([1.0], dtype=np.float64),
+        np.array([1.0], dtype=np.float64),
+        np.array([50.0], dtype=np.float64),
+        np.array([5.0], dtype=np.float64),
+        np.array([0.0], dtype=np.float64),
+        {"X": "X"},
+        {"X": "G"},
+    )
+    token, _ = _read_token()
+    payload = {"token": token, "StartDate": "01.02.2024", "FinishDate": "02.02.2024"}
+
+    before = an.cache_stats()
+    first = client.post("/item-analytics/", json=payload)
+    second = client.post("/item-analytics/", json=payload)
+    after = an.cache_stats()
+    assert first.status_code == second.status_code == 200
+    assert first.content == second.content
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
+    assert after["entries"] == 1
+
+    an._install_csr(
+        ["X"],
+        np.array([0, 0], dtype=np.int64),
+        np.empty(0, dtype=np.float64),
+        np.empty(0, dtype=np.float64),
+        np.empty(0, dtype=np.float64),
+        np.array([70.0], dtype=np.float64),
+        np.array([7.0], dtype=np.float64),
+        np.array([0.0], dtype=np.float64),
+        {"X": "X"},
+        {"X": "G"},
+    )
+    assert an.cache_stats()["entries"] == 0
+    third = client.post("/item-analytics/", json=payload)
+    assert third.json()[0]["Sales"] == 70.0
+
+
+def test_item_analytics_does_not_cache_results_of_a_replaced_dataset(monkeypatch):
+    stock = [{"НоменклатураКод": "X", "Номенклатура": "X", "Родитель": "G", "Период": "01.02.2024",
+              "НачальныйОстаток": 1, "КонечныйОстаток": 1}]
+    sales = [{"Код": "X", "Количество": 1, "Сумма": 10}]
+    an._install_dataset(an._build_from_records(stock, sales))
+    rows_body = an._rows_body
+
+    def reload_meanwhile(ds, *args):
+        # A reload lands while the request is computing on the old snapshot.
+        an._install_dataset(an._build_from_records(stock, sales))
+        return rows_body(ds, *args)
+
+    monkeypatch.setattr(an, "_rows_body", reload_meanwhile)
+    token, _ = _read_token()
+    resp = client.post("/item-analytics/", json={"token": token, "StartDate": "01.02.2024", "FinishDate": "02.02.2024"})
+    assert resp.status_code == 200 and resp.json()[0]["Code"] == "X"
+    assert an.cache_stats()["entries"] == 0
+
+
+def test_item_analytics_batch_matches_single_requests():
+    an._install_csr(
+        ["X", "Y"],
+        np.array([0, 2, 3], dtype=np.int64),
+        np.array([1_706_745_600.0, 1_706_832_000.0, 1_706_745_600.0], dtype=np.float64),
+        np.array([5.0, 0.0, 0.0], dtype=np.float64),
+        np.array([0.0, 3.0, 2.0], dtype=np.float64),
+        np.array([100.0, 40.0], dtype=np.float64),
+        np.array([10.0, 2.0], dtype=np.float64),
+        np.array([1.0, 0.0], dtype=np.float64),
+        {"X": "X", "Y": "Y"},
+        {"X": "G", "Y": "G"},
+    )
+    token, _ = _read_token()
+    ranges = [
+        {"StartDate": "01.02.2024", "FinishDate": "01.02.2024"},
+        {"StartDate": "01.02.2024", "FinishDate": "07.02.2024"},
+        {"StartDate": "02.02.2024", "FinishDate": "03.02.2024"},
+    ]
+
+    single = client.post("/item-analytics/", json={"token": token, **ranges[2]})
+    resp = client.post("/item-analytics/batch", json={"token": token, "Ranges": ranges})
+    assert resp.status_code == 200
+    data = resp.json()
+    assert list(data) == ["01.02.2024-01.02.2024", "01.02.2024-07.02.2024", "02.02.2024-03.02.2024"]
+    assert data["02.02.2024-03.02.2024"] == single.json()
+    for item in ranges[:2]:
+        expected = client.post("/item-analytics/", json={"token": token, **item}).json()
+        assert data[f"{item['StartDate']}-{item['FinishDate']}"] == expected
+
+    # A repeated range is answered once instead of as a duplicate key.
+    repeated = client.post("/item-analytics/batch", json={"token": token, "Ranges": ranges + ranges[:1]})
+    assert repeated.content.count(b'"01.02.2024-01.02.2024"') == 1
+    assert repeated.json() == data
+
+    bad = client.post("/item-analytics/batch", json={"token": token, "Ranges": [{"StartDate": "x"}]})
+    assert bad.status_code == 400
+    assert client.post("/item-analytics/batch", json={"token": token, "Ranges": []}).status_code == 400
+
+
+def test_item_analytics_filters_match_full_list():
+    n = 12
+    codes = [f"C{i}" for i in range(n)]
+    _install_codes(
+        codes, np.arange(1, n + 1) ** 2, {c: ("Even" if i % 2 == 0 else "Odd") for i, c in enumerate(codes)},
+        {c: c.lower() for c in codes}, closes=44_400.0, price=3.0, loss=np.arange(n) % 3,
+    )
+    token, _ = _read_token()
+    base = {"token": token, "StartDate": "01.02.2024", "FinishDate": "01.02.2024"}
+    full = client.post("/item-analytics/", json=base).json()
+
+    def query(**extra):
+        resp = client.post("/item-analytics/", json={**base, **extra})
+        assert resp.status_code == 200
+        return resp.json()
+
+    assert query(Limit=5) == full[:5]
+    assert query(Offset=3, Limit=4) == full[3:7]
+    assert query(Group="Odd") == [r for r in full if r["Group"] == "Odd"]
+    assert query(ABC=["B", "C"]) == [r for r in full if r["ABC"] in "BC"]
+    assert query(Codes=["C3", "C7", "missing"], Group=["Odd"]) == [r for r in full if r["Code"] in ("C3", "C7")]
+    assert query(Group="Odd", ABC="A", Limit=1) == [r for r in full if r["Group"] == "Odd" and r["ABC"] == "A"][:1]
+    assert query(Group="nobody") == []
+    for bad in ({"Limit": -1}, {"ABC": "D"}, {"Codes": "C1,C2".split(",") + [3]}, {"Offset": "1"}):
+        assert client.post("/item-analytics/", json={**base, **bad}).status_code == 400
+
+
+def test_item_analytics_stream_matches_buffered(monkeypatch):
+    n = 10
+    codes = [f"S{i}" for i in range(n)]
+    _install_codes(
+        codes, np.arange(n) * 7 % 11, {c: ("Even" if i % 2 == 0 else "Odd") for i, c in enumerate(codes)},
+        closes=34_400.0 - np.arange(n) * 900.0, price=4.0, loss=np.arange(n) % 2,
+    )
+    monkeypatch.setattr(an, "STREAM_CHUNK_ROWS", 3)
+    token, _ = _read_token()
+    base = {"token": token, "StartDate": "01.02.2024", "FinishDate": "01.02.2024"}
+
+    for extra in ({}, {"Group": "Odd"}, {"Offset": 2, "Limit": 7}, {"PeriodSales": True}, {"Codes": ["none"]}):
+        an._result_cache.clear()
+        streamed = client.post("/item-analytics/", json={**base, **extra, "Stream": True})
+        assert streamed.status_code == 200
+        assert "content-length" not in streamed.headers
+        buffered = client.post("/item-analytics/", json={**base, **extra})
+        assert streamed.content == buffered.content
+    assert client.post("/item-analytics/", json={**base, "Stream": 1}).status_code == 400
+
+
+def test_item_analytics_columnar_formats_match_rows(monkeypatch):
+    n = 7
+    codes = [f"C{i}" for i in range(n)]
+    _install_codes(
+        codes, [5.0, 0.0, 40.0, 12.5, 3.0, 0.0, 9.0], {c: ("G1" if i < 4 else "G2") for i, c in enumerate(codes)},
+        {c: f"name {c}" for c in codes}, closes=24_400.0 + np.arange(n) * 1800.0, loss=np.arange(n) % 3,
+    )
+    token, _ = _read_token()
+    base = {"token": token, "StartDate": "01.02.2024", "FinishDate": "01.02.2024"}
+
+    for extra in ({}, {"Group": "G2", "Limit": 2}):
+        rows = client.post("/item-analytics/", json={**base, **extra}).json()
+        resp = client.post("/item-analytics/", json={**base, **extra},
+                           headers={"Accept": an.COLUMNS_MEDIA})
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == an.COLUMNS_MEDIA
+        cols = resp.json()
+        assert [cols["Codes"][i] for i in cols["Row"]] == [r["Code"] for r in rows]
+        assert [cols["Names"][i] for i in cols["Row"]] == [r["Name"] for r in rows]
+        assert [cols["Groups"][g] for g in cols["Group"]] == [r["Group"] for r in rows]
+        assert list(cols["ABC"]) == [r["ABC"] for r in rows]
+        for key in ("Sales", "Loss", "LossOfProfit", "OSA"):
+            assert cols[key] == pytest.approx([r[key] for r in rows])
+
+        resp = client.post("/item-analytics/", json={**base, **extra},
+                           headers={"Accept": f"application/json;q=0.5, {an.NPZ_MEDIA}"})
+        assert resp.headers["content-type"] == an.NPZ_MEDIA
+        with np.load(io.BytesIO(resp.content)) as npz:
+            assert npz["Codes"][npz["Row"]].tolist() == [r["Code"] for r in rows]
+            assert npz["ABC"].astype(str).tolist() == [r["ABC"] for r in rows]
+            assert npz["OSA"] == pytest.approx([r["OSA"] for r in rows], abs=0.005)
+
+    monkeypatch.setattr(an, "pa", None)
+    resp = client.post("/item-analytics/", json=base, headers={"Accept": an.ARROW_MEDIA})
+    assert resp.status_code == 406
+    resp = client.post("/item-analytics/", json=base, headers={"Accept": f"{an.ARROW_MEDIA}, */*;q=0.1"})
+    assert resp.headers["content-type"] == "application/json"
+
+
+def test_item_analytics_arrow_stream():
+    pa = pytest.importorskip("pyarrow")
+    _install_codes(["A1", "A2", "A3"], [1.0, 9.0, 4.0], {"A1": "G", "A2": "G", "A3": "H"})
+    token, _ = _read_token()
+    base = {"token": token, "StartDate": "01.02.2024", "FinishDate": "01.02.2024"}
+    rows = client.post("/item-analytics/", json=base).json()
+    resp = client.post("/item-analytics/", json=base, headers={"Accept": an.ARROW_MEDIA})
+    table = pa.ipc.open_stream(resp.content).read_all().to_pylist()
+    assert [(t["Code"], t["Name"], t["Group"], t["ABC"]) for t in table] == \
+        [(r["Code"], r["Name"], r["Group"], r["ABC"]) for r in rows]
+
+
+def test_item_analytics_group_rollup_matches_rows():
+    n = 9
+    codes = [f"C{i}" for i in range(n)]
+    sales = np.array([50.0, 0.0, 7.0, 3.0, 0.0, 30.0, 1.0, 2.0, 0.0])
+    _install_codes(
+        codes, sales, {c: "GABC"[i % 3] if i < 8 else "Empty" for i, c in enumerate(codes)},
+        closes=14_400.0 + np.arange(n) * 3600.0, loss=np.arange(n) % 2,
+    )
+    token, _ = _read_token()
+    body = {"token": token, "StartDate": "01.02.2024", "FinishDate": "01.02.2024"}
+    rows = client.post("/item-analytics/", json=body).json()
+    resp = client.post("/item-analytics/groups", json=body)
+    assert resp.status_code == 200
+    groups = resp.json()
+
+    assert [g["Sales"] for g in groups] == sorted((g["Sales"] for g in groups), reverse=True)
+    assert sorted(g["Group"] for g in groups) == sorted({r["Group"] for r in rows})
+    for g in groups:
+        members = [r for r in rows if r["Group"] == g["Group"]]
+        total = sum(r["Sales"] for r in members)
+        assert g["Codes"] == len(members)
+        assert g["Sales"] == pytest.approx(total)
+        assert g["Loss"] == pytest.approx(sum(r["Loss"] for r in members))
+        if total > 0:
+            expected = sum(r["OSA"] * r["Sales"] for r in members) / total
+        else:
+            expected = sum(r["OSA"] for r in members) / len(members)
+        assert g["OSA"] == pytest.approx(expected, abs=0.01)
+        assert g["ABC"] == {k: sum(r["ABC"] == k for r in members) for k in "ABC"}
+
+
+def test_item_analytics_series_matches_daily_requests():
+    day = 86_400.0
+    base_ts = 1_706_745_600.0
+    an._install_csr(
+        ["X", "Y"],
+        np.array([0, 3, 5], dtype=np.int64),
+        np.array([base_ts, base_ts + 1.5 * day, base_ts + 4.2 * day, base_ts - day, base_ts + 2.25 * day]),
+        np.array([3.0, 0.0, 2.0, 1.0, 1.0]),
+        np.array([0.0, 2.0, 1.0, 1.0, 0.0]),
+        np.array([10.0, 5.0]),
+        np.array([1.0, 1.0]),
+        np.array([0.0, 0.0]),
+        {"X": "X", "Y": "Y"},
+        {"X": "G", "Y": "G"},
+    )
+    token, _ = _read_token()
+    resp = client.post("/item-analytics/series", json={
+        "token": token, "StartDate": "01.02.2024", "FinishDate": "10.02.2024", "Bucket": "day"})
+    assert resp.status_code == 200
+    data = resp.json()
+    assert data["Buckets"][0] == "01.02.2024" and len(data["Buckets"]) == 10
+    assert data["Codes"] == ["X", "Y"]
+    for b, label in enumerate(data["Buckets"]):
+        rows = client.post("/item-analytics/", json={
+            "token": token, "StartDate": label, "FinishDate": label}).json()
+        for j, row in enumerate(rows):
+            assert data["OSA"][j][b] == pytest.approx(row["OSA"], abs=0.011)
+
+    weekly = client.post("/item-analytics/series", json={
+        "token": token, "StartDate": "01.02.2024", "FinishDate": "10.02.2024",
+        "Bucket": "week", "Codes": ["Y"]}).json()
+    assert weekly["Buckets"] == ["01.02.2024", "08.02.2024"]
+    assert weekly["Codes"] == ["Y"] and len(weekly["OSA"][0]) == 2
+    bad = client.post("/item-analytics/series", json={
+        "token": token, "StartDate": "01.02.2024", "FinishDate": "01.02.2024", "Bucket": "hour"})
+    assert bad.status_code == 400
+    too_long = client.post("/item-analytics/series", json={
+        "token": token, "StartDate": "01.01.2020", "FinishDate": "31.12.2024", "Bucket": "day"})
+    assert too_long.status_code == 400
+    assert too_long.json()["error"] == f"too many buckets (at most {an.SERIES_MAX_BUCKETS})"
+    undated = client.post("/item-analytics/series", json={"token": token, "StartDate": "x", "FinishDate": "x"})
+    assert undated.json()["error"] == "invalid dates"
+
+
+def _metric(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start + " "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"{line_start} not exported")
+
+
+def test_stage_metrics_and_server_timing(tmp_path, monkeypatch):
+    telemetry.close()
+    monkeypatch.setattr(telemetry, "METRICS_DIR", str(tmp_path))
+    n = 5
+    _install_codes([f"M{i}" for i in range(n)], np.arange(1.0, n + 1), {f"M{i}": "G" for i in range(n)})
+    token, _ = _read_token()
+    body = {"token": token, "StartDate": "01.02.2024", "FinishDate": "01.02.2024"}
+    try:
+        resp = client.post("/item-analytics/", json=body)
+        stages = [part.split(";")[0] for part in resp.headers["server-timing"].split(", ")]
+        for name in ("parse", "user_lookup", "cache", "queue", "metrics", "format", "total"):
+            assert name in stages
+        # A cache hit never reaches the kernels.
+        assert "metrics;" not in client.post("/item-analytics/", json=body).headers["server-timing"]
+        assert "user_lookup" in client.post("/userid/", json={"token": token}).headers["server-timing"]
+
+        text = client.get("/metrics").text
+        assert _metric(text, 'rtu_stage_seconds_count{stage="metrics"}') == 1
+        assert _metric(text, 'rtu_stage_seconds_count{stage="user_lookup"}') == 3
+        assert _metric(text, 'rtu_request_seconds_count{route="/item-analytics/"}') == 2
+        assert _metric(text, 'rtu_responses_total{route="/userid/",code="2xx"}') == 1
+        assert _metric(text, 'rtu_cache_hits_total') >= 1
+        assert _metric(text, f'rtu_dataset_codes{{worker="{os.getpid()}"}}') == n
+        kernel_calls = sum(_metric(text, f'rtu_kernel_calls_total{{kernel="metrics",variant="{v}"}}')
+                           for v in ("parallel", "serial"))
+        assert kernel_calls == 1
+
+        # Another live worker's slab is added in; a dead worker's is dropped.
+        other = np.zeros(telemetry._SLAB_SIZE)
+        other[telemetry._STATUS_AT + telemetry.ROUTES.index("/userid/") * 4] = 5
+        other.tofile(telemetry._slab_path(os.getppid()))
+        gone = subprocess.Popen(["true"])
+        gone.wait()
+        other.tofile(telemetry._slab_path(gone.pid))
+        text = client.get("/metrics").text
+        assert _metric(text, 'rtu_responses_total{route="/userid/",code="2xx"}') == 6
+        assert _metric(text, "rtu_workers") == 2
+        assert not os.path.exists(telemetry._slab_path(gone.pid))
+    finally:
+        telemetry.close()
+
+
+def _spin_for_profiler(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_admin_profile_returns_collapsed_stacks(monkeypatch):
+    token, user_id = _read_token()
+    monkeypatch.setattr(userid_module, "ADMIN_IDS", frozenset({user_id + 1}))
+    assert client.post("/admin/profile", json={"token": token, "Seconds": 0.1}).status_code == 403
+    monkeypatch.setattr(userid_module, "ADMIN_IDS", frozenset({user_id}))
+    assert client.post("/admin/profile", json={"token": token, "Rate": 0}).status_code == 400
+    assert client.post("/admin/profile", json={"token": token, "Seconds": 1e6}).status_code == 400
+
+    stop = threading.Event()
+    spinner = threading.Thread(target=_spin_for_profiler, args=(stop,), name="spinner")
+    spinner.start()
+    try:
+        resp = client.post("/admin/profile", json={"token": token, "Seconds": 0.3, "Rate": 200})
+    finally:
+        stop.set()
+        spinner.join()
+    assert resp.status_code == 200
+    assert 20 <= int(resp.headers["x-profile-samples"]) <= 61
+    lines = resp.text.splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    spinning = [line for line in lines if "_spin_for_profiler (" in line]
+    assert spinning and all(line.startswith("thread (spinner);") for line in spinning)
+    # Idle threads (the test client's loop waiting in select) are left out.
+    assert not any("select (selectors.py:" in line for line in lines)
+
+    assert profiler._busy.acquire(blocking=False)
+    try:
+        assert client.post("/admin/profile", json={"token": token, "Seconds": 0.1}).status_code == 409
+    finally:
+        profiler._busy.release()
+
+
+def test_item_analytics_append_updates_later_requests(tmp_path, monkeypatch):
+    stock = [{"НоменклатураКод": "X", "Номенклатура": "X", "Родитель": "G", "Период": "01.02.2024",
+              "НачальныйОстаток": 1, "КонечныйОстаток": 1}]
+    sales = [{"Код": "X", "Количество": 1, "Сумма": 10, "Период": "01.02.2024"}]
+    an._install_dataset(an._build_from_records(stock, sales))
+    monkeypatch.setattr(an, "APPEND_LOG", str(tmp_path / "appends"))
+    token, user_id = _read_token()
+    query = {"token": token, "StartDate": "01.02.2024", "FinishDate": "29.02.2024"}
+    before = client.post("/item-analytics/", json=query).json()
+
+    added_stock = [{"НоменклатураКод": "Y", "Номенклатура": "Y", "Родитель": "H", "Период": "02.02.2024",
+                    "НачальныйОстаток": 0, "КонечныйОстаток": 2}]
+    added_sales = [{"Код": "X", "Количество": 2, "Сумма": 20, "Период": "03.02.2024"},
+                   {"Код": "Y", "Количество": 1, "Сумма": 50, "Период": "03.02.2024"}]
+    payload = {"token": token, "Stock": added_stock, "Sales": added_sales}
+    monkeypatch.setattr(userid_module, "ADMIN_IDS", frozenset({user_id + 1}))
+    assert client.post("/item-analytics/append", json=payload).status_code == 403
+    monkeypatch.setattr(userid_module, "ADMIN_IDS", frozenset({user_id}))
+    assert client.post("/item-analytics/append", json={"token": token, "Stock": {}}).status_code == 400
+    assert client.post("/item-analytics/append", json={"token": token, "Sales": [1]}).status_code == 400
+    assert not (tmp_path / "appends").exists()
+
+    resp = client.post("/item-analytics/append", json=payload)
+    assert resp.status_code == 200
+    # The delta holds the whole history of touched codes: Y's stock event
+    # and the sales ledger of X (old and new entry) and Y.
+    assert resp.json() == {"Stock": 1, "Sales": 2, "Codes": 2, "DeltaEvents": 4, "Pending": 0}
+    assert len(an.journal.read_entries(str(tmp_path / "appends"), 0)[1]) == 1
+
+    after = {row["Code"]: row for row in client.post("/item-analytics/", json=query).json()}
+    assert [row["Code"] for row in before] == ["X"]
+    assert (after["X"]["Sales"], after["Y"]["Sales"]) == (30.0, 50.0)
+    assert (after["Y"]["ABC"], after["Y"]["Group"]) == ("A", "H")
+    expected = an._build_from_records(stock + added_stock, sales + added_sales)
+    start_ts, end_ts = an._parse_window("01.02.2024", "29.02.2024")
+    assert client.post("/item-analytics/", json=query).content == an._rows_body(expected, start_ts, end_ts, None)
+
+    # The watcher folds the delta into a new base once it is due.
+    monkeypatch.setattr(an, "DELTA_MAX_EVENTS", 0)
+    assert asyncio.run(an._compact_if_due())
+    assert an._delta_size(an._DATASET.delta) == 0
+    assert client.post("/item-analytics/", json=query).content == an._rows_body(expected, start_ts, end_ts, None)
+
+
+def test_ready_after_startup(monkeypatch):
+    monkeypatch.setattr(an, "_DATASET", None)
+    assert client.get("/ready").status_code == 503
+    with TestClient(app) as started:
+        resp = started.get("/ready")
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["ready"] and body["kernels"] and body["dataset"]
+    assert set(body["startup"]) >= {"cpu", "kernels", "dataset", "calibrate", "seconds"}
+    assert body["startup"]["kernels"]["cached"] + body["startup"]["kernels"]["compiled"] > 0
+
+
+def test_ready_surfaces_warmup_failure(monkeypatch):
+    def broken():
+        raise OSError("dump unreadable")
+
+    monkeypatch.setattr(an, "_DATASET", None)
+    monkeypatch.setattr(an, "_load_dataset", broken)
+    with TestClient(app) as started:
+        resp = started.get("/ready")
+    assert resp.status_code == 503
+    body = resp.json()
+    assert body["kernels"] and not body["dataset"]
+    assert body["startup"]["error"] == "OSError: dump unreadable"
+    assert "kernels" in body["startup"] and "dataset" not in body["startup"]
+
+
+def test_jit_cache_is_keyed_by_cpu_target():
+    key = jit.cache_key()
+    assert key.startswith(jit.cpu_target() + "-numba")
+    if "ANALYTICS_JIT_CACHE_DIR" not in os.environ:
+        assert numba.config.CACHE_DIR.endswith(os.sep + key)
+
+
+def test_load_generator_replays_weighted_mix():
+    _install_codes(["L1", "L2"], [5.0, 1.0], {"L1": "G", "L2": "G"},
+                   closes=32_800.0, start=1_704_067_200.0, price=1.0, stock=3.0)
+    token, _ = _read_token()
+    known = load_mod.builtin_scenarios(token, "01.01.2024", "3.01.2024")
+    scenarios = load_mod.parse_mix("item=3,userid=1,auth=1", known)
+    stats = asyncio.run(load_mod.run_load(
+        "http://testserver", scenarios, connections=4, duration=0.5, warmup=0.1,
+        transport=httpx.ASGITransport(app=app),
+    ))
+    summary = load_mod.summarize([stats])
+    assert summary["requests"] > 0 and summary["errors"] == 0 and summary["non_2xx"] == 0
+    assert set(summary["scenarios"]) <= {"item", "userid", "auth"}
+    assert sum(d["count"] for d in summary["scenarios"].values()) == summary["requests"]
+    assert list(summary["latency"]["percentiles"]) == ["50", "75", "90", "95", "99", "99.9", "99.99"]
+    report = load_mod.format_report(summary, "http://testserver", 4)
+    assert "Requests/sec:" in report and "Latency Distribution" in report
+
+
 def test_large_log_file(monkeypatch):
     token = "target"
     user_id = 123